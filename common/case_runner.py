@@ -0,0 +1,113 @@
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+ケース単位の処理をプロセスプールで並列に実行する共通モジュール
+
+各ケースは独立しているため，ワーカー数を指定するとケースをプロセスプールに分配する．
+1ケースの失敗でバッチ全体が止まらないよう，例外はケースごとの結果として記録し，
+最後に集計結果を返す．
+'''
+
+
+def new_case_result(case):
+    """
+    ケースごとの処理結果
+
+    status: 'ok' (処理済み), 'skipped' (入力が不足), 'error' (例外が発生)
+    files: 配置したファイル数
+    messages: 警告などのメッセージ
+    manifest_rows: マニフェストに追加する行 (ManifestWriter.add の引数)
+    extent_entries: ワーカーで更新したz範囲インデックスのエントリ {インデックスのパス: エントリ}
+    metrics: ステージごとの計測結果 (instrumentation.measure_stage)
+    traceback: 例外が発生した場合のトレースバック
+    """
+    return {
+        'case': case,
+        'status': 'ok',
+        'files': 0,
+        'messages': [],
+        'manifest_rows': [],
+        'extent_entries': {},
+        'metrics': [],
+        'traceback': None,
+    }
+
+
+def log_case_message(result, message, verbose=True):
+    """
+    メッセージを結果に記録する（verboseの場合は逐次表示も行う）
+
+    並列実行時は出力が混ざらないよう結果にのみ記録し，summarize_resultsでまとめて表示する．
+    """
+    result['messages'].append(message)
+    if verbose:
+        print(message)
+
+
+def _run_case(func, case, args, kwargs):
+    # ケース内の例外は結果として返す（ワーカープロセスの外へ送出しない）
+    # 結果はここで作成して渡すため，例外の前に記録した計測結果やz範囲インデックスのエントリも残る
+    result = new_case_result(case)
+    try:
+        return func(*args, result=result, **kwargs)
+    except Exception as e:
+        result['status'] = 'error'
+        result['messages'].append(f"{type(e).__name__}: {e}")
+        result['traceback'] = traceback.format_exc()
+        return result
+
+
+def run_cases(func, tasks, num_workers=1):
+    """
+    ケースごとの処理を実行するジェネレータ
+
+    Parameters:
+    func (callable): ケース1つを処理して new_case_result() の形式の結果を返す関数（モジュールのトップレベルに定義）．
+                     キーワード引数 result に new_case_result(case) を渡すので，これに追記して返す
+    tasks (list): (case, args, kwargs) のリスト
+    num_workers (int): プロセス数．1以下の場合は逐次処理
+
+    Yields:
+    dict: ケースごとの結果（並列の場合は完了順）
+    """
+    if num_workers is None or num_workers <= 1 or len(tasks) <= 1:
+        for case, args, kwargs in tasks:
+            yield _run_case(func, case, args, kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_run_case, func, case, args, kwargs): case for case, args, kwargs in tasks}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # ワーカープロセス自体の異常終了など
+                result = new_case_result(futures[future])
+                result['status'] = 'error'
+                result['messages'].append(f"{type(e).__name__}: {e}")
+                yield result
+
+
+def summarize_results(results, title='Summary'):
+    """
+    ケースごとの結果を集計して表示する
+
+    Returns:
+    dict: {'cases': 件数, 'ok': 件数, 'skipped': 件数, 'error': 件数, 'files': 配置したファイル数, 'results': 結果のリスト}
+    """
+    summary = {'cases': len(results), 'ok': 0, 'skipped': 0, 'error': 0, 'files': 0}
+    for result in results:
+        summary[result['status']] += 1
+        summary['files'] += result['files']
+
+    print(f"{title}: {summary['cases']} cases (ok: {summary['ok']}, skipped: {summary['skipped']}, "
+          f"error: {summary['error']}), {summary['files']} files")
+    for result in results:
+        if result['status'] != 'ok':
+            for message in result['messages']:
+                print(f"  [{result['status']}] {result['case']}: {message}")
+
+    summary['results'] = [{key: value for key, value in result.items()
+                           if key not in ('manifest_rows', 'extent_entries')} for result in results]
+    return summary
@@ -0,0 +1,86 @@
+import os
+import json
+import shutil
+import hashlib
+import contextlib
+
+'''
+ファイルの書き込み・ハッシュなど，各スクリプトで共有するファイル操作
+
+インデックスやマニフェストなどの出力は，同じフォルダの一時ファイル ({path}.{pid}.tmp) に書いてから
+os.replace で置き換える．書き込み途中のファイルを他のプロセスに読まれず，途中で止まっても
+前回の内容が残る．
+
+使用例:
+with atomic_write('~/extent_index.json') as f:
+    json.dump(entries, f)
+'''
+
+# ハッシュ計算時の読み込みサイズ
+HASH_CHUNK_SIZE = 1 << 20
+
+# DICOMファイルの拡張子
+DICOM_SUFFIX = '.DCM'
+
+
+def temp_path(path, suffix=''):
+    """
+    path と同じフォルダの一時ファイルのパス（プロセスごとに異なる）
+    """
+    return f"{path}.{os.getpid()}.tmp{suffix}"
+
+
+def replace_path(tmp_path, path):
+    """
+    書き終えた一時ファイル・フォルダで path を置き換える（フォルダの場合は古いフォルダを削除する）
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """
+    一時ファイルを開き，正常に書き終えた場合のみ path に置き換える（例外の場合は一時ファイルを削除）
+
+    Parameters:
+    path (str): 出力先のパス（フォルダがなければ作成）
+    mode (str): open のモード ('w' または 'wb')
+    """
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, obj, **kwargs):
+    """
+    objをJSONとして path に書き出す（atomic_write）
+    """
+    with atomic_write(path) as f:
+        json.dump(obj, f, **kwargs)
+
+
+def update_digest(digest, file_path):
+    """
+    ファイルの内容をハッシュオブジェクトに加える
+    """
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest
+
+
+def file_digest(file_path):
+    """
+    ファイルの内容の sha256（.nii.gzなどは圧縮されたままのバイト列をハッシュする）
+    """
+    return update_digest(hashlib.sha256(), file_path).hexdigest()
@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import contextlib
+from file_io import atomic_write
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+'''
+ケース・ステージごとの処理時間，読み書きしたファイル数・バイト数，マスクのデコード時間，ピーク時のRSSを記録するモジュール
+
+各スクリプトはケースの処理を measure_stage で囲み，計測結果をケースの処理結果 (case_runner.new_case_result) の
+'metrics' に追加する．並列実行時もワーカープロセスから結果と一緒に返るため，記録は親プロセスの MetricsWriter で行う．
+    events_path:     1ステージ1行のJSON (JSON lines)
+    prometheus_path: ステージごとの合計を node_exporter の textfile collector 形式で出力
+
+ファイルごとの表示の代わりに，ProgressReporter で一定間隔ごとに進捗をまとめて表示する．
+
+使用例:
+    with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+        partition_slices(regions, src_dir, metrics=metrics)
+'''
+
+# 進捗を表示する間隔（秒）
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+# Prometheusのtextfileを書き出す間隔（秒）
+PROMETHEUS_INTERVAL = 30.0
+
+METRIC_PREFIX = 'slicepartitioning'
+
+# ステージごとに合計する項目
+COUNTER_FIELDS = ('seconds', 'files_read', 'bytes_read', 'files_written', 'bytes_written', 'decode_seconds')
+
+
+def peak_rss_bytes():
+    """
+    プロセスのピーク時のRSS（バイト）．取得できない場合はNone
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト，macOSはバイト
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def folder_size(path):
+    """
+    フォルダ直下のファイル数と合計バイト数 (例: DICOMシリーズ)
+    """
+    files = nbytes = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_file():
+                files += 1
+                nbytes += entry.stat().st_size
+    except OSError:
+        pass
+    return files, nbytes
+
+
+class StageMetrics:
+    """
+    1ケース・1ステージ分の計測値
+
+    Parameters:
+    case (str): ケース名
+    stage (str): ステージ名 (例: 'split', 'partition', 'blend')
+    """
+
+    def __init__(self, case, stage):
+        self.case = case
+        self.stage = stage
+        self.seconds = 0.0
+        self.files_read = 0
+        self.bytes_read = 0
+        self.files_written = 0
+        self.bytes_written = 0
+        self.decode_seconds = 0.0
+        self.peak_rss_bytes = None
+        self._start = None
+
+    def read(self, nbytes, files=1):
+        self.files_read += files
+        self.bytes_read += nbytes
+
+    def write(self, nbytes, files=1):
+        self.files_written += files
+        self.bytes_written += nbytes
+
+    @contextlib.contextmanager
+    def decoding(self, *paths):
+        """
+        マスクなどの読み込み・デコード時間を計測する（pathsのサイズを読み込んだバイト数に加える）
+        """
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.decode_seconds += time.perf_counter() - start
+            for path in paths:
+                self.read(file_size(path))
+
+    def add_materializer(self, materializer):
+        """
+        Materializerで配置したファイル数とコピーしたバイト数を加える（コピーは同じバイト数を読み込む）
+        """
+        self.write(materializer.bytes_copied, materializer.files_placed)
+        self.read(materializer.bytes_copied, materializer.files_copied)
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def stop(self):
+        if self._start is not None:
+            self.seconds += time.perf_counter() - self._start
+            self._start = None
+        self.peak_rss_bytes = peak_rss_bytes()
+
+    def to_event(self, status='ok'):
+        return {
+            'event': 'stage',
+            'timestamp': time.time(),
+            'pid': os.getpid(),
+            'case': self.case,
+            'stage': self.stage,
+            'status': status,
+            'seconds': self.seconds,
+            'files_read': self.files_read,
+            'bytes_read': self.bytes_read,
+            'files_written': self.files_written,
+            'bytes_written': self.bytes_written,
+            'decode_seconds': self.decode_seconds,
+            'peak_rss_bytes': self.peak_rss_bytes,
+        }
+
+
+@contextlib.contextmanager
+def measure_stage(result, stage):
+    """
+    ステージの処理を計測し，終了時にイベントを result['metrics'] に追加する（例外が発生した場合も追加）
+
+    Parameters:
+    result (dict): ケースの処理結果 (case_runner.new_case_result)
+    stage (str): ステージ名
+
+    使用例:
+    with measure_stage(result, 'split') as metrics:
+        with metrics.decoding(mask_path):
+            occupancy = get_slice_occupancy(mask_path)
+    """
+    metrics = StageMetrics(result['case'], stage)
+    metrics.start()
+    status = None
+    try:
+        yield metrics
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        metrics.stop()
+        result['metrics'].append(metrics.to_event(status or result['status']))
+
+
+class ProgressReporter:
+    """
+    ファイルごとに表示する代わりに，interval秒ごとに進捗をまとめて表示する
+
+    Parameters:
+    title (str): 表示する処理名
+    total_cases (int): 全ケース数（指定した場合は残り時間も表示）
+    interval (float): 表示する間隔（秒）．Noneの場合は close() 時のみ表示
+    """
+
+    def __init__(self, title, total_cases=None, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.title = title
+        self.total_cases = total_cases
+        self.interval = interval
+        self.cases = 0
+        self.files = 0
+        self.bytes = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+
+    def update(self, files=0, nbytes=0, cases=0):
+        self.files += files
+        self.bytes += nbytes
+        self.cases += cases
+        now = time.perf_counter()
+        if self.interval is not None and now - self._last >= self.interval:
+            self._last = now
+            self.report()
+
+    def add_result(self, result):
+        """
+        ケースの処理結果1件分の進捗を加える
+        """
+        nbytes = sum(event['bytes_written'] for event in result.get('metrics', []))
+        self.update(result['files'], nbytes, cases=1)
+
+    def report(self, final=False):
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        message = (f"[{self.title}] {self.files} files, {self.bytes / 2**20:.1f} MiB "
+                   f"({self.files / elapsed:.1f} files/s, {self.bytes / 2**20 / elapsed:.1f} MiB/s)")
+        if self.total_cases:
+            message += f", {self.cases}/{self.total_cases} cases"
+            if not final and 0 < self.cases < self.total_cases:
+                message += f", ETA {elapsed / self.cases * (self.total_cases - self.cases):.0f} s"
+        message += f", {elapsed:.1f} s elapsed" if final else ""
+        print(message)
+
+    def close(self):
+        self.report(final=True)
+
+
+class MetricsWriter:
+    """
+    ステージごとの計測結果をJSON lines / Prometheusのtextfileに出力する
+
+    Parameters:
+    events_path (str): 指定した場合はイベントを1行ずつ追記する (.jsonl)
+    prometheus_path (str): 指定した場合はステージごとの合計をPrometheusのtextfile形式で出力する (.prom)
+    prometheus_interval (float): 実行中にtextfileを更新する間隔（秒）
+    """
+
+    def __init__(self, events_path=None, prometheus_path=None, prometheus_interval=PROMETHEUS_INTERVAL):
+        self.events_path = os.path.expanduser(events_path) if events_path else None
+        self.prometheus_path = os.path.expanduser(prometheus_path) if prometheus_path else None
+        self.prometheus_interval = prometheus_interval
+        self.totals = {}
+        self._events_file = None
+        self._last_prometheus = time.perf_counter()
+
+        if self.events_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.events_path)), exist_ok=True)
+            self._events_file = open(self.events_path, 'a', buffering=1)
+
+    def add(self, event):
+        """
+        イベント1件を記録する (StageMetrics.to_event の形式)
+        """
+        if self._events_file is not None:
+            self._events_file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+        totals = self.totals.setdefault(event['stage'], dict.fromkeys(COUNTER_FIELDS, 0))
+        for field in COUNTER_FIELDS:
+            totals[field] += event[field]
+        totals['cases'] = totals.get('cases', 0) + 1
+        status_key = f"status_{event['status']}"
+        totals[status_key] = totals.get(status_key, 0) + 1
+        if event['peak_rss_bytes'] is not None:
+            totals['peak_rss_bytes'] = max(totals.get('peak_rss_bytes', 0), event['peak_rss_bytes'])
+
+        if self.prometheus_path is not None and time.perf_counter() - self._last_prometheus >= self.prometheus_interval:
+            self.write_prometheus()
+
+    def add_result(self, result):
+        """
+        ケースの処理結果 (case_runner.new_case_result) に含まれるイベントを記録する
+        """
+        for event in result.get('metrics', []):
+            self.add(event)
+
+    def write_prometheus(self):
+        """
+        ステージごとの合計をtextfileに書き出す（書き込み途中のファイルを読まれないよう置き換える）
+        """
+        self._last_prometheus = time.perf_counter()
+        lines = []
+        metrics = [
+            ('stage_seconds_total', 'seconds', 'counter', 'Wall time spent in each stage'),
+            ('stage_decode_seconds_total', 'decode_seconds', 'counter', 'Time spent reading and decoding masks'),
+            ('stage_files_read_total', 'files_read', 'counter', 'Files read by each stage'),
+            ('stage_bytes_read_total', 'bytes_read', 'counter', 'Bytes read by each stage'),
+            ('stage_files_written_total', 'files_written', 'counter', 'Files written by each stage'),
+            ('stage_bytes_written_total', 'bytes_written', 'counter', 'Bytes written by each stage'),
+            ('stage_cases_total', 'cases', 'counter', 'Cases processed by each stage'),
+            ('stage_peak_rss_bytes', 'peak_rss_bytes', 'gauge', 'Peak resident set size of the processes running each stage'),
+        ]
+        for name, field, metric_type, help_text in metrics:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for stage, totals in sorted(self.totals.items()):
+                if field in totals:
+                    lines.append(f'{METRIC_PREFIX}_{name}{{stage="{stage}"}} {totals[field]}')
+
+        lines.append(f"# HELP {METRIC_PREFIX}_stage_status_total Cases by stage and status")
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_status_total counter")
+        for stage, totals in sorted(self.totals.items()):
+            for key, value in sorted(totals.items()):
+                if key.startswith('status_'):
+                    lines.append(f'{METRIC_PREFIX}_stage_status_total{{stage="{stage}",status="{key[7:]}"}} {value}')
+
+        with atomic_write(self.prometheus_path) as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        if self._events_file is not None:
+            self._events_file.close()
+            self._events_file = None
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,319 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime
+import numpy as np
+import series_index
+from synthetic_cohort import make_cohort, make_generated_folders, ORGAN_EXTENTS
+from mask_extent import get_slice_occupancy
+from extent_index import ExtentIndex, INDEX_FILENAME
+from slicePt_2segmentation import process_all_cases
+from slicepartitioning import copy_slices_up_to_segmentation, find_and_copy_missing_files, partition_slices
+from unity_dcmfolder import blend_case, weights
+
+'''
+合成データセットで各ステージの処理時間を計測するベンチマーク（CPUのみ）
+
+synthetic_cohortでDICOMシリーズと臓器マスクを作成し（セグメンテーションは作成済みのマスクで代用），
+以下のステージをrepeat回ずつ計測して結果をJSONに保存する．コミット間の比較は --compare で行う．
+    mask_extent:               全マスクのget_slice_occupancy
+    extent_index_warm:         変更のないマスクのExtentIndexの参照
+    split_dicom_files:         slicePt_2segmentationのprocess_all_cases（ヘッダの検証と配置）
+    copy_slices_up_to_segmentation: 3領域のコピー
+    gap_fill:                  find_and_copy_missing_files（upper-middle, lower-middle）
+    partition_slices:          z区間を求めてから1回で分割（copy + gap_fill と同じ出力）
+    blend:                     unity_dcmfolderのblend_case
+
+繰り返しごとに出力フォルダとシリーズのインデックスのキャッシュを削除するため，各計測はコールドな状態から行う
+（OSのページキャッシュは除く）．
+
+使用例:
+    python benchmark.py --cases 4 --slices 200 --matrix 128 --repeat 3 --output bench.json
+    python benchmark.py --compare bench_before.json bench.json
+'''
+
+# 領域ごとの (領域ラベル, 臓器名, copy_all)（上から順）
+REGIONS = [
+    ('upper', 'thyroid_gland', True),
+    ('middle', 'whole_lung', False),
+    ('lower', 'kidney', False),
+]
+
+
+def git_revision():
+    """
+    現在のコミットと未コミットの変更の有無を返す（gitが使えない場合はNone）
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=script_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=script_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': bool(status)}
+
+
+def _reset(folder):
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+
+def _clear_caches(organ_folder):
+    # 計測間でインデックスを再利用しないよう削除
+    series_index._INDEX_CACHE.clear()
+    for folder_name, _, _ in ORGAN_EXTENTS.values():
+        index_path = os.path.join(organ_folder, f'dataset_{folder_name}', INDEX_FILENAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+
+def _timed(func, quiet=True):
+    # 各スクリプトのファイルごとの表示は計測に含めない
+    start = time.perf_counter()
+    if quiet:
+        with contextlib.redirect_stdout(io.StringIO()):
+            value = func()
+    else:
+        value = func()
+    return time.perf_counter() - start, value
+
+
+class StageTimer:
+    """
+    ステージごとの計測結果を集める
+
+    Parameters:
+    quiet (bool): Trueの場合はステージ内の表示を抑制
+    """
+
+    def __init__(self, quiet=True):
+        self.quiet = quiet
+        self.stages = {}
+
+    def run(self, name, func, items=None):
+        """
+        funcを実行して時間を記録する
+
+        Parameters:
+        name (str): ステージ名
+        func (callable): 計測する処理（引数なし）
+        items (int or callable): 処理した件数（callableの場合はfuncの戻り値から求める）
+
+        Returns:
+        funcの戻り値
+        """
+        seconds, value = _timed(func, self.quiet)
+        if callable(items):
+            items = items(value)
+        stage = self.stages.setdefault(name, {'seconds': [], 'items': items})
+        stage['seconds'].append(seconds)
+        print(f"{name}: {seconds:.3f} s" + (f" ({items} items)" if items is not None else ""))
+        return value
+
+    def summary(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            seconds = stage['seconds']
+            median = statistics.median(seconds)
+            stages[name] = {
+                'seconds': seconds,
+                'min': min(seconds),
+                'median': median,
+                'mean': statistics.fmean(seconds),
+                'items': stage['items'],
+                'items_per_second': stage['items'] / median if stage['items'] and median > 0 else None,
+            }
+        return stages
+
+
+def run_benchmarks(work_dir, n_cases=4, n_slices=200, matrix_size=128, repeat=3, materialize_method='copy',
+                   num_workers=1, quiet=True, keep=False):
+    """
+    合成データセットを作成して各ステージを計測する
+
+    Parameters:
+    work_dir (str): 合成データセットと出力を作成するフォルダ
+    n_cases (int): ケース数
+    n_slices (int): 1シリーズあたりのスライス数
+    matrix_size (int): 画像の縦横のピクセル数
+    repeat (int): 各ステージの計測回数
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    num_workers (int): ケースを並列に処理するプロセス数（blendはスレッド数）
+    quiet (bool): Trueの場合はステージ内の表示を抑制
+    keep (bool): Falseの場合は終了後にwork_dir内に作成した実行ごとのフォルダ (benchmark_*) を削除
+
+    Returns:
+    dict: {'meta': 実行環境とパラメータ, 'stages': {ステージ名: 計測結果}}
+    """
+    params = {'cases': n_cases, 'slices': n_slices, 'matrix': matrix_size, 'repeat': repeat,
+              'materialize_method': materialize_method, 'num_workers': num_workers}
+    # work_dir内に実行ごとのフォルダを作成し，その中だけを使う（既存のファイルは変更・削除しない）
+    os.makedirs(work_dir, exist_ok=True)
+    run_dir = tempfile.mkdtemp(prefix='benchmark_', dir=work_dir)
+    cohort_dir = os.path.join(run_dir, 'cohort')
+    out_dir = os.path.join(run_dir, 'out')
+
+    print(f"Generating synthetic cohort: {params}")
+    start = time.perf_counter()
+    cohort = make_cohort(cohort_dir, n_cases, n_slices, matrix_size)
+    generate_seconds = time.perf_counter() - start
+
+    dataset = cohort['dataset']
+    organ_folder = cohort['organSeg']
+    organ_dirs = {organ_name: os.path.join(organ_folder, f'dataset_{folder_name}')
+                  for organ_name, (folder_name, _, _) in ORGAN_EXTENTS.items()}
+    masks = [os.path.join(organ_dirs[organ_name], f'{case}_CT2', f'{organ_name}_{case}_CT2.nii.gz')
+             for organ_name in organ_dirs for case in cohort['cases']]
+    n_files = cohort['slices']
+
+    timer = StageTimer(quiet)
+    try:
+        for k in range(repeat):
+            print(f"--- repeat {k + 1}/{repeat}")
+            _reset(out_dir)
+            _clear_caches(organ_folder)
+
+            timer.run('mask_extent', lambda: [get_slice_occupancy(mask) for mask in masks], len(masks))
+
+            indexes = [ExtentIndex(organ_dirs[organ_name]) for organ_name in organ_dirs]
+            for index in indexes:
+                for mask in masks:
+                    if mask.startswith(index.nifti_dir + os.sep):
+                        index.get_slice_occupancy(mask)
+            timer.run('extent_index_warm',
+                      lambda: [index.get_slice_occupancy(mask) for index in indexes for mask in masks
+                               if mask.startswith(index.nifti_dir + os.sep)], len(masks))
+
+            _clear_caches(organ_folder)
+            split_base = os.path.join(out_dir, 'split', 'dataset')
+            timer.run('split_dicom_files',
+                      lambda: process_all_cases(dataset, organ_dirs['aorta'], organ_dirs['liver'], split_base,
+                                                materialize_method=materialize_method, num_workers=num_workers,
+                                                verbose=False),
+                      n_files)
+
+            _clear_caches(organ_folder)
+            copy_dirs = {region: os.path.join(out_dir, 'copy', f'dataset_{region}') for region, _, _ in REGIONS}
+            timer.run('copy_slices_up_to_segmentation',
+                      lambda: [copy_slices_up_to_segmentation(organ_dirs[organ_name], dataset, copy_dirs[region],
+                                                              organ_name, copy_all,
+                                                              materialize_method=materialize_method,
+                                                              num_workers=num_workers, verbose=False)
+                               for region, organ_name, copy_all in REGIONS],
+                      n_files)
+
+            timer.run('gap_fill',
+                      lambda: [find_and_copy_missing_files(copy_dirs['upper'], copy_dirs['middle'], dataset,
+                                                           materialize_method=materialize_method),
+                               find_and_copy_missing_files(copy_dirs['lower'], copy_dirs['middle'], dataset,
+                                                           materialize_method=materialize_method)],
+                      n_files)
+
+            _clear_caches(organ_folder)
+            partition_dirs = {region: os.path.join(out_dir, 'partition', f'dataset_{region}')
+                              for region, _, _ in REGIONS}
+            regions = [(organ_dirs[organ_name], partition_dirs[region], organ_name, copy_all)
+                       for region, organ_name, copy_all in REGIONS]
+            timer.run('partition_slices',
+                      lambda: partition_slices(regions, dataset, materialize_method=materialize_method,
+                                               num_workers=num_workers, verbose=False),
+                      n_files)
+
+            # 推論の代わりに分割したCT2をそのまま生成画像とする（計測に含めない）
+            with contextlib.redirect_stdout(io.StringIO()):
+                folders = make_generated_folders(os.path.join(out_dir, 'generated'), partition_dirs)
+            blend_dir = os.path.join(out_dir, 'blend')
+            timer.run('blend',
+                      lambda: sum(len(blend_case(case, folders, blend_dir, weights, max_workers=num_workers))
+                                  for case in cohort['cases']),
+                      lambda n_outputs: n_outputs)
+    finally:
+        if keep:
+            print(f"Synthetic cohort and outputs kept in {run_dir}")
+        else:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'params': params,
+            'cohort_files': n_files,
+            'generate_seconds': generate_seconds,
+        },
+        'stages': timer.summary(),
+    }
+
+
+def save_results(results, output_path):
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved benchmark results: {output_path}")
+
+
+def compare_results(baseline_path, current_path):
+    """
+    2つの計測結果のステージごとの中央値を比較して表示する
+
+    Returns:
+    dict: {ステージ名: 中央値の比 (current / baseline)}
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    with open(current_path, 'r') as f:
+        current = json.load(f)
+
+    if baseline['meta']['params'] != current['meta']['params']:
+        print(f"Warning: parameters differ: {baseline['meta']['params']} vs {current['meta']['params']}")
+
+    ratios = {}
+    print(f"{'stage':<32} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, stage in current['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f"{name:<32} {'-':>10} {stage['median']:>10.3f} {'-':>7}")
+            continue
+        ratios[name] = stage['median'] / base['median'] if base['median'] > 0 else None
+        ratio = f"{ratios[name]:.2f}" if ratios[name] is not None else '-'
+        print(f"{name:<32} {base['median']:>10.3f} {stage['median']:>10.3f} {ratio:>7}")
+    return ratios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic-data benchmark for the slice partitioning pipeline')
+    parser.add_argument('--cases', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=200)
+    parser.add_argument('--matrix', type=int, default=128)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--materialize-method', default='copy')
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--work-dir', default='~/benchmark_work')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic cohort and outputs')
+    parser.add_argument('--verbose', action='store_true', help='show messages from each stage')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit(0)
+
+    results = run_benchmarks(os.path.expanduser(args.work_dir), args.cases, args.slices, args.matrix, args.repeat,
+                             args.materialize_method, args.num_workers, quiet=not args.verbose, keep=args.keep)
+    save_results(results, args.output)
@@ -0,0 +1,428 @@
+import os
+import json
+import shutil
+import hashlib
+import traceback
+import script_paths  # noqa: F401
+from volume_cache import load_mask_extent, store_volume
+from materialize import DEFAULT_MATERIALIZE_WORKERS
+from slicepartitioning import place_case_slices
+from partition_planner import plan_from_occupancies, interval_to_occupancy
+from unity_dcmfolder import blend_case, weights as DEFAULT_WEIGHTS
+from routing import RoutingTable
+from pipeline import DEFAULT_REGIONS, region_dirs, nifti_cache_path, mask_cache_path
+# 以下は totalSegmentator/script と common/ のモジュール
+from segmenter import GroupSegmenter
+from mask_io import save_mask
+from dcm2nifti import convert_case
+from case_runner import new_case_result
+from instrumentation import measure_stage
+from file_io import file_digest, write_json
+
+'''
+ケースごとの処理（変換 → セグメンテーション → 領域分割 → 生成画像の統合）を差分ビルドするモジュール
+
+ステージごとに「入力ファイルのハッシュ・パラメータ（臓器リスト，copy_all，重みなど）・上流ステージのキー」
+からキーを求め，ケースごとに build_state.json へ記録する．再実行時はキーが変わったステージと
+その下流のステージだけを処理する．
+
+例えば腎臓の臓器リストを変更した場合は，全ケースの segment:kidney と split だけが再実行され，
+convert と他の臓器の segment は再実行されない．
+
+ステージ (build_pipeline_graph):
+    convert          : DICOMシリーズ → work_dir/dataset_nifti/{case}_{series}.nii.gz
+    segment:<臓器名>  : 臓器マスク → work_dir/organSeg/dataset_{臓器名}/{case}_CT2/（古いグループをまとめて1回で推論）
+    split:<領域>      : 分割データセット output_base/dataset_{領域}/{case}（全領域のマスクからz区間を求める）
+    blend            : 生成画像の加重平均 blend_output/{case}（generated_foldersを指定した場合）
+
+臓器が見つからなかった臓器グループは，そのステージだけを 'empty' として記録し（マスクは保存しない），
+split ではマスクがない領域として扱う (partition_planner.plan_from_occupancies)．
+'''
+
+STATE_FILENAME = 'build_state.json'
+STATE_VERSION = 2
+
+
+def _digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Stage:
+    """
+    ビルドグラフの1ステージ
+
+    Parameters:
+    name (str): ステージ名
+    run (callable): run(case) でケース1つを処理する．batchを指定した場合は run(case, ステージ名のリスト)
+                    出力を作らずに終えたステージがある場合は {ステージ名: 'empty'} を返す
+    deps (list): 上流のステージ名
+    params (dict): 結果に影響するパラメータ（JSONに変換できる値）
+    inputs (callable): inputs(case) -> 外部の入力ファイル・フォルダのパスのリスト
+    outputs (callable): outputs(case) -> 出力ファイル・フォルダのパスのリスト
+    batch (str): 同じbatchの古いステージはケースごとにまとめて1回のrunで処理する
+    """
+
+    def __init__(self, name, run, deps=(), params=None, inputs=None, outputs=None, batch=None):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.params = params or {}
+        self.inputs = inputs or (lambda case: [])
+        self.outputs = outputs or (lambda case: [])
+        self.batch = batch
+
+
+class BuildState:
+    """
+    ステージごとの記録と入力ファイルのハッシュのキャッシュ (build_state.json)
+
+    Parameters:
+    state_path (str): 記録ファイルのパス
+    """
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.cases = {}
+        # 単独の入力ファイルのパス -> {size, mtime_ns, sha256}（フォルダ内のファイルは記録しない）
+        self.files = {}
+
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == STATE_VERSION:
+                    self.cases = data.get('cases', {})
+                    self.files = data.get('files', {})
+            except (OSError, ValueError) as e:
+                print(f"Failed to read build state {state_path}: {e}")
+
+    def file_digest(self, file_path):
+        stat = os.stat(file_path)
+        entry = self.files.get(file_path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_digest(file_path)}
+            self.files[file_path] = entry
+        return entry['sha256']
+
+    def path_digest(self, path):
+        """
+        ファイルまたはフォルダのハッシュを返す．存在しない場合はNone
+
+        フォルダ（DICOMシリーズなど）は中の全ファイルの相対パス・サイズ・更新時刻から1つのハッシュを求め，
+        ファイルの内容は読まない．単独のファイル（ルーティングテーブルなど）のみ内容のハッシュを使う．
+        """
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = os.path.join(root, file_name)
+                stat = os.stat(file_path)
+                digest.update(f"{os.path.relpath(file_path, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n"
+                              .encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, case, stage_name):
+        return self.cases.get(case, {}).get(stage_name)
+
+    def set(self, case, stage_name, record):
+        self.cases.setdefault(case, {})[stage_name] = record
+
+    def save(self):
+        write_json(self.state_path, {'version': STATE_VERSION, 'cases': self.cases, 'files': self.files})
+
+
+class BuildGraph:
+    """
+    ステージの依存関係に従ってケースごとに差分ビルドを行う
+
+    Parameters:
+    stages (list): Stageのリスト
+    state_path (str): 記録ファイルのパス
+    """
+
+    def __init__(self, stages, state_path):
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = self._sort(stages)
+        self.state = BuildState(state_path)
+
+    def _sort(self, stages):
+        # 上流のステージが先になるよう並べる
+        order, visiting = [], set()
+
+        def visit(stage):
+            if stage.name in order:
+                return
+            if stage.name in visiting:
+                raise ValueError(f"Cyclic dependency at stage {stage.name}")
+            visiting.add(stage.name)
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"Unknown stage {dep} (required by {stage.name})")
+                visit(self.stages[dep])
+            order.append(stage.name)
+
+        for stage in stages:
+            visit(stage)
+        return order
+
+    def _plan(self, case, force):
+        """
+        ステージごとのキーを求め，処理が必要なステージを返す
+        """
+        keys, records, stale, missing = {}, {}, [], set()
+        digests = {}  # 複数のステージが読むシリーズフォルダは1回だけ確認する
+        for name in self.order:
+            stage = self.stages[name]
+            for path in stage.inputs(case):
+                if path not in digests:
+                    digests[path] = self.state.path_digest(path)
+            inputs = {path: digests[path] for path in stage.inputs(case)}
+            if inputs and all(digest is None for digest in inputs.values()):
+                # 入力がまだ存在しない（例: 生成画像が未作成）
+                missing.add(name)
+                continue
+            if any(dep in missing for dep in stage.deps):
+                missing.add(name)
+                continue
+
+            deps = {dep: keys[dep] for dep in stage.deps}
+            keys[name] = _digest({'params': stage.params, 'inputs': inputs, 'deps': deps})
+            records[name] = {'key': keys[name], 'params': stage.params, 'inputs': inputs, 'deps': deps}
+
+            record = self.state.get(case, name)
+            if record is not None and record.get('status') == 'empty':
+                # 臓器が見つからなかったステージは出力を作らない
+                outputs_exist = True
+            else:
+                outputs_exist = all(os.path.exists(path) for path in stage.outputs(case))
+            if name in force or record is None or record['key'] != keys[name] or not outputs_exist:
+                stale.append(name)
+        return records, stale, missing
+
+    def run(self, cases, force=(), metrics=None):
+        """
+        Parameters:
+        cases (list): ケース名のリスト
+        force (list): キーに関係なく再実行するステージ名
+        metrics (MetricsWriter): 指定した場合は実行したステージごとの処理時間とピーク時のRSSを出力
+                                 (instrumentation.MetricsWriter．batchのステージはbatch名でまとめて記録)
+
+        Returns:
+        dict: {'run': 件数, 'up_to_date': 件数, 'failed': 件数, 'blocked': 件数, 'missing': 件数}（ステージ単位）
+        """
+        counts = {'run': 0, 'up_to_date': 0, 'failed': 0, 'blocked': 0, 'missing': 0}
+
+        for case in cases:
+            records, stale, missing = self._plan(case, set(force))
+            counts['missing'] += len(missing)
+            counts['up_to_date'] += len(records) - len(stale)
+
+            failed, done = set(), set()
+            for name in stale:
+                if name in done:
+                    continue
+                stage = self.stages[name]
+                if any(dep in failed for dep in stage.deps):
+                    failed.add(name)
+                    counts['blocked'] += 1
+                    print(f"{case}: {name} blocked")
+                    continue
+
+                # 同じbatchの古いステージはまとめて処理
+                names = [name]
+                if stage.batch is not None:
+                    names = [other for other in stale if other not in done
+                             and self.stages[other].batch == stage.batch]
+                result = new_case_result(case)
+                try:
+                    with measure_stage(result, stage.batch or name):
+                        if stage.batch is not None:
+                            statuses = stage.run(case, names)
+                        else:
+                            statuses = stage.run(case)
+                except Exception as e:
+                    failed.update(names)
+                    done.update(names)
+                    counts['failed'] += len(names)
+                    print(f"{case}: {', '.join(names)} failed: {type(e).__name__}: {e}")
+                    print(traceback.format_exc())
+                    continue
+                finally:
+                    if metrics is not None:
+                        metrics.add_result(result)
+
+                for done_name in names:
+                    status = (statuses or {}).get(done_name, 'done')
+                    record = dict(records[done_name], outputs=self.stages[done_name].outputs(case), status=status)
+                    self.state.set(case, done_name, record)
+                    print(f"{case}: {done_name} {status}")
+                done.update(names)
+                counts['run'] += len(names)
+
+            # 中断しても処理済みのステージは再実行しないよう，ケースごとに保存
+            self.state.save()
+
+        print(f"Build complete: {counts['run']} run, {counts['up_to_date']} up to date, {counts['failed']} failed, "
+              f"{counts['blocked']} blocked, {counts['missing']} waiting for inputs")
+        return counts
+
+
+def build_pipeline_graph(dataset_folder, work_dir, output_base, regions=DEFAULT_REGIONS, series='CT2', margin=0,
+                         extend_bottom=False, segment_fn=None, materialize_method='copy',
+                         materialize_workers=DEFAULT_MATERIALIZE_WORKERS, generated_folders=None, blend_output=None,
+                         weights=DEFAULT_WEIGHTS, state_path=None, volume_cache=None,
+                         routing_path=None, compression=None):
+    """
+    Parameters:
+    dataset_folder (str): 分割前のDICOMデータセットのフォルダ（ケースフォルダ/CT1, CT2）
+    work_dir (str): 変換したNIfTIと臓器マスクを保存するフォルダ
+    output_base (str): 分割したデータセット(dataset_upper, dataset_middle, dataset_lower)を作成するフォルダ
+    regions (list): 上の領域から順に [(領域ラベル, 臓器名, [TotalSegmentatorの臓器名], copy_all), ...]
+    series (str): セグメンテーションに使うCTフォルダ名
+    margin (int): 隣り合う領域と重複させるスライス数 (partition_planner.plan_intervals)
+    extend_bottom (bool): 最後の領域を下端のスライスまで含めるか
+    segment_fn (callable): セグメンテーションの関数（Noneの場合はTotalSegmentator．テスト時はスタブを渡す）
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    materialize_workers (int): 配置を並列に行うスレッド数
+    generated_folders (list): 各領域の生成画像のフォルダ（指定した場合はblendステージを追加）
+    blend_output (str): 統合した生成画像の出力先
+    weights (dict): 統合時の領域ごとの重み
+    state_path (str): 記録ファイルのパス．Noneの場合は work_dir/build_state.json
+    volume_cache (str): 指定した場合は臓器マスクと生成画像を非圧縮のキャッシュ (volume_cache) からメモリマップで読み込む
+                        （segmentで保存したマスクはそのままキャッシュにも書き込む）
+    routing_path (str): 指定した場合はblendでルーティングテーブル (routing.RoutingTable) で割り当てた生成画像のみを読み込む
+    compression (str): 指定した場合はblendの出力を可逆圧縮する ('jpegls', 'jpeg2000')
+
+    Returns:
+    BuildGraph: graph.run(cases) で実行
+    """
+    output_dirs = region_dirs(output_base, regions)
+    nifti_dir = os.path.join(work_dir, 'dataset_nifti')
+    region_config = {region: (organ_name, rois, copy_all) for region, organ_name, rois, copy_all in regions}
+    segmenters = []
+
+    # 臓器が見つからない領域があると，その上下で最も近い領域どうしの間を補うため (partition_planner)，
+    # 領域ごとのz区間は全領域のマスクから求める
+    order = [region for region, _, _, _ in regions]
+
+    def series_dirs(case):
+        # 領域分割で読み込むシリーズフォルダ（ケースフォルダ内のCTフォルダ）
+        case_path = os.path.join(dataset_folder, case)
+        if not os.path.isdir(case_path):
+            return [case_path]
+        return [os.path.join(case_path, ct) for ct in sorted(os.listdir(case_path))
+                if os.path.isdir(os.path.join(case_path, ct))]
+
+    def convert(case):
+        target_file = nifti_cache_path(work_dir, case, series)
+        if os.path.exists(target_file):
+            os.remove(target_file)
+        os.makedirs(nifti_dir, exist_ok=True)
+        status, message, _ = convert_case(case, os.path.join(dataset_folder, case, series), nifti_dir, series)
+        if status == 'failed':
+            raise RuntimeError(message)
+
+    def segment(case, names):
+        # モデルは最初に必要になったときに1回だけ読み込み，以降のケースで使い回す
+        if not segmenters:
+            segmenters.append(GroupSegmenter(segment_fn))
+
+        organ_names = [name.split(':', 1)[1] for name in names]
+        rois = {organ_name: rois for organ_name, rois, _ in region_config.values()}
+        masks, affine = segmenters[0].segment_groups(nifti_cache_path(work_dir, case, series),
+                                                     [(organ_name, rois[organ_name]) for organ_name in organ_names])
+        statuses = {}
+        for organ_name in organ_names:
+            mask_file = mask_cache_path(work_dir, organ_name, case)
+            if masks[organ_name] is None or not masks[organ_name].any():
+                # 臓器が見つからないグループはマスクを保存せず，他のグループの処理は続ける
+                # （splitではマスクがない領域として扱う）
+                print(f"{case}: No labels found for {organ_name}: {rois[organ_name]}")
+                if os.path.exists(mask_file):
+                    os.remove(mask_file)
+                statuses[f'segment:{organ_name}'] = 'empty'
+                continue
+            os.makedirs(os.path.dirname(mask_file), exist_ok=True)
+            save_mask(masks[organ_name], affine, mask_file)
+            if volume_cache is not None:
+                store_volume(mask_file, masks[organ_name], affine, volume_cache)
+        return statuses
+
+    def split(region):
+        def run(case):
+            occupancies, affines = [], {}
+            for other in order:
+                mask_file = mask_cache_path(work_dir, region_config[other][0], case)
+                if not os.path.exists(mask_file):
+                    # 臓器が見つからなかった領域 (segmentの状態が 'empty')
+                    occupancies.append(None)
+                    continue
+                occupancy, _, affines[other] = load_mask_extent(mask_file, volume_cache)
+                occupancies.append(occupancy)
+            # マスクは同じボリュームから作るため，自分のマスクがない場合は上下の領域のaffineを使う
+            affine = affines.get(region, next(iter(affines.values()), None))
+
+            intervals, n_slices = plan_from_occupancies(occupancies, margin,
+                                                        [region_config[other][2] for other in order], extend_bottom)
+            interval = intervals[order.index(region)]
+
+            dst_case_path = os.path.join(output_dirs[region], case)
+            if os.path.exists(dst_case_path):
+                shutil.rmtree(dst_case_path)
+            place_case_slices(case, interval_to_occupancy(interval, n_slices), dataset_folder, output_dirs[region],
+                              materialize_method=materialize_method, materialize_workers=materialize_workers,
+                              verbose=False, affine=affine)
+            os.makedirs(dst_case_path, exist_ok=True)
+        return run
+
+    def blend(case):
+        output_case_path = os.path.join(blend_output, case)
+        if os.path.exists(output_case_path):
+            shutil.rmtree(output_case_path)
+        routing = RoutingTable.load(routing_path) if routing_path is not None else None
+        blend_case(case, generated_folders, blend_output, weights, volume_cache=volume_cache, routing=routing,
+                   compression=compression)
+
+    stages = [Stage('convert', convert, params={'series': series},
+                    inputs=lambda case: [os.path.join(dataset_folder, case, series)],
+                    outputs=lambda case: [nifti_cache_path(work_dir, case, series)])]
+
+    for region, (organ_name, rois, _) in region_config.items():
+        stages.append(Stage(f'segment:{organ_name}', segment, deps=['convert'], params={'rois': sorted(rois)},
+                            outputs=lambda case, organ_name=organ_name: [mask_cache_path(work_dir, organ_name, case)],
+                            batch='segment'))
+
+    for region in order:
+        stages.append(Stage(f'split:{region}', split(region),
+                            deps=[f'segment:{region_config[other][0]}' for other in order],
+                            params={'regions': [[other, region_config[other][2]] for other in order],
+                                    'margin': margin, 'extend_bottom': extend_bottom},
+                            inputs=series_dirs,
+                            outputs=lambda case, region=region: [os.path.join(output_dirs[region], case)]))
+
+    if generated_folders:
+        stages.append(Stage('blend', blend, params={'weights': weights, 'compression': compression},
+                            inputs=lambda case: [os.path.join(folder, case, 'dicom') for folder in generated_folders]
+                                                + ([routing_path] if routing_path is not None else []),
+                            outputs=lambda case: [os.path.join(blend_output, case)]))
+
+    return BuildGraph(stages, state_path or os.path.join(work_dir, STATE_FILENAME))
+
+
+if __name__ == "__main__":
+    dataset_folder = '~/dataset'
+
+    # 呼び出し例（変更のあったケース・ステージだけを再実行）
+    graph = build_pipeline_graph(
+        dataset_folder=dataset_folder,
+        work_dir='~/totalSegmentator',
+        output_base='~/',
+        generated_folders=['~/test_gene_upper', '~/test_gene_middle', '~/test_gene_lower'],
+        blend_output='~/test_gene'
+    )
+    graph.run(sorted(case for case in os.listdir(dataset_folder) if os.path.isdir(os.path.join(dataset_folder, case))))
@@ -0,0 +1,31 @@
+import os
+import pydicom
+
+'''
+DICOMファイルのヘッダのみを読み込む検証処理
+
+ピクセルデータの手前で読み込みを止め（stop_before_pixels），大きな要素は遅延読み込み（defer_size）にすることで，
+コピー前の検証でファイル全体を読まないようにする．
+I/O待ちが主なので，呼び出し側 (series_index など) はシリーズごとにスレッドプールで並列に読み込む．
+'''
+
+# 検証に使うスレッド数の上限
+DEFAULT_VALIDATION_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+# このサイズを超える要素は実際にアクセスされるまで読み込まない
+DEFER_SIZE = '1 KB'
+
+
+def read_dicom_header(file_path):
+    """
+    DICOMファイルのヘッダのみを読み込む
+
+    Returns:
+    pydicom.Dataset: ピクセルデータを含まないデータセット．読み込めない場合はNone
+    """
+    try:
+        return pydicom.dcmread(file_path, stop_before_pixels=True, defer_size=DEFER_SIZE)
+    except Exception as e:
+        print(f"Error reading DICOM file {file_path}: {e}")
+        return None
+
@@ -0,0 +1,222 @@
+import os
+import json
+import base64
+import numpy as np
+from mask_extent import occupancy_to_z_range
+from volume_cache import load_mask_extent
+import script_paths  # noqa: F401
+from file_io import file_digest, write_json
+
+'''
+臓器データセットごとのz範囲インデックス（サイドカーファイル）
+
+totalSegmentator/organSeg/dataset_* フォルダごとに1つのJSONファイルを置き，
+各マスクのz範囲，スライスごとの占有ビットマップ，shape，affineを記録する．
+エントリはパス・ファイルサイズ・更新時刻・内容のハッシュで照合し，
+変更されたマスクだけを再計算する．
+（volume_cacheを指定した場合は，再計算時にマスクをvolume_cacheのメモリマップから読み込む）
+
+マスクを保存せずにz範囲のみを求めた場合 (extents.py) は，
+record_extent で「z範囲のみのエントリ」(extents_only) を記録する．マスクファイルがなくても
+このエントリのz範囲・shape・affineを利用する．
+'''
+
+INDEX_FILENAME = 'extent_index.json'
+INDEX_VERSION = 1
+
+
+def _encode_occupancy(occupancy):
+    return base64.b64encode(np.packbits(occupancy).tobytes()).decode('ascii')
+
+
+def _decode_occupancy(encoded, n_slices):
+    packed = np.frombuffer(base64.b64decode(encoded), dtype=np.uint8)
+    return np.unpackbits(packed, count=n_slices).astype(bool)
+
+
+def mask_available(nifti_file, extent_index=None):
+    """
+    マスクファイルがあるか（extent_indexを指定した場合はz範囲のみのエントリも含める）
+    """
+    if extent_index is not None:
+        return extent_index.has_mask(nifti_file)
+    return os.path.exists(nifti_file)
+
+
+class ExtentIndex:
+    """
+    臓器データセットフォルダ1つ分のz範囲インデックス
+
+    Parameters:
+    nifti_dir (str): 臓器セグメンテーションのデータセットフォルダ (例: organSeg/dataset_kidney)
+    index_path (str): インデックスファイルのパス．Noneの場合は nifti_dir/extent_index.json
+    load (bool): Falseの場合はインデックスファイルを読み込まない（空のインデックス）
+    volume_cache (str): 指定した場合はマスクをキャッシュ (volume_cache) から読み込む
+    """
+
+    def __init__(self, nifti_dir, index_path=None, load=True, volume_cache=None):
+        self.nifti_dir = nifti_dir
+        self.index_path = index_path or os.path.join(nifti_dir, INDEX_FILENAME)
+        self.volume_cache = volume_cache
+        self.entries = {}
+        # このインスタンスで追加・更新したエントリ（プロセス間でのマージに使う）
+        self.updated = {}
+
+        if load and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == INDEX_VERSION:
+                    self.entries = data.get('entries', {})
+            except (OSError, ValueError) as e:
+                # 壊れたインデックスは作り直す
+                print(f"Failed to read extent index {self.index_path}: {e}")
+
+    @property
+    def dirty(self):
+        return bool(self.updated)
+
+    def _set(self, key, entry):
+        self.entries[key] = entry
+        self.updated[key] = entry
+
+    def _key(self, nifti_file):
+        return os.path.relpath(os.path.abspath(nifti_file), os.path.abspath(self.nifti_dir))
+
+    def _lookup(self, nifti_file):
+        key = self._key(nifti_file)
+        entry = self.entries.get(key)
+        if entry is not None and entry.get('extents_only') and not os.path.exists(nifti_file):
+            return entry
+        stat = os.stat(nifti_file)
+
+        digest = None
+        if entry is not None and entry.get('size') == stat.st_size:
+            # サイズと更新時刻が一致すればハッシュ計算なしで利用
+            if entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry
+
+            # 更新時刻だけが変わった場合（コピーやtouch）は内容のハッシュで照合
+            digest = file_digest(nifti_file)
+            if entry['sha256'] == digest:
+                entry = dict(entry, mtime_ns=stat.st_mtime_ns)
+                self._set(key, entry)
+                return entry
+
+        # 新規または変更されたマスクのみ再計算
+        occupancy, shape, affine = load_mask_extent(nifti_file, self.volume_cache)
+        z_range = occupancy_to_z_range(occupancy)
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': digest or file_digest(nifti_file),
+            'shape': [int(n) for n in shape],
+            'affine': np.asarray(affine).tolist(),
+            'z_range': list(z_range) if z_range is not None else None,
+            'n_slices': int(occupancy.size),
+            'occupancy': _encode_occupancy(occupancy),
+        }
+        self._set(key, entry)
+        return entry
+
+    def has_mask(self, nifti_file):
+        """
+        マスクファイル，またはz範囲のみのエントリがあるか
+        """
+        if os.path.exists(nifti_file):
+            return True
+        entry = self.entries.get(self._key(nifti_file))
+        return entry is not None and bool(entry.get('extents_only'))
+
+    def extents_only_folders(self):
+        """
+        z範囲のみのエントリがあるケースフォルダ名の集合
+        """
+        return {os.path.dirname(key) for key, entry in self.entries.items()
+                if entry.get('extents_only') and os.path.dirname(key)}
+
+    def record_extent(self, nifti_file, z_range, shape, affine, **details):
+        """
+        マスクを保存せずに求めたz範囲を記録する（nifti_fileはマスクを保存した場合のパス）
+
+        Parameters:
+        nifti_file (str): マスクのパス（ファイルは存在しなくてよい）
+        z_range (tuple): 元の解像度でのzインデックスの範囲 (z_min, z_max)．臓器が見つからない場合はNone
+        shape (tuple): 元のボリュームのshape
+        affine (numpy.ndarray): 元のボリュームのaffine
+        details: その他に記録する値（縮小率，マージンなど）
+        """
+        n_slices = int(shape[2])
+        occupancy = np.zeros(n_slices, dtype=bool)
+        if z_range is not None:
+            occupancy[z_range[0]:z_range[1] + 1] = True
+        entry = {
+            'extents_only': True,
+            'shape': [int(n) for n in shape],
+            'affine': np.asarray(affine).tolist(),
+            'z_range': [int(z) for z in z_range] if z_range is not None else None,
+            'n_slices': n_slices,
+            'occupancy': _encode_occupancy(occupancy),
+        }
+        entry.update(details)
+        self._set(self._key(nifti_file), entry)
+        return entry
+
+    def get_slice_occupancy(self, nifti_file):
+        """
+        スライスごとのセグメンテーションの有無（bool配列）を返す
+        """
+        entry = self._lookup(nifti_file)
+        return _decode_occupancy(entry['occupancy'], entry['n_slices'])
+
+    def get_z_range(self, nifti_file):
+        """
+        セグメンテーションが存在するzインデックスの範囲 (z_min, z_max) を返す．存在しない場合はNone
+        """
+        z_range = self._lookup(nifti_file)['z_range']
+        return tuple(z_range) if z_range is not None else None
+
+    def get_geometry(self, nifti_file):
+        """
+        マスクのshapeとaffineを返す
+        """
+        entry = self._lookup(nifti_file)
+        return tuple(entry['shape']), np.array(entry['affine'])
+
+    def subset(self, nifti_files):
+        """
+        指定したマスクのエントリだけを持つインデックスを返す（ワーカープロセスへ渡す用）
+        """
+        index = ExtentIndex(self.nifti_dir, self.index_path, load=False, volume_cache=self.volume_cache)
+        for nifti_file in nifti_files:
+            key = self._key(nifti_file)
+            if key in self.entries:
+                index.entries[key] = self.entries[key]
+        return index
+
+    def merge(self, updated_entries):
+        """
+        ワーカープロセスで更新されたエントリを取り込む
+        """
+        for key, entry in updated_entries.items():
+            if entry is None:
+                self.entries.pop(key, None)
+                self.updated[key] = None
+            else:
+                self._set(key, entry)
+
+    def prune(self):
+        # 存在しなくなったマスクのエントリを削除（z範囲のみのエントリは残す）
+        for key in list(self.entries):
+            if self.entries[key].get('extents_only'):
+                continue
+            if not os.path.exists(os.path.join(self.nifti_dir, key)):
+                del self.entries[key]
+                self.updated[key] = None
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        write_json(self.index_path, {'version': INDEX_VERSION, 'entries': self.entries})
+        self.updated = {}
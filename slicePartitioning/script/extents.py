@@ -0,0 +1,203 @@
+import os
+import tempfile
+import numpy as np
+import nibabel as nib
+from extent_index import ExtentIndex
+import script_paths  # noqa: F401
+# 以下は totalSegmentator/script と common/ のモジュール
+from segmenter import GroupSegmenter
+from case_runner import new_case_result, summarize_results
+from instrumentation import measure_stage, ProgressReporter, file_size
+
+'''
+臓器のz範囲のみを求めるモード（GPUのないCPUノード向け）
+
+領域分割に必要なのは各臓器の最上部・最下部のスライスのみだが，totalseg.pyは元の解像度で推論して
+マスク全体を保存する．本モジュールは totalseg.py の代わりに実行し（slicePartitioning/script から
+python extents.py），
+1. ボリュームを target_spacing (mm) 程度に間引いて縮小し（TotalSegmentatorは高速モデル），
+   必要な臓器 (roi_subset) のみを1回で推論する
+2. 縮小したボリュームでのz範囲を元の解像度のzインデックスに戻し，safety marginを加える
+   （間引きで見落とす可能性のある縮小率分のスライスも含める）
+3. マスクは保存せず，臓器データセットのz範囲インデックス (extent_index.json) に
+   z範囲のみのエントリを記録する（slicepartitioning.py などはこのエントリを使って分割する）
+'''
+
+# 縮小後のボクセルサイズ（mm）．TotalSegmentatorの高速モデルと同じ3mm
+DEFAULT_TARGET_SPACING = 3.0
+
+# 元の解像度のz範囲の上下に加えるスライス数
+DEFAULT_EXTENT_MARGIN = 2
+
+
+def extents_segmenter(segment_fn=None, device='cpu', fast=True):
+    """
+    z範囲を求めるためのセグメンテーション（Noneの場合はTotalSegmentatorの高速モデルをCPUで実行）
+    """
+    if segment_fn is not None:
+        return GroupSegmenter(segment_fn)
+    return GroupSegmenter(device=device, fast=fast)
+
+
+def downsample_volume(img, target_spacing=DEFAULT_TARGET_SPACING):
+    """
+    ボリュームを各軸のボクセルサイズが target_spacing 程度になるよう間引く（affineも合わせて更新）
+
+    Returns:
+    (nibabel image, tuple): 縮小した画像と各軸の縮小率
+    """
+    zooms = img.header.get_zooms()[:3]
+    factors = tuple(max(1, int(round(target_spacing / zoom))) if zoom > 0 else 1 for zoom in zooms)
+    if factors == (1, 1, 1):
+        return img, factors
+    return img.slicer[::factors[0], ::factors[1], ::factors[2]], factors
+
+
+def native_z_range(z_range, seg_affine, native_affine, n_slices, margin=DEFAULT_EXTENT_MARGIN):
+    """
+    縮小したボリュームのz範囲を元のボリュームのzインデックスの範囲に戻す
+
+    Parameters:
+    z_range (tuple): 縮小したボリュームでのzインデックスの範囲 (z_min, z_max)
+    seg_affine (numpy.ndarray): 縮小したボリュームのaffine
+    native_affine (numpy.ndarray): 元のボリュームのaffine
+    n_slices (int): 元のボリュームのスライス数
+    margin (int): 上下に加えるスライス数
+
+    Returns:
+    tuple: 元のボリュームでのzインデックスの範囲 (z_min, z_max)
+    """
+    to_native = np.linalg.inv(native_affine) @ seg_affine
+    ends = [(to_native @ np.array([0.0, 0.0, float(k), 1.0]))[2] for k in z_range]
+    # 縮小したボクセル1つが元のスライス何枚分か（間引いた間のスライスも含める）
+    scale = np.linalg.norm(seg_affine[:3, 2]) / np.linalg.norm(native_affine[:3, 2])
+    spread = max(scale - 1.0, 0.0)
+    z_min = int(np.floor(min(ends) - spread)) - margin
+    z_max = int(np.ceil(max(ends) + spread)) + margin
+    return max(z_min, 0), min(z_max, n_slices - 1)
+
+
+def segment_extents(input_file, mask_groups, segmenter, target_spacing=DEFAULT_TARGET_SPACING,
+                    margin=DEFAULT_EXTENT_MARGIN):
+    """
+    縮小したボリュームで1回だけ推論し，臓器グループごとの元の解像度でのz範囲を求める
+
+    Parameters:
+    input_file (str): 入力のNIfTIファイル
+    mask_groups (list): [(グループ名, [臓器名, ...]), ...]
+    segmenter (GroupSegmenter): ケース間でモデルを保持するセグメンテーション
+    target_spacing (float): 縮小後のボクセルサイズ (mm)．Noneの場合は縮小しない
+    margin (int): 元の解像度のz範囲の上下に加えるスライス数
+
+    Returns:
+    (dict, nibabel image, tuple): {グループ名: (z_min, z_max) (見つからない場合はNone)}，元の画像，縮小率
+    """
+    img = nib.load(input_file)
+    if target_spacing is None:
+        small_img, factors = img, (1, 1, 1)
+    else:
+        small_img, factors = downsample_volume(img, target_spacing)
+
+    roi_subset = sorted({mask for _, masks in mask_groups for mask in masks})
+    if small_img is img:
+        seg_img, label_ids = segmenter.segment(input_file, roi_subset)
+    else:
+        # 縮小したボリュームは圧縮せずに一時ファイルとして渡す
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            small_file = os.path.join(tmp_dir, os.path.basename(input_file)[:-7] + '.nii')
+            nib.save(small_img, small_file)
+            seg_img, label_ids = segmenter.segment(small_file, roi_subset)
+    labels = np.asanyarray(seg_img.dataobj)
+
+    z_ranges = {}
+    for group_name, masks in mask_groups:
+        ids = [label_ids[mask] for mask in masks if mask in label_ids]
+        occupied = np.flatnonzero(np.isin(labels, ids).any(axis=(0, 1))) if ids else []
+        if len(occupied) == 0:
+            z_ranges[group_name] = None
+            continue
+        z_ranges[group_name] = native_z_range((int(occupied[0]), int(occupied[-1])), seg_img.affine, img.affine,
+                                              img.shape[2], margin)
+    return z_ranges, img, factors
+
+
+def process_case_extents(input_file, mask_groups, segmenter, indexes, target_spacing=DEFAULT_TARGET_SPACING,
+                         margin=DEFAULT_EXTENT_MARGIN):
+    """
+    1ケース分の臓器グループごとのz範囲を求め，z範囲インデックスに記録する（マスクは保存しない）
+
+    Parameters:
+    input_file (str): 入力のNIfTIファイル
+    mask_groups (list): [(出力フォルダ, [臓器名, ...], 結合マスクのファイル名), ...] (totalseg.MASK_GROUPSと同じ)
+    segmenter (GroupSegmenter): ケース間でモデルを保持するセグメンテーション
+    indexes (dict): {出力フォルダ: ExtentIndex}
+    target_spacing (float): 縮小後のボクセルサイズ (mm)
+    margin (int): 元の解像度のz範囲の上下に加えるスライス数
+
+    Returns:
+    dict: {結合マスクのファイル名: (z_min, z_max) または None}
+    """
+    patient_id = os.path.basename(input_file)[:-7]  # '.nii.gz'を除外
+    z_ranges, img, factors = segment_extents(
+        input_file, [(combined_filename, masks) for _, masks, combined_filename in mask_groups],
+        segmenter, target_spacing, margin)
+
+    for output_folder, masks, combined_filename in mask_groups:
+        z_range = z_ranges[combined_filename]
+        if z_range is None:
+            print(f"マスクが見つかりません: {combined_filename} {masks}")
+            continue
+        # totalseg.pyで結合マスクを保存する場合と同じパスで記録
+        mask_path = os.path.join(output_folder, patient_id,
+                                 f"{combined_filename}_{os.path.basename(input_file)[-19:]}")
+        indexes[output_folder].record_extent(mask_path, z_range, img.shape, img.affine,
+                                             downsample=list(factors), margin=margin,
+                                             source=os.path.abspath(input_file))
+    return z_ranges
+
+
+def main(inputfol, mask_groups, segment_fn=None, target_spacing=DEFAULT_TARGET_SPACING,
+         margin=DEFAULT_EXTENT_MARGIN, metrics=None):
+    """
+    inputfol: 変換したNIfTIファイルのフォルダ
+    mask_groups: [(出力フォルダ, [臓器名, ...], 結合マスクのファイル名), ...] (totalseg.MASK_GROUPSと同じ)
+    segment_fn: セグメンテーションの関数（Noneの場合はTotalSegmentatorの高速モデルをCPUで実行）
+    target_spacing: 縮小後のボクセルサイズ (mm)
+    margin: 元の解像度のz範囲の上下に加えるスライス数
+    metrics: 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    """
+    segmenter = extents_segmenter(segment_fn)
+    indexes = {output_folder: ExtentIndex(output_folder) for output_folder, _, _ in mask_groups}
+    for output_folder in indexes:
+        os.makedirs(output_folder, exist_ok=True)
+
+    filenames = [filename for filename in sorted(os.listdir(inputfol)) if filename.endswith('.nii.gz')]
+    progress = ProgressReporter('extents', len(filenames))
+    results = []
+    for filename in filenames:
+        input_file = os.path.join(inputfol, filename)
+        result = new_case_result(filename[:-7])
+        with measure_stage(result, 'extents') as stage_metrics:
+            stage_metrics.read(file_size(input_file))
+            z_ranges = process_case_extents(input_file, mask_groups, segmenter, indexes, target_spacing, margin)
+            result['files'] = sum(z_range is not None for z_range in z_ranges.values())
+        # 途中で止まっても処理済みのケースは残す
+        for index in indexes.values():
+            index.save()
+        results.append(result)
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+    progress.close()
+    return summarize_results(results, 'extents')
+
+
+if __name__ == "__main__":
+    # totalseg.pyと同じ入力フォルダ・臓器グループで，z範囲のみを extent_index.json に記録する
+    from totalseg import INPUT_FOLDER, MASK_GROUPS
+    main(INPUT_FOLDER, MASK_GROUPS, target_spacing=3.0, margin=2)
+
+    # ケースごとの処理時間・読み書きしたバイト数を記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     main(INPUT_FOLDER, MASK_GROUPS, metrics=metrics)
@@ -0,0 +1,185 @@
+import os
+import json
+import numpy as np
+import script_paths  # noqa: F401
+from file_io import atomic_write
+
+'''
+分割データセットのマニフェスト（仮想的な領域分割）
+
+upper/middle/lowerのフォルダにDICOMファイルを配置する代わりに，
+1スライス1行で「ケース・シリーズ・ファイル名・元ファイルのパス・zインデックス・領域ラベル・重複フラグ」を記録する．
+出力形式は拡張子で切り替える（.parquet: pyarrow，それ以外: JSON lines）．
+
+使用例:
+manifest = ManifestWriter('~/dataset_manifest.parquet')
+copy_slices_up_to_segmentation(..., manifest=manifest)
+manifest.close()
+
+for row in iter_region('~/dataset_manifest.parquet', 'upper'):
+    print(row['source_path'])
+'''
+
+MANIFEST_COLUMNS = ('case', 'series', 'file_name', 'source_path', 'z_index', 'regions', 'overlap')
+
+# Parquetを読み込む際の1バッチあたりの行数
+READ_BATCH_SIZE = 65536
+
+
+def region_label(folder):
+    """
+    出力フォルダ名から領域ラベルを求める (例: '~/dataset_upper' -> 'upper')
+    """
+    return os.path.basename(os.path.normpath(folder)).rsplit('_', 1)[-1]
+
+
+def _is_parquet(manifest_path):
+    return manifest_path.endswith('.parquet')
+
+
+class ManifestWriter:
+    """
+    分割結果をマニフェストとして記録する
+
+    Parameters:
+    manifest_path (str): 出力ファイルのパス（.parquet の場合はParquet，それ以外はJSON lines）
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        # (case, series) -> {file_name: 行}
+        self.series = {}
+
+    def add(self, case, series, file_name, source_path, z_index, region):
+        """
+        スライスを領域に追加する（同じスライスが複数の領域に追加された場合は重複領域として記録）
+        """
+        series_rows = self.series.setdefault((case, series), {})
+        row = series_rows.get(file_name)
+        if row is None:
+            row = {
+                'case': case,
+                'series': series,
+                'file_name': file_name,
+                'source_path': source_path,
+                'z_index': None if z_index is None else int(z_index),
+                'regions': [],
+            }
+            series_rows[file_name] = row
+        if region not in row['regions']:
+            row['regions'].append(region)
+
+    def files_in_region(self, case, series, region):
+        """
+        ケース・シリーズ内で指定した領域に含まれるファイル名の集合を返す
+        """
+        series_rows = self.series.get((case, series), {})
+        return {file_name for file_name, row in series_rows.items() if region in row['regions']}
+
+    def cases(self):
+        return sorted({case for case, _ in self.series})
+
+    def z_index_of(self, case, series, file_name, series_index):
+        """
+        ファイルに対応するzインデックスを求める（求められない場合はNone）
+
+        記録済みの2スライスの患者座標zとzインデックスからマスクのaffineのz成分を復元し，
+        シリーズのジオメトリインデックス (series_index.SeriesIndex.z_index_of) で変換する．
+        ファイル名の命名規則には依存しない．
+
+        Parameters:
+        case (str): ケース名
+        series (str): シリーズ名
+        file_name (str): ファイル名
+        series_index (SeriesIndex): 元のシリーズのインデックス (series_index.load_series_index)
+        """
+        located = []
+        for row in self.series.get((case, series), {}).values():
+            entry = series_index.by_name.get(row['file_name'])
+            if row['z_index'] is not None and entry is not None and entry['z'] is not None:
+                located.append((entry['z'], row['z_index']))
+
+        for z, z_index in located[1:]:
+            if z_index != located[0][1]:
+                affine = np.eye(4)
+                affine[2, 2] = (z - located[0][0]) / (z_index - located[0][1])
+                affine[2, 3] = located[0][0] - affine[2, 2] * located[0][1]
+                return series_index.z_index_of(file_name, affine)
+        return series_index.z_index_of(file_name, None, len(series_index.file_names))
+
+    def __len__(self):
+        return sum(len(series_rows) for series_rows in self.series.values())
+
+    def rows(self):
+        """
+        記録した行をケース・シリーズ・ファイル名の順に返す（保存するマニフェストの行と同じ形式）
+        """
+        for key in sorted(self.series):
+            series_rows = self.series[key]
+            for file_name in sorted(series_rows):
+                row = series_rows[file_name]
+                yield dict(row, regions=sorted(row['regions']), overlap=len(row['regions']) > 1)
+
+    def close(self):
+        if _is_parquet(self.manifest_path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            rows = list(self.rows())
+            table = pa.table({column: [row[column] for row in rows] for column in MANIFEST_COLUMNS},
+                             schema=pa.schema([
+                                 ('case', pa.string()),
+                                 ('series', pa.string()),
+                                 ('file_name', pa.string()),
+                                 ('source_path', pa.string()),
+                                 ('z_index', pa.int32()),
+                                 ('regions', pa.list_(pa.string())),
+                                 ('overlap', pa.bool_()),
+                             ]))
+            with atomic_write(self.manifest_path, 'wb') as f:
+                pq.write_table(table, f)
+        else:
+            with atomic_write(self.manifest_path) as f:
+                for row in self.rows():
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+        print(f"Manifest saved: {self.manifest_path} ({len(self)} slices)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def read_manifest(manifest_path):
+    """
+    マニフェストの行を1行ずつ読み込むジェネレータ
+    """
+    if _is_parquet(manifest_path):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(manifest_path)
+        for batch in parquet_file.iter_batches(batch_size=READ_BATCH_SIZE):
+            yield from batch.to_pylist()
+    else:
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_region(manifest_path, region, case=None):
+    """
+    指定した領域に含まれるスライスを遅延的に読み込むジェネレータ
+
+    Parameters:
+    manifest_path (str): マニフェストのパス
+    region (str): 領域ラベル ('upper', 'middle', 'lower' など)
+    case (str): 指定した場合はそのケースのみ
+    """
+    for row in read_manifest(manifest_path):
+        if region in row['regions'] and (case is None or row['case'] == case):
+            yield row
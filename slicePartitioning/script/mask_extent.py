@@ -0,0 +1,90 @@
+import numpy as np
+import nibabel as nib
+
+'''
+セグメンテーションマスクのz方向の範囲を求める共通モジュール
+
+get_fdata()でfloat64の全ボリュームを展開せず，nibabelのdataobj(プロキシ)から
+ネイティブのdtype(uint8など)のままz方向のスラブ単位で読み込み，
+スライスごとの占有(any)をベクトル演算で求める．
+'''
+
+# 一度に読み込むzスライス数（512x512x64のuint8で約16MB）
+DEFAULT_SLAB_SIZE = 64
+
+
+def _load_image(nifti_file):
+    # パスが渡された場合はファイルを開いたままにして，スラブ読み込みのたびにgzipを先頭から展開しないようにする
+    if isinstance(nifti_file, (str, bytes)) or hasattr(nifti_file, '__fspath__'):
+        return nib.load(nifti_file, keep_file_open=True)
+    return nifti_file
+
+
+def iter_mask_slabs(nifti_file, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    マスクをz方向のスラブ単位で読み込むジェネレータ
+
+    Parameters:
+    nifti_file (str or nibabel image): NIfTIファイルのパス，または読み込み済みのimage
+    slab_size (int): 一度に読み込むzスライス数
+
+    Yields:
+    (z0, slab): スラブ先頭のzインデックスと，ネイティブdtypeの配列 (x, y, z0:z0+slab_size, ...)
+    """
+    img = _load_image(nifti_file)
+    dataobj = img.dataobj
+    n_slices = img.shape[2]
+
+    for z0 in range(0, n_slices, slab_size):
+        z1 = min(z0 + slab_size, n_slices)
+        # プロキシをスライスすると該当範囲だけが読み込まれる（スケーリングがなければ元のdtypeのまま）
+        yield z0, np.asanyarray(dataobj[:, :, z0:z1, ...])
+
+
+def get_slice_occupancy(nifti_file, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    スライスごとのセグメンテーションの有無を求める
+
+    Parameters:
+    nifti_file (str or nibabel image): NIfTIファイルのパス，または読み込み済みのimage
+    slab_size (int): 一度に読み込むzスライス数
+
+    Returns:
+    numpy.ndarray: 長さがzスライス数のbool配列（Trueのスライスにセグメンテーションが存在）
+    """
+    img = _load_image(nifti_file)
+    occupancy = np.zeros(img.shape[2], dtype=bool)
+
+    for z0, slab in iter_mask_slabs(img, slab_size):
+        # z以外の軸でanyを取り，スラブ内の全スライスの占有を一度に求める
+        axes = tuple(axis for axis in range(slab.ndim) if axis != 2)
+        occupancy[z0:z0 + slab.shape[2]] = slab.any(axis=axes)
+
+    return occupancy
+
+
+def occupancy_to_z_range(occupancy):
+    """
+    占有配列から最初と最後のzインデックスを求める
+
+    Returns:
+    tuple or None: (z_min, z_max)．セグメンテーションが存在しない場合はNone
+    """
+    occupied = np.flatnonzero(occupancy)
+    if occupied.size == 0:
+        return None
+    return int(occupied[0]), int(occupied[-1])
+
+
+def get_z_range(nifti_file, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    セグメンテーションが存在するzインデックスの範囲を求める
+
+    Parameters:
+    nifti_file (str or nibabel image): NIfTIファイルのパス，または読み込み済みのimage
+    slab_size (int): 一度に読み込むzスライス数
+
+    Returns:
+    tuple or None: (z_min, z_max)．セグメンテーションが存在しない場合はNone
+    """
+    return occupancy_to_z_range(get_slice_occupancy(nifti_file, slab_size))
@@ -0,0 +1,201 @@
+import os
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+'''
+分割データセット(dataset_upper/middle/lower)へのファイル配置方法を切り替えるモジュール
+
+method:
+    'copy'     : copy_file_range / sendfile によるコピー（max_workers > 1 の場合はスレッドプールで並列化）
+    'hardlink' : ハードリンク（同一ファイルシステム内のみ）
+    'reflink'  : copy-on-writeのクローン（btrfs, XFS など対応するファイルシステムのみ）
+    'symlink'  : 相対パスのシンボリックリンク
+
+hardlink / reflink / symlink が使えない場合は自動的に 'copy' にフォールバックする．
+'''
+
+MATERIALIZE_METHODS = ('copy', 'hardlink', 'reflink', 'symlink')
+
+# 並列コピーのスレッド数とバッチサイズ
+DEFAULT_MATERIALIZE_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+DEFAULT_BATCH_SIZE = 64
+
+# linux/fs.h の FICLONE
+FICLONE = 0x40049409
+
+# この errno の場合はファイルシステムが非対応とみなしてコピーにフォールバック
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EMLINK,
+                       errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.ENOSYS}
+
+
+def copy_file(src, dst):
+    # カーネル内でコピーする（copy_file_rangeが使えない場合はshutil.copyfile(sendfile)を使う）
+    # コピーしたバイト数を返す
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                size = remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            shutil.copymode(src, dst)
+            return size - remaining
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+    shutil.copy(src, dst)
+    return os.path.getsize(dst)
+
+
+def reflink_file(src, dst):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copymode(src, dst)
+
+
+def hardlink_file(src, dst):
+    os.link(src, dst)
+
+
+def symlink_file(src, dst):
+    os.symlink(os.path.relpath(os.path.abspath(src), os.path.dirname(os.path.abspath(dst))), dst)
+
+
+_METHOD_FUNCS = {
+    'copy': copy_file,
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+    'symlink': symlink_file,
+}
+
+
+class Materializer:
+    """
+    ファイルを分割データセットへ配置する
+
+    Parameters:
+    method (str): 'copy', 'hardlink', 'reflink', 'symlink' のいずれか
+    max_workers (int): 並列に処理するスレッド数．1以下の場合は呼び出し時に逐次処理
+    batch_size (int): スレッドプールへ投入する1回あたりのファイル数
+
+    files_placed, files_copied, bytes_copied: 配置したファイル数，そのうちコピーしたファイル数とバイト数
+    （計測用．スレッドプールを使う場合は wait() の後に参照する）
+
+    使用例:
+    with Materializer('hardlink') as materializer:
+        materializer.submit(src_path, dst_path)
+    """
+
+    def __init__(self, method='copy', max_workers=DEFAULT_MATERIALIZE_WORKERS, batch_size=DEFAULT_BATCH_SIZE):
+        if method not in MATERIALIZE_METHODS:
+            raise ValueError(f"method must be one of {MATERIALIZE_METHODS}: {method}")
+        self.method = method
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.fallback = False
+        self.files_placed = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self._lock = threading.Lock()
+        self._batch = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers and max_workers > 1 else None
+
+    def _place(self, src, dst):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+
+        # 既存のファイル・リンクは置き換える（shutil.copyと同じく上書き）
+        # リンク先に書き込んで元ファイルを壊さないよう，上書きせず削除してから配置する
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        if self.method != 'copy' and not self.fallback:
+            try:
+                try:
+                    _METHOD_FUNCS[self.method](src, dst)
+                except FileExistsError:
+                    # 同じ配置先が並列に処理された場合は置き換える
+                    os.remove(dst)
+                    _METHOD_FUNCS[self.method](src, dst)
+                self._count(None)
+                return dst
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                # 非対応の場合は以降すべてコピーにする
+                if not self.fallback:
+                    self.fallback = True
+                    print(f"{self.method} is not supported for {dst} ({e}); falling back to copy")
+
+        self._count(copy_file(src, dst))
+        return dst
+
+    def _count(self, copied_bytes):
+        with self._lock:
+            self.files_placed += 1
+            if copied_bytes is not None:
+                self.files_copied += 1
+                self.bytes_copied += copied_bytes
+
+    def _place_batch(self, batch):
+        return [self._place(src, dst) for src, dst in batch]
+
+    def submit(self, src, dst):
+        """
+        srcをdstへ配置する（dstがフォルダの場合はその中に同名で配置）
+        """
+        if self._executor is None:
+            return self._place(src, dst)
+
+        self._batch.append((src, dst))
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        return dst
+
+    def _flush_batch(self):
+        if self._batch:
+            self._futures.append(self._executor.submit(self._place_batch, self._batch))
+            self._batch = []
+
+    def wait(self):
+        """
+        投入済みの処理の完了を待つ．失敗した処理があれば例外を送出する
+        """
+        if self._executor is None:
+            return
+        self._flush_batch()
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
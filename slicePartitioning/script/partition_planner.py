@@ -0,0 +1,100 @@
+import numpy as np
+from mask_extent import occupancy_to_z_range
+
+'''
+臓器のz範囲からN個の領域のz区間を求めるプランナー
+
+領域は上から順に並べる (例: upper, middle, lower)．NIfTIのzインデックスは大きいほど上
+（00000001.DCMが最大のzインデックス）．
+
+1. 各領域の区間を臓器のz範囲 (z_min, z_max) とする
+   copy_allの領域は上端のスライスまで，extend_bottomの場合は最後の領域を下端のスライスまで広げる
+2. 隣り合う領域の区間が離れている場合は，間のスライスを両方の領域に加える
+   （find_and_copy_missing_filesと同じく，重複がある場合は何もしない）
+3. marginを指定した場合は，隣り合う領域の側へmarginスライスずつ広げて重複させる
+
+臓器が見つからない（z範囲がNone）領域は区間をNoneとして飛ばし，その上下で最も近い領域どうしを
+隣り合う領域として2.と3.を行う（間のスライスが抜けないようにする）．
+ファイルの配置やフォルダの一覧取得は行わないため，ケースごとに配置を1回で行える．
+'''
+
+
+def plan_intervals(extents, n_slices, margin=0, copy_all=None, extend_bottom=False):
+    """
+    Parameters:
+    extents (list): 上の領域から順に臓器のz範囲 (z_min, z_max)．臓器が見つからない領域はNone
+    n_slices (int): ボリュームのスライス数
+    margin (int): 隣り合う領域と重複させるスライス数
+    copy_all (list): 領域ごとに上端のスライスまで含めるか (copy_slices_up_to_segmentationのcopy_all)
+    extend_bottom (bool): 最後の領域を下端のスライスまで含めるか
+
+    Returns:
+    list: 領域ごとのz区間 (z_lo, z_hi)（両端を含む）．臓器が見つからない領域はNone
+    """
+    copy_all = copy_all or [False] * len(extents)
+    intervals = [list(extent) if extent is not None else None for extent in extents]
+
+    for interval, to_top in zip(intervals, copy_all):
+        if interval is not None and to_top:
+            interval[1] = n_slices - 1
+    if extend_bottom and intervals and intervals[-1] is not None:
+        intervals[-1][0] = 0
+
+    # 臓器が見つかった領域のみで，上下に隣り合う組を作る
+    found = [k for k, interval in enumerate(intervals) if interval is not None]
+    neighbours = list(zip(found[:-1], found[1:]))
+
+    # 隣り合う領域の間のスライスを両方に加える
+    base = [tuple(interval) if interval is not None else None for interval in intervals]
+    for k, j in neighbours:
+        first, second = base[k], base[j]
+        if first[0] > second[1]:
+            gap = (second[1] + 1, first[0] - 1)
+        elif second[0] > first[1]:
+            gap = (first[1] + 1, second[0] - 1)
+        else:
+            # 重複がある場合は何もしない
+            continue
+        for interval in (intervals[k], intervals[j]):
+            interval[0] = min(interval[0], gap[0])
+            interval[1] = max(interval[1], gap[1])
+
+    # 隣り合う領域の側へ広げる（上の領域は下へ，下の領域は上へ）
+    if margin:
+        extended = [list(interval) if interval is not None else None for interval in intervals]
+        for k, j in neighbours:
+            extended[k][0] = max(0, intervals[k][0] - margin)
+            extended[j][1] = min(n_slices - 1, intervals[j][1] + margin)
+        intervals = extended
+
+    return [tuple(int(z) for z in interval) if interval is not None else None for interval in intervals]
+
+
+def plan_from_occupancies(occupancies, margin=0, copy_all=None, extend_bottom=False):
+    """
+    スライスごとのセグメンテーションの有無（bool配列）から領域ごとのz区間を求める
+
+    Parameters:
+    occupancies (list): 上の領域から順にzスライスごとの有無．マスクがない領域はNone
+    その他はplan_intervalsと同じ
+
+    Returns:
+    (list, int): 領域ごとのz区間とスライス数
+    """
+    sizes = {len(occupancy) for occupancy in occupancies if occupancy is not None}
+    if len(sizes) > 1:
+        raise ValueError(f"Masks have different numbers of slices: {sorted(sizes)}")
+    n_slices = sizes.pop() if sizes else 0
+
+    extents = [occupancy_to_z_range(occupancy) if occupancy is not None else None for occupancy in occupancies]
+    return plan_intervals(extents, n_slices, margin, copy_all, extend_bottom), n_slices
+
+
+def interval_to_occupancy(interval, n_slices):
+    """
+    z区間をzスライスごとの有無（bool配列）に変換する
+    """
+    occupancy = np.zeros(n_slices, dtype=bool)
+    if interval is not None:
+        occupancy[interval[0]:interval[1] + 1] = True
+    return occupancy
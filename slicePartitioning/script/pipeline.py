@@ -0,0 +1,237 @@
+import os
+import numpy as np
+import script_paths  # noqa: F401
+from materialize import Materializer, DEFAULT_MATERIALIZE_WORKERS
+from manifest import ManifestWriter
+from case_runner import new_case_result, log_case_message, run_cases, summarize_results
+from slicepartitioning import place_case_slices
+from partition_planner import plan_from_occupancies, interval_to_occupancy
+from instrumentation import measure_stage, folder_size, ProgressReporter
+from volume_cache import store_volume
+# 以下は totalSegmentator/script のモジュール
+from segmenter import GroupSegmenter
+from mask_io import save_nifti_gz, save_mask, DEFAULT_COMPRESSLEVEL, DEFAULT_GZIP_THREADS
+
+'''
+DICOM → NIfTI変換 → セグメンテーション → 3領域分割 を1回で行うパイプライン
+
+READMEのstep1~3（dcm2nifti.py, totalseg.py, slicepartitioning.py）はディスクを介して受け渡すが，
+分割に必要なのはマスクのzスライスごとの有無だけである．
+本パイプラインでは変換したボリュームとマスクをメモリ上で次の処理に渡し，
+.nii.gzの圧縮・展開を行わずに最終的な分割結果（フォルダまたはマニフェスト）のみを出力する．
+
+cache_dirを指定した場合は，中間データをstep1~2と同じ構成で保存する（後から個別のスクリプトでも利用できる）．
+    cache_dir/dataset_nifti/{case}_CT2.nii.gz
+    cache_dir/organSeg/dataset_{臓器名}/{case}_CT2/{臓器名}_{case}_CT2.nii.gz
+'''
+
+# 上の領域から順に (領域ラベル, 臓器名, [TotalSegmentatorの臓器名], copy_all)
+## TotalSegmentatorの臓器名は以下を参照してください：https://github.com/wasserth/TotalSegmentator/blob/ff50878153342c7b4cb8ae466f7d98aadde4797d/README.md
+DEFAULT_REGIONS = [
+    ('upper', 'thyroid_gland', ['thyroid_gland'], True),
+    ('middle', 'whole_lung', ['lung_upper_lobe_right', 'lung_middle_lobe_right', 'lung_lower_lobe_right', 'lung_upper_lobe_left', 'lung_lower_lobe_left'], False),
+    ('lower', 'kidney', ['kidney_right', 'kidney_left'], False),
+]
+
+
+def convert_series_in_memory(ct_path):
+    """
+    DICOMシリーズをファイルに書き出さずにNIfTI画像へ変換する（dcm2nifti.pyと同じくreorientする）
+
+    Returns:
+    nibabel.Nifti1Image: 変換した画像
+    """
+    import dicom2nifti.convert_dicom
+
+    return dicom2nifti.convert_dicom.dicom_series_to_nifti(ct_path, None, reorient_nifti=True)['NII']
+
+
+def region_dirs(output_base, regions=DEFAULT_REGIONS):
+    """
+    領域ごとの出力フォルダ {領域ラベル: output_base/dataset_{領域ラベル}} を返す
+    """
+    return {region: os.path.join(output_base, f'dataset_{region}') for region, _, _, _ in regions}
+
+
+def nifti_cache_path(cache_dir, case, series='CT2'):
+    """
+    変換したNIfTIの保存先 (cache_dir/dataset_nifti/{case}_{series}.nii.gz)
+    """
+    return os.path.join(cache_dir, 'dataset_nifti', f'{case}_{series}.nii.gz')
+
+
+def mask_cache_path(cache_dir, organ_name, case):
+    """
+    臓器マスクの保存先 (cache_dir/organSeg/dataset_{臓器名}/{case}_CT2/{臓器名}_{case}_CT2.nii.gz)
+    """
+    return os.path.join(cache_dir, 'organSeg', f"dataset_{organ_name.replace('_', '')}", f'{case}_CT2',
+                        f'{organ_name}_{case}_CT2.nii.gz')
+
+
+def _cache_intermediates(cache_dir, case, image, masks, affine, regions, compresslevel, gzip_threads,
+                         volume_cache=None):
+    nifti_file = nifti_cache_path(cache_dir, case)
+    os.makedirs(os.path.dirname(nifti_file), exist_ok=True)
+    save_nifti_gz(image, nifti_file, compresslevel, gzip_threads)
+    # 後のステージが.nii.gzを展開し直さないよう，メモリ上の配列をそのままvolume_cacheにも保存
+    if volume_cache is not None:
+        store_volume(nifti_file, np.asanyarray(image.dataobj), image.affine, volume_cache)
+
+    for _, organ_name, _, _ in regions:
+        if masks[organ_name] is None:
+            continue
+        mask_file = mask_cache_path(cache_dir, organ_name, case)
+        os.makedirs(os.path.dirname(mask_file), exist_ok=True)
+        save_mask(masks[organ_name], affine, mask_file, compresslevel, gzip_threads)
+        if volume_cache is not None:
+            store_volume(mask_file, masks[organ_name], affine, volume_cache)
+
+
+def partition_case(case, dataset_folder, output_dirs, segmenter, regions=DEFAULT_REGIONS, series='CT2',
+                   margin=0, extend_bottom=False, cache_dir=None,
+                   materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                   record_manifest=False, compresslevel=DEFAULT_COMPRESSLEVEL, gzip_threads=DEFAULT_GZIP_THREADS,
+                   verbose=True, volume_cache=None, result=None):
+    """
+    1ケース分の変換・セグメンテーション・領域分割をメモリ上で行う
+
+    Parameters:
+    case (str): dataset_folder内のケースフォルダ名
+    output_dirs (dict): {領域ラベル: 出力フォルダ}
+    segmenter (GroupSegmenter): ケース間でモデルを保持するセグメンテーション
+    series (str): セグメンテーションに使うCTフォルダ名
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+    その他はrun_pipelineと同じ
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)
+    """
+    if result is None:
+        result = new_case_result(case)
+    ct_path = os.path.join(dataset_folder, case, series)
+    if not os.path.isdir(ct_path):
+        result['status'] = 'skipped'
+        log_case_message(result, f"DICOM folder {ct_path} does not exist", verbose)
+        return result
+
+    # DICOM → NIfTI（ファイルには書き出さない）
+    with measure_stage(result, 'convert') as metrics:
+        image = convert_series_in_memory(ct_path)
+        files, nbytes = folder_size(ct_path)
+        metrics.read(nbytes, files)
+
+    # 全領域の臓器を1回の推論でセグメンテーション
+    with measure_stage(result, 'segment'):
+        masks, affine = segmenter.segment_groups(image, [(organ_name, rois) for _, organ_name, rois, _ in regions])
+
+    if cache_dir is not None:
+        with measure_stage(result, 'cache'):
+            _cache_intermediates(cache_dir, case, image, masks, affine, regions, compresslevel, gzip_threads,
+                                 volume_cache)
+
+    with measure_stage(result, 'partition') as metrics:
+        # スライスごとのセグメンテーションの有無
+        occupancies = []
+        for _, organ_name, _, _ in regions:
+            if masks[organ_name] is None:
+                log_case_message(result, f"{organ_name} was not found in {case}", verbose)
+                occupancies.append(None)
+            else:
+                occupancies.append(masks[organ_name].any(axis=(0, 1)))
+
+        # 全領域のz区間を求めてから配置を1回で行う
+        intervals, n_slices = plan_from_occupancies(occupancies, margin,
+                                                    [copy_all for _, _, _, copy_all in regions], extend_bottom)
+        materializer = Materializer(materialize_method, materialize_workers)
+        try:
+            for (region, _, _, _), interval in zip(regions, intervals):
+                if interval is None:
+                    continue
+                place_case_slices(case, interval_to_occupancy(interval, n_slices), dataset_folder,
+                                  output_dirs[region], record_manifest=record_manifest, verbose=verbose,
+                                  result=result, affine=affine, materializer=materializer)
+        finally:
+            materializer.close()
+            metrics.add_materializer(materializer)
+
+    return result
+
+
+def run_pipeline(dataset_folder, output_base, regions=DEFAULT_REGIONS, series='CT2', margin=0, extend_bottom=False,
+                 segment_fn=None, cache_dir=None, materialize_method='copy',
+                 materialize_workers=DEFAULT_MATERIALIZE_WORKERS, manifest_path=None,
+                 compresslevel=DEFAULT_COMPRESSLEVEL, gzip_threads=DEFAULT_GZIP_THREADS, verbose=True, metrics=None,
+                 volume_cache=None):
+    """
+    Parameters:
+    dataset_folder (str): 分割前のDICOMデータセットのフォルダ（ケースフォルダ/CT1, CT2）
+    output_base (str): 分割したデータセット(dataset_upper, dataset_middle, dataset_lower)を作成するフォルダ
+    regions (list): 上の領域から順に [(領域ラベル, 臓器名, [TotalSegmentatorの臓器名], copy_all), ...]
+    series (str): セグメンテーションに使うCTフォルダ名
+    margin (int): 隣り合う領域と重複させるスライス数 (partition_planner.plan_intervals)
+    extend_bottom (bool): 最後の領域を下端のスライスまで含めるか
+    segment_fn (callable): セグメンテーションの関数（Noneの場合はTotalSegmentator．テスト時はスタブを渡す）
+    cache_dir (str): 指定した場合は変換したNIfTIと臓器マスクを保存
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    materialize_workers (int): 配置を並列に行うスレッド数
+    manifest_path (str): 指定した場合はフォルダを作成せず，マニフェスト(.parquet または .jsonl)のみを出力
+    compresslevel (int): 中間データ保存時のgzipの圧縮レベル
+    gzip_threads (int): gzip圧縮に使うスレッド数
+    verbose (bool): メッセージを逐次表示するか
+    metrics (MetricsWriter): 指定した場合はケース・ステージ（convert, segment, cache, partition）ごとの計測結果を出力
+    volume_cache (str): cache_dirと合わせて指定した場合は，保存したNIfTIと臓器マスクを非圧縮のキャッシュ (volume_cache) にも
+                        保存する（個別のスクリプトに同じvolume_cacheを指定すると.nii.gzを展開せずに読み込む）
+
+    Returns:
+    dict: 集計結果 (case_runner.summarize_results)
+    """
+    output_dirs = region_dirs(output_base, regions)
+    manifest = ManifestWriter(manifest_path) if manifest_path else None
+
+    # モデルはケース間で保持する（GPUを使うためケースは逐次処理）
+    segmenter = GroupSegmenter(segment_fn)
+
+    tasks = []
+    for case in sorted(os.listdir(dataset_folder)):
+        if os.path.isdir(os.path.join(dataset_folder, case)):
+            tasks.append((case, (case, dataset_folder, output_dirs, segmenter),
+                          dict(regions=regions, series=series, margin=margin, extend_bottom=extend_bottom,
+                               cache_dir=cache_dir,
+                               materialize_method=materialize_method, materialize_workers=materialize_workers,
+                               record_manifest=manifest is not None, compresslevel=compresslevel,
+                               gzip_threads=gzip_threads, verbose=verbose, volume_cache=volume_cache)))
+
+    progress = ProgressReporter('pipeline', len(tasks))
+    results = []
+    for result in run_cases(partition_case, tasks):
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+        if manifest is not None:
+            for row in result['manifest_rows']:
+                manifest.add(*row)
+        results.append(result)
+    progress.close()
+
+    if manifest is not None:
+        manifest.close()
+
+    print("Pipeline complete.")
+    return summarize_results(results, 'pipeline')
+
+
+if __name__ == "__main__":
+    # 呼び出し例（dataset_upper, dataset_middle, dataset_lowerを~/に作成）
+    run_pipeline(
+        dataset_folder='~/dataset',
+        output_base='~/',
+        cache_dir=None  # '~/pipeline_cache' を指定するとstep1~2の中間データも保存
+    )
+
+    # フォルダを作成せず，マニフェストのみを出力する場合
+    # run_pipeline('~/dataset', '~/', manifest_path='~/dataset_manifest.parquet')
+
+    # ケース・ステージごとの処理時間・読み書きしたバイト数・ピーク時のRSSを記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     run_pipeline('~/dataset', '~/', metrics=metrics)
@@ -0,0 +1,178 @@
+import os
+import json
+from manifest import ManifestWriter, read_manifest, region_label
+import script_paths  # noqa: F401
+from file_io import write_json
+
+'''
+推論のルーティングテーブル（領域ごとのモデルで推論するスライスのリスト）
+
+テストセットの全スライスを全領域のモデルで推論すると，統合時 (unity_dcmfolder) に重複しないスライスの
+生成画像は使われず，推論と読み込みが無駄になる．領域分割の結果（重複させるmarginを含む）から，
+スライスごとに推論する領域を記録し，推論と統合の両方で参照する．
+    routing.json:     {'version', 'series', 'cases': {case: {file_name: {'regions': [...], 'source_path': ...}}}}
+    {領域}.txt:        その領域のモデルで推論するスライスのパス（1行1ファイル，write_slice_lists）
+
+統合時は blend_case(..., routing=routing) とすると，複数の領域に含まれるスライスのみを加重平均し，
+それ以外は担当する領域の生成画像のみをコピーする（他の領域のフォルダは参照しない）．
+
+使用例:
+routing = route_slices(regions, '~/test', '~/test_routing.json', margin=5)
+routing.write_slice_lists('~/test_routing')
+'''
+
+ROUTING_VERSION = 1
+
+# 推論の入力とするシリーズ
+DEFAULT_SERIES = 'CT1'
+
+
+class RoutingTable:
+    """
+    スライスごとに推論する領域を記録する
+
+    Parameters:
+    series (str): 推論の入力とするシリーズ名
+    cases (dict): {case: {file_name: {'regions': [...], 'source_path': ...}}}
+    """
+
+    def __init__(self, series=DEFAULT_SERIES, cases=None):
+        self.series = series
+        self.cases = cases if cases is not None else {}
+
+    def add(self, case, file_name, region, source_path=None):
+        route = self.cases.setdefault(case, {}).setdefault(file_name, {'regions': [], 'source_path': source_path})
+        if region not in route['regions']:
+            route['regions'].append(region)
+            route['regions'].sort()
+        if route['source_path'] is None:
+            route['source_path'] = source_path
+
+    @classmethod
+    def from_manifest(cls, manifest, series=DEFAULT_SERIES):
+        """
+        マニフェスト (ManifestWriter または保存したマニフェストのパス) から作成する
+        """
+        rows = manifest.rows() if isinstance(manifest, ManifestWriter) else read_manifest(manifest)
+        table = cls(series)
+        for row in rows:
+            if row['series'] == series:
+                for region in row['regions']:
+                    table.add(row['case'], row['file_name'], region, row['source_path'])
+        return table
+
+    @classmethod
+    def from_folders(cls, region_folders, series=DEFAULT_SERIES):
+        """
+        分割したデータセットのフォルダ (例: '~/test_upper') から作成する
+        """
+        table = cls(series)
+        for folder in region_folders:
+            region = region_label(folder)
+            for case in sorted(os.listdir(folder)):
+                series_dir = os.path.join(folder, case, series)
+                if not os.path.isdir(series_dir):
+                    continue
+                for entry in os.scandir(series_dir):
+                    if entry.name.endswith('.DCM'):
+                        table.add(case, entry.name, region, os.path.realpath(entry.path))
+        return table
+
+    def regions(self):
+        return sorted({region for routes in self.cases.values() for route in routes.values()
+                       for region in route['regions']})
+
+    def case_routes(self, case):
+        """
+        ケース内の {file_name: 推論する領域のリスト}
+        """
+        return {file_name: route['regions'] for file_name, route in self.cases.get(case, {}).items()}
+
+    def slices_for(self, region):
+        """
+        領域のモデルで推論するスライスを (case, file_name, source_path) のリストで返す
+        """
+        return [(case, file_name, route['source_path'])
+                for case in sorted(self.cases) for file_name, route in sorted(self.cases[case].items())
+                if region in route['regions']]
+
+    def overlap_count(self):
+        return sum(len(route['regions']) > 1 for routes in self.cases.values() for route in routes.values())
+
+    def save(self, routing_path):
+        write_json(routing_path, {'version': ROUTING_VERSION, 'series': self.series, 'cases': self.cases},
+                   ensure_ascii=False)
+
+    @classmethod
+    def load(cls, routing_path):
+        with open(os.path.expanduser(routing_path), 'r') as f:
+            data = json.load(f)
+        if data.get('version') != ROUTING_VERSION:
+            raise ValueError(f"Unsupported routing table version in {routing_path}: {data.get('version')}")
+        return cls(data['series'], data['cases'])
+
+    def write_slice_lists(self, output_dir):
+        """
+        領域ごとに推論するスライスのパスを {領域}.txt に書き出す
+
+        Returns:
+        dict: {領域: 書き出したパス}
+        """
+        output_dir = os.path.expanduser(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        paths = {}
+        for region in self.regions():
+            paths[region] = os.path.join(output_dir, f'{region}.txt')
+            with open(paths[region], 'w') as f:
+                for _, _, source_path in self.slices_for(region):
+                    f.write(f'{source_path}\n')
+        return paths
+
+
+def route_slices(regions, src_dir, routing_path, margin=0, extend_bottom=False, series=DEFAULT_SERIES, **kwargs):
+    """
+    領域分割 (slicepartitioning.partition_slices) の結果からルーティングテーブルを作成して保存する
+    （ファイルは配置せず，分割結果のマニフェストを routing_path と同じ場所に保存）
+
+    Parameters:
+    regions (list): partition_slicesと同じ
+    src_dir (str): 分割するデータセット（テストセット）のフォルダ
+    routing_path (str): ルーティングテーブルの出力先 (.json)
+    margin (int): 隣り合う領域と重複させるスライス数（重複したスライスのみ統合時に加重平均される）
+    extend_bottom (bool): 最後の領域を下端のスライスまで含めるか
+    series (str): 推論の入力とするシリーズ名
+    kwargs: その他のpartition_slicesの引数
+
+    Returns:
+    RoutingTable: ルーティングテーブル
+    """
+    from slicepartitioning import partition_slices
+
+    routing_path = os.path.expanduser(routing_path)
+    with ManifestWriter(f'{os.path.splitext(routing_path)[0]}_manifest.jsonl') as manifest:
+        partition_slices(regions, src_dir, margin=margin, extend_bottom=extend_bottom, manifest=manifest, **kwargs)
+    routing = RoutingTable.from_manifest(manifest, series)
+    routing.save(routing_path)
+
+    for region in routing.regions():
+        print(f"{region}: {len(routing.slices_for(region))} slices")
+    print(f"Routing table saved: {routing_path} ({routing.overlap_count()} overlapping slices)")
+    return routing
+
+
+if __name__ == "__main__":
+    # テストセットを分割する領域（slicepartitioning.pyと同じ）
+    test_dir = '~/test'
+    regions = [
+        ('~/totalSegmentator/organSeg/test_thyroidgland', '~/test_upper', 'thyroid_gland', True),
+        ('~/totalSegmentator/organSeg/test_wholelung', '~/test_middle', 'whole_lung', False),
+        ('~/totalSegmentator/organSeg/test_kidney', '~/test_lower', 'kidney', False),
+    ]
+
+    # 隣り合う領域と5スライスずつ重複させ，領域ごとに推論するスライスのリストを出力
+    routing = route_slices(regions, test_dir, '~/test_routing.json', margin=5)
+    routing.write_slice_lists('~/test_routing')
+
+    # 分割済みのフォルダから作成する場合
+    # routing = RoutingTable.from_folders(['~/test_upper', '~/test_middle', '~/test_lower'])
+    # routing.save('~/test_routing.json')
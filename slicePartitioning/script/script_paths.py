@@ -0,0 +1,19 @@
+import os
+import sys
+
+'''
+他のフォルダのモジュールを読み込めるよう sys.path に追加する（import script_paths とするだけでよい）
+    common/                     case_runner, instrumentation など両方のスクリプトで共有するモジュール
+    totalSegmentator/script/    segmenter, mask_io, dcm2nifti（pipeline.py などで利用）
+
+依存の向きは slicePartitioning → totalSegmentator → common の一方向とし，
+totalSegmentator/script からは slicePartitioning/script のモジュールを読み込まない．
+'''
+
+REPO_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+COMMON_DIR = os.path.join(REPO_DIR, 'common')
+TOTALSEG_SCRIPT_DIR = os.path.join(REPO_DIR, 'totalSegmentator', 'script')
+
+for _path in (COMMON_DIR, TOTALSEG_SCRIPT_DIR):
+    if _path not in sys.path:
+        sys.path.append(_path)
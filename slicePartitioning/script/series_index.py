@@ -0,0 +1,244 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dicom_validation import read_dicom_header, DEFAULT_VALIDATION_WORKERS
+import script_paths  # noqa: F401
+from file_io import DICOM_SUFFIX, write_json
+
+'''
+DICOMシリーズ（CT1, CT2 などのフォルダ）ごとのジオメトリインデックス
+
+フォルダを1回scandirし，各ファイルのヘッダのみ（ピクセルデータは読まない）を並列に読み込んで
+ファイル名・InstanceNumber・ImagePositionPatientのz・SOPInstanceUIDを記録する．
+NIfTIのzインデックスはマスクのaffineで患者座標のzに変換し，スライス位置からDICOMファイルを求める．
+（dicom2niftiはx, yのみを反転してRASに変換するため，zはDICOMの座標と同じ）
+
+ファイル名の連番 ({j:08}.DCM) やファイルの存在確認に依存しないため，命名規則の異なるデータでも利用できる．
+インデックスはプロセス内でシリーズごとにキャッシュし，cache_dirを指定した場合はJSONとしても保存する．
+フォルダの更新時刻とファイル名の一覧が変わった場合は作り直す（ファイルの上書きは検出しない）．
+'''
+
+INDEX_VERSION = 1
+
+# ヘッダを読み込むスレッド数
+DEFAULT_INDEX_WORKERS = DEFAULT_VALIDATION_WORKERS
+
+# スライス間隔に対する位置の許容誤差
+Z_TOLERANCE = 0.25
+
+# プロセス内のキャッシュ {シリーズの絶対パス: SeriesIndex}
+_INDEX_CACHE = {}
+
+
+def _read_entry(file_path):
+    dcm = read_dicom_header(file_path)
+    if dcm is None:
+        return None
+
+    position = dcm.get('ImagePositionPatient')
+    instance = dcm.get('InstanceNumber')
+    sop_uid = dcm.get('SOPInstanceUID')
+    return {
+        'file': os.path.basename(file_path),
+        'instance': int(instance) if instance is not None else None,
+        'z': float(position[2]) if position is not None and len(position) == 3 else None,
+        'sop_uid': str(sop_uid) if sop_uid is not None else None,
+    }
+
+
+def _z_of_index(affine, z_index):
+    # ボクセル (0, 0, z_index) の中心の患者座標z
+    return float(affine[2, 2] * z_index + affine[2, 3])
+
+
+class SeriesIndex:
+    """
+    DICOMシリーズ1つ分のジオメトリインデックス
+
+    Parameters:
+    series_dir (str): シリーズのフォルダ
+    entries (list): [{'file', 'instance', 'z', 'sop_uid'}, ...]（ヘッダを読み込めたファイルのみ）
+    dir_mtime_ns (int): 作成時のフォルダの更新時刻
+    file_names (list): 作成時のフォルダ内のDICOMファイル名（読み込めなかったファイルを含む）
+    """
+
+    def __init__(self, series_dir, entries, dir_mtime_ns=None, file_names=None):
+        self.series_dir = series_dir
+        self.entries = entries
+        self.dir_mtime_ns = dir_mtime_ns
+        self.file_names = sorted(file_names if file_names is not None else [entry['file'] for entry in entries])
+        self.by_name = {entry['file']: entry for entry in entries}
+
+        # zの昇順に並べ，等間隔であればO(1)で位置からファイルを求める
+        located = sorted((entry for entry in entries if entry['z'] is not None), key=lambda entry: entry['z'])
+        self._z = np.array([entry['z'] for entry in located], dtype=np.float64)
+        self._files = [entry['file'] for entry in located]
+        self._spacing = None
+        if self._z.size > 1:
+            steps = np.diff(self._z)
+            spacing = float(np.median(steps))
+            if spacing > 0 and np.all(np.abs(steps - spacing) <= Z_TOLERANCE * spacing):
+                self._spacing = spacing
+
+    @classmethod
+    def build(cls, series_dir, max_workers=DEFAULT_INDEX_WORKERS):
+        """
+        scandirとヘッダの読み込みでインデックスを作成する
+        """
+        dir_mtime_ns = os.stat(series_dir).st_mtime_ns
+        file_paths = sorted(entry.path for entry in os.scandir(series_dir)
+                            if entry.name.endswith(DICOM_SUFFIX) and entry.is_file())
+
+        if max_workers is None or max_workers <= 1 or len(file_paths) <= 1:
+            entries = [_read_entry(path) for path in file_paths]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+                entries = list(executor.map(_read_entry, file_paths))
+
+        return cls(series_dir, [entry for entry in entries if entry is not None], dir_mtime_ns,
+                   [os.path.basename(path) for path in file_paths])
+
+    def is_current(self):
+        """
+        フォルダの更新時刻とファイル名の一覧が作成時と同じか
+        """
+        try:
+            if os.stat(self.series_dir).st_mtime_ns != self.dir_mtime_ns:
+                return False
+            file_names = sorted(entry.name for entry in os.scandir(self.series_dir)
+                                if entry.name.endswith(DICOM_SUFFIX))
+        except OSError:
+            return False
+        return file_names == self.file_names
+
+    @property
+    def has_geometry(self):
+        return self._z.size > 0
+
+    def is_valid(self, file_name):
+        """
+        ヘッダを読み込めたファイルか
+        """
+        return file_name in self.by_name
+
+    def path(self, file_name):
+        return os.path.join(self.series_dir, file_name)
+
+    def file_at_z(self, z):
+        """
+        患者座標zの位置にあるスライスのファイル名を返す．該当するスライスがない場合はNone
+        """
+        if self._z.size == 0:
+            return None
+        if self._spacing is not None:
+            position = int(round((z - self._z[0]) / self._spacing))
+            if not 0 <= position < self._z.size:
+                return None
+            tolerance = Z_TOLERANCE * self._spacing
+        else:
+            # 不等間隔の場合は最も近いスライス
+            position = int(np.searchsorted(self._z, z))
+            if position == self._z.size or (position > 0 and z - self._z[position - 1] < self._z[position] - z):
+                position -= 1
+            neighbours = np.diff(self._z[max(position - 1, 0):position + 2])
+            tolerance = Z_TOLERANCE * float(neighbours.min()) if neighbours.size else np.inf
+        if abs(self._z[position] - z) > tolerance:
+            return None
+        return self._files[position]
+
+    def ordered_files(self):
+        """
+        スライス位置の順に並べたファイル名のリスト（位置情報がない場合はファイル名順）
+        """
+        return list(self._files) if self.has_geometry else list(self.file_names)
+
+    def file_for_z_index(self, z_index, affine, n_slices=None):
+        """
+        NIfTIのzインデックスに対応するファイル名を返す
+
+        Parameters:
+        z_index (int): マスクのzインデックス
+        affine (numpy.ndarray): マスクのaffine
+        n_slices (int): マスクのスライス数（ヘッダに位置情報がない場合に {n_slices - z_index:08}.DCM を使う）
+        """
+        if self.has_geometry and affine is not None:
+            return self.file_at_z(_z_of_index(affine, z_index))
+
+        # 位置情報がない場合はファイル名の連番で対応付ける
+        if n_slices is not None:
+            file_name = f"{n_slices - int(z_index):08}{DICOM_SUFFIX}"
+            if file_name in self.by_name:
+                return file_name
+        return None
+
+    def files_for_z_indices(self, z_indices, affine, n_slices=None):
+        return [self.file_for_z_index(z_index, affine, n_slices) for z_index in z_indices]
+
+    def z_index_of(self, file_name, affine, n_slices=None):
+        """
+        ファイルに対応するNIfTIのzインデックスを返す（file_for_z_indexの逆）．求められない場合はNone
+        """
+        entry = self.by_name.get(file_name)
+        if entry is None:
+            return None
+        if entry['z'] is not None and affine is not None:
+            return int(round((entry['z'] - affine[2, 3]) / affine[2, 2]))
+        if n_slices is not None:
+            try:
+                return n_slices - int(file_name.split('.')[0])
+            except ValueError:
+                return None
+        return None
+
+    def to_dict(self):
+        return {'version': INDEX_VERSION, 'series_dir': os.path.abspath(self.series_dir),
+                'dir_mtime_ns': self.dir_mtime_ns, 'file_names': self.file_names, 'entries': self.entries}
+
+    @classmethod
+    def from_dict(cls, series_dir, data):
+        return cls(series_dir, data['entries'], data['dir_mtime_ns'], data['file_names'])
+
+
+def _cache_path(cache_dir, series_dir):
+    key = hashlib.sha1(os.path.abspath(series_dir).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f'{key}.json')
+
+
+def load_series_index(series_dir, cache_dir=None, max_workers=DEFAULT_INDEX_WORKERS):
+    """
+    シリーズのインデックスを返す（変更がなければキャッシュを利用）
+
+    Parameters:
+    series_dir (str): シリーズのフォルダ (例: dataset/case01/CT2)
+    cache_dir (str): 指定した場合はインデックスをJSONとして保存・再利用
+    max_workers (int): ヘッダを読み込むスレッド数
+    """
+    key = os.path.abspath(series_dir)
+    index = _INDEX_CACHE.get(key)
+    if index is not None and index.is_current():
+        return index
+
+    index = None
+    if cache_dir is not None:
+        cache_path = _cache_path(cache_dir, series_dir)
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    data = json.load(f)
+                if data.get('version') == INDEX_VERSION:
+                    index = SeriesIndex.from_dict(series_dir, data)
+                    if not index.is_current():
+                        index = None
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Failed to read series index {cache_path}: {e}")
+                index = None
+
+    if index is None:
+        index = SeriesIndex.build(series_dir, max_workers)
+        if cache_dir is not None:
+            write_json(cache_path, index.to_dict())
+
+    _INDEX_CACHE[key] = index
+    return index
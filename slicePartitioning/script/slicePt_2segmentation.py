@@ -1,7 +1,15 @@
 import os
-import shutil
 import nibabel as nib
-import pydicom
+from dicom_validation import read_dicom_header, DEFAULT_VALIDATION_WORKERS
+from mask_extent import occupancy_to_z_range
+from volume_cache import load_mask_extent
+from extent_index import ExtentIndex, mask_available
+from materialize import Materializer, DEFAULT_MATERIALIZE_WORKERS
+from manifest import ManifestWriter
+from series_index import load_series_index
+import script_paths  # noqa: F401
+from case_runner import new_case_result, log_case_message, run_cases, summarize_results
+from instrumentation import measure_stage, ProgressReporter
 
 '''
 ２つのセグメンテーションデータから３領域に分割するスクリプト
@@ -12,118 +20,207 @@ seg1_nifti_base (str): セグメンテーションデータが保存されてい
 seg2_nifti_base (str): セグメンテーションデータが保存されているフォルダのパス
 '''
 
-def get_nifti_slice_range(nifti_file):
-    # NIfTIファイルを読み込む
-    img = nib.load(nifti_file)
-    data = img.get_fdata()
-
-    # セグメンテーションデータが存在するかを確認
-    slices_with_segmentation = [1 if data[:, :, i].sum() > 0 else 'none' for i in range(data.shape[2])]
+def get_nifti_slice_range(nifti_file, extent_index=None, volume_cache=None):
+    # NIfTIファイルからスライスごとのセグメンテーションの有無を取得（float64に展開せずスラブ単位で読み込む）
+    # extent_indexが指定された場合は，変更のないマスクはインデックスの値を利用
+    # volume_cacheが指定された場合は，非圧縮のキャッシュからメモリマップで読み込む
+    if extent_index is not None:
+        slices_with_segmentation = extent_index.get_slice_occupancy(nifti_file)
+    else:
+        slices_with_segmentation = load_mask_extent(nifti_file, volume_cache)[0]
+
+    # セグメンテーションデータが存在するzインデックスの範囲
+    z_range = occupancy_to_z_range(slices_with_segmentation)
+    if z_range is None:
+        return None
 
-    # 逆順でスライス番号を取得
+    # 逆順で最初に出現するスライス（z_max）の番号をseg_startとする
     total_slices = len(slices_with_segmentation)
-    seg_start = None
-
-    # 最初に1（セグメンテーションデータ）が出現するスライスをseg_startとする
-    for i, val in enumerate(slices_with_segmentation[::-1]):
-        if val == 1:
-            if seg_start is None:
-                seg_start = i   # 逆順にしているので調整
+    seg_start = total_slices - 1 - z_range[1]
 
     # 最初のスライス番号のindexを返す
     return seg_start
 
+def get_nifti_num_slices(nifti_file, extent_index=None):
+    # マスクのzスライス数（ヘッダのみ参照）
+    return get_nifti_geometry(nifti_file, extent_index)[0][2]
+
+def get_nifti_geometry(nifti_file, extent_index=None):
+    # マスクのshapeとaffine（ヘッダのみ参照）
+    if extent_index is not None:
+        return extent_index.get_geometry(nifti_file)
+    img = nib.load(nifti_file)
+    return img.shape, img.affine
+
 def validate_dicom_file(file_path):
-    try:
-        # DICOMファイルを読み込む
-        dicom_data = pydicom.dcmread(file_path)
-        return dicom_data
-    except Exception as e:
-        print(f"Error reading DICOM file {file_path}: {e}")
-        return None
+    # DICOMファイルのヘッダのみを読み込む（ピクセルデータは読まない）
+    return read_dicom_header(file_path)
 
 # セグメンテーションのスライス範囲に基づいてDICOMファイルを分割
-def split_dicom_files(dataset_folder, case_folder, seg1_nifti, seg2_nifti, output_upper, output_middle, output_lower):
-    # NIfTI ファイルが存在するかチェック
-    if not os.path.exists(seg1_nifti) or not os.path.exists(seg2_nifti):
-        print(f"{case_folder} のセグメンテーションファイルが見つかりません。スキップします。")
-        return
-
-    # NIfTI ファイルから最初のスライス番号のindexを取得
-    try:
-        seg1_start = get_nifti_slice_range(seg1_nifti)
-        seg2_start = get_nifti_slice_range(seg2_nifti)
-    except FileNotFoundError as e:
-        print(f"セグメンテーションファイルの読み込みに失敗しました: {e}")
-        return
-
-    print(f"segmentation1の初めのスライス番号：{seg1_start}\nsegmentation2の初めのスライス番号：{seg2_start}")
-
-    if seg1_start > seg2_start :
-        print("seg1_start < seg2_startとなるようにしてください")
-        return  
-
-    if seg1_start is None or seg2_start is None:
-        print("セグメンテーションデータに有効なスライスが見つかりません。")
-        return
-
-    # 出力フォルダ (upper, middle, lower) を作成
-    os.makedirs(output_upper, exist_ok=True)
-    os.makedirs(output_middle, exist_ok=True)
-    os.makedirs(output_lower, exist_ok=True)
-
-    ct_folders = [os.path.join(case_folder, sub_folder) for sub_folder in os.listdir(case_folder)
-                  if os.path.isdir(os.path.join(case_folder, sub_folder)) and sub_folder.startswith("CT")]
-
-    for ct_folder in ct_folders:
-        ct_name = os.path.basename(ct_folder)  # CT1とCT2のフォルダ名を取得
-
-        # 出力フォルダ内にCT1, CT2フォルダを作成
-        output_upper_ct = os.path.join(output_upper, ct_name)
-        output_middle_ct = os.path.join(output_middle, ct_name)
-        output_lower_ct = os.path.join(output_lower, ct_name)
-
-        os.makedirs(output_upper_ct, exist_ok=True)
-        os.makedirs(output_middle_ct, exist_ok=True)
-        os.makedirs(output_lower_ct, exist_ok=True)
-
-        dicom_files = sorted([f for f in os.listdir(ct_folder) if f.endswith(".DCM")], reverse=True)
-
-        for file_name in dicom_files:
-            slice_num_str = file_name.split('.')[0]  # ファイル名の番号部分 (例: 00000001)
-
-            try:
-                # 8桁の番号を整数に変換してスライス番号として扱う
-                slice_num = int(slice_num_str)
-
-            except ValueError:
-                print(f"ファイル名 {file_name} からスライス番号を取得できませんでした。")
-                continue
-
-            # DICOMファイルを読み込み、エラーチェック
-            dicom_file_path = os.path.join(ct_folder, file_name)
-            dicom_data = validate_dicom_file(dicom_file_path)
-
-            if dicom_data is None: 
-                # DICOMファイルが正しく読み込めない場合はスキップ
-                continue
-
-            # 上部：上端スライスから大動脈の上端までの範囲を指定
-            if slice_num <= seg1_start:
-                shutil.copy(dicom_file_path, os.path.join(output_upper_ct, file_name))
-            # 中部：大動脈の上端から肝臓の上端までの範囲
-            elif seg1_start < slice_num <= seg2_start:
-                shutil.copy(dicom_file_path, os.path.join(output_middle_ct, file_name))
-            # 下部：肝臓の上端から末端スライスまでの範囲
-            else:
-                shutil.copy(dicom_file_path, os.path.join(output_lower_ct, file_name))
-
-    print(f"{case_folder} のDICOMファイルが正常に分割されました。")
-
-def process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base):
-    case_folders = [os.path.join(dataset_folder, case) for case in os.listdir(dataset_folder)
+def split_dicom_files(dataset_folder, case_folder, seg1_nifti, seg2_nifti, output_upper, output_middle, output_lower,
+                      seg1_index=None, seg2_index=None, validation_workers=DEFAULT_VALIDATION_WORKERS,
+                      materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                      record_manifest=False, verbose=True, use_series_index=True, series_index_cache=None,
+                      volume_cache=None, result=None):
+    """
+    1ケース分のDICOMファイルを分割する
+
+    record_manifest (bool): Trueの場合はファイルを配置せず，マニフェストの行を結果に記録
+    verbose (bool): Trueの場合はメッセージを逐次表示
+    use_series_index (bool): Trueの場合，DICOMのヘッダのスライス位置とマスクのaffineからスライス番号を求める
+                             Falseの場合はファイル名の番号をスライス番号とする
+    series_index_cache (str): シリーズのインデックスを保存するフォルダ
+    volume_cache (str): マスクのキャッシュ (volume_cache) のフォルダ
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)
+    """
+    case_name = os.path.basename(os.path.normpath(case_folder))
+    if result is None:
+        result = new_case_result(case_name)
+
+    # ケース全体の処理時間・配置したファイル数などを計測し，result['metrics']に記録
+    with measure_stage(result, 'split') as metrics:
+        # NIfTI ファイルが存在するかチェック
+        if not mask_available(seg1_nifti, seg1_index) or not mask_available(seg2_nifti, seg2_index):
+            result['status'] = 'skipped'
+            log_case_message(result, f"{case_folder} のセグメンテーションファイルが見つかりません。スキップします。", verbose)
+            return result
+
+        # NIfTI ファイルから最初のスライス番号のindexを取得
+        try:
+            # z範囲インデックスを使う場合はデコードしたか分からないため，読み込んだバイト数には加えない
+            with metrics.decoding(*[path for path, index in ((seg1_nifti, seg1_index), (seg2_nifti, seg2_index))
+                                    if index is None and volume_cache is None]):
+                seg1_start = get_nifti_slice_range(seg1_nifti, seg1_index, volume_cache)
+                seg2_start = get_nifti_slice_range(seg2_nifti, seg2_index, volume_cache)
+        except FileNotFoundError as e:
+            result['status'] = 'skipped'
+            log_case_message(result, f"セグメンテーションファイルの読み込みに失敗しました: {e}", verbose)
+            return result
+        finally:
+            # ワーカープロセスで更新したz範囲インデックスのエントリを返す
+            for index in (seg1_index, seg2_index):
+                if index is not None:
+                    result['extent_entries'][index.index_path] = index.updated
+
+        if verbose:
+            print(f"segmentation1の初めのスライス番号：{seg1_start}\nsegmentation2の初めのスライス番号：{seg2_start}")
+
+        if seg1_start is None or seg2_start is None:
+            result['status'] = 'skipped'
+            log_case_message(result, "セグメンテーションデータに有効なスライスが見つかりません。", verbose)
+            return result
+
+        if seg1_start > seg2_start :
+            result['status'] = 'skipped'
+            log_case_message(result, "seg1_start < seg2_startとなるようにしてください", verbose)
+            return result
+
+        # スライス番号 (total_slices - zインデックス) を求めるためのマスクのジオメトリ
+        shape, affine = get_nifti_geometry(seg1_nifti, seg1_index)
+        total_slices = shape[2]
+        if not use_series_index:
+            affine = None
+
+        # マニフェストを出力する場合はフォルダを作成せず，スライスごとに領域ラベルを記録
+        if not record_manifest:
+            # 出力フォルダ (upper, middle, lower) を作成
+            os.makedirs(output_upper, exist_ok=True)
+            os.makedirs(output_middle, exist_ok=True)
+            os.makedirs(output_lower, exist_ok=True)
+
+        ct_folders = [os.path.join(case_folder, sub_folder) for sub_folder in os.listdir(case_folder)
+                      if os.path.isdir(os.path.join(case_folder, sub_folder)) and sub_folder.startswith("CT")]
+
+        materializer = Materializer(materialize_method, materialize_workers)
+        try:
+            for ct_folder in ct_folders:
+                ct_name = os.path.basename(ct_folder)  # CT1とCT2のフォルダ名を取得
+
+                # 出力フォルダ内にCT1, CT2フォルダを作成
+                output_upper_ct = os.path.join(output_upper, ct_name)
+                output_middle_ct = os.path.join(output_middle, ct_name)
+                output_lower_ct = os.path.join(output_lower, ct_name)
+
+                if not record_manifest:
+                    os.makedirs(output_upper_ct, exist_ok=True)
+                    os.makedirs(output_middle_ct, exist_ok=True)
+                    os.makedirs(output_lower_ct, exist_ok=True)
+
+                # シリーズ内の全ファイルのヘッダを並列に読み込んだインデックス（キャッシュがあれば再利用）
+                series_index = load_series_index(ct_folder, series_index_cache, validation_workers)
+
+                for file_name in sorted(series_index.file_names, reverse=True):
+                    dicom_file_path = os.path.join(ct_folder, file_name)
+
+                    if not series_index.is_valid(file_name):
+                        # DICOMファイルが正しく読み込めない場合はスキップ
+                        continue
+
+                    # スライス位置からマスクのzインデックスを求め，スライス番号 (00000001.DCMが1) に変換
+                    z_index = series_index.z_index_of(file_name, affine, total_slices)
+                    if z_index is None:
+                        log_case_message(result, f"ファイル {file_name} からスライス番号を取得できませんでした。", verbose)
+                        continue
+                    slice_num = total_slices - z_index
+
+                    # 上部：上端スライスから大動脈の上端までの範囲を指定
+                    if slice_num <= seg1_start:
+                        region, output_ct = 'upper', output_upper_ct
+                    # 中部：大動脈の上端から肝臓の上端までの範囲
+                    elif seg1_start < slice_num <= seg2_start:
+                        region, output_ct = 'middle', output_middle_ct
+                    # 下部：肝臓の上端から末端スライスまでの範囲
+                    else:
+                        region, output_ct = 'lower', output_lower_ct
+
+                    if record_manifest:
+                        result['manifest_rows'].append(
+                            (case_name, ct_name, file_name, dicom_file_path, z_index, region))
+                    else:
+                        materializer.submit(dicom_file_path, os.path.join(output_ct, file_name))
+                    result['files'] += 1
+        finally:
+            materializer.close()
+            metrics.add_materializer(materializer)
+
+        if verbose:
+            print(f"{case_folder} のDICOMファイルが正常に分割されました。")
+        return result
+
+def process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base, use_extent_index=True,
+                      validation_workers=DEFAULT_VALIDATION_WORKERS,
+                      materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                      manifest_path=None, num_workers=1, verbose=None, use_series_index=True,
+                      series_index_cache=None, metrics=None, volume_cache=None):
+    """
+    num_workers (int): ケースを並列に処理するプロセス数（1の場合は逐次処理）
+    verbose (bool): メッセージを逐次表示するか（Noneの場合は逐次処理のときのみ表示）
+    use_series_index (bool): Trueの場合，DICOMのヘッダのスライス位置とマスクのaffineからスライス番号を求める
+    series_index_cache (str): シリーズのインデックスを保存するフォルダ（Noneの場合はプロセス内のみでキャッシュ）
+    metrics (MetricsWriter): 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    volume_cache (str): 指定した場合はマスクを非圧縮のキャッシュ (volume_cache) に展開し，以降はメモリマップで読み込む
+
+    Returns:
+    dict: 集計結果 (case_runner.summarize_results)
+    """
+    parallel = num_workers is not None and num_workers > 1
+    if verbose is None:
+        verbose = not parallel
+
+    # 臓器データセットごとのz範囲インデックス（変更のないマスクは再読み込みしない）
+    seg1_index = ExtentIndex(seg1_nifti_base, volume_cache=volume_cache) if use_extent_index else None
+    seg2_index = ExtentIndex(seg2_nifti_base, volume_cache=volume_cache) if use_extent_index else None
+
+    # manifest_pathを指定した場合はupper/middle/lowerのフォルダの代わりにマニフェスト(.parquet or .jsonl)を出力
+    manifest = ManifestWriter(manifest_path) if manifest_path is not None else None
+
+    case_folders = [os.path.join(dataset_folder, case) for case in sorted(os.listdir(dataset_folder))
                     if os.path.isdir(os.path.join(dataset_folder, case))]
 
+    tasks = []
     for case_folder in case_folders:
         case_name = os.path.basename(case_folder)
 
@@ -136,15 +233,61 @@ def process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_b
         output_middle = os.path.join(output_base + "_middle", f"{case_name}")
         output_lower = os.path.join(output_base + "_lower", f"{case_name}")
 
-        # 各ケースを処理
-        split_dicom_files(dataset_folder, case_folder, seg1_nifti, seg2_nifti, output_upper, output_middle, output_lower)
-
-# 入力フォルダと出力フォルダのパス
-dataset_folder = '~/dataset'
-seg1_nifti_base = '~/totalSegmentator/organSeg/dataset_aorta'
-seg2_nifti_base = '~/totalSegmentator/organSeg/dataset_liver'
-output_base = dataset_folder
-
-# 全てのケースを処理
-process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base)
-  
\ No newline at end of file
+        # ワーカープロセスにはそのケースのエントリだけを渡す
+        case_seg1_index, case_seg2_index = seg1_index, seg2_index
+        if use_extent_index and parallel:
+            case_seg1_index = seg1_index.subset([seg1_nifti])
+            case_seg2_index = seg2_index.subset([seg2_nifti])
+
+        tasks.append((case_name,
+                      (dataset_folder, case_folder, seg1_nifti, seg2_nifti, output_upper, output_middle, output_lower),
+                      dict(seg1_index=case_seg1_index, seg2_index=case_seg2_index,
+                           validation_workers=validation_workers,
+                           materialize_method=materialize_method, materialize_workers=materialize_workers,
+                           record_manifest=manifest is not None, verbose=verbose,
+                           use_series_index=use_series_index, series_index_cache=series_index_cache,
+                           volume_cache=volume_cache)))
+
+    # 各ケースを処理（進捗は一定間隔ごとにまとめて表示）
+    progress = ProgressReporter('split', len(tasks))
+    results = []
+    for result in run_cases(split_dicom_files, tasks, num_workers):
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+        if use_extent_index and parallel:
+            for index in (seg1_index, seg2_index):
+                index.merge(result['extent_entries'].get(index.index_path, {}))
+        if manifest is not None:
+            for row in result['manifest_rows']:
+                manifest.add(*row)
+        results.append(result)
+    progress.close()
+
+    if manifest is not None:
+        manifest.close()
+
+    if use_extent_index:
+        seg1_index.save()
+        seg2_index.save()
+
+    return summarize_results(results, output_base)
+
+if __name__ == "__main__":
+    # 入力フォルダと出力フォルダのパス
+    dataset_folder = '~/dataset'
+    seg1_nifti_base = '~/totalSegmentator/organSeg/dataset_aorta'
+    seg2_nifti_base = '~/totalSegmentator/organSeg/dataset_liver'
+    output_base = dataset_folder
+
+    # 全てのケースを処理（num_workersを指定するとケースをプロセスプールで並列に処理）
+    process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base)
+
+    # upper/middle/lowerのフォルダを作成せず，マニフェストのみを出力する場合
+    # process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base,
+    #                   manifest_path=output_base + '_manifest.parquet')
+
+    # ケースごとの処理時間・読み書きしたバイト数・ピーク時のRSSを記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     process_all_cases(dataset_folder, seg1_nifti_base, seg2_nifti_base, output_base, metrics=metrics)
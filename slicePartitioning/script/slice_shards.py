@@ -0,0 +1,266 @@
+import os
+import json
+import shutil
+import numpy as np
+import pydicom
+from manifest import ManifestWriter
+import script_paths  # noqa: F401
+from instrumentation import ProgressReporter
+from file_io import temp_path, replace_path
+
+'''
+分割したデータセットを，学習用に正規化済みのCT1/CT2ペアのシャードとして出力するモジュール
+
+upper/middle/lowerのフォルダのDCMファイルは，学習時にエポックごとに読み込み・展開・正規化し直す必要がある．
+ShardWriterは分割結果をマニフェスト (manifest.ManifestWriter) と同様に記録し，close() 時に領域ごとに
+CT1とCT2の同じファイル名のスライスをペアにして，ウィンドウ処理と正規化を済ませた配列を1回だけ書き出す．
+    output_dir/manifest.jsonl            分割結果のマニフェスト
+    output_dir/{領域}/shards.json         dtype・ウィンドウ・シリーズ名・スライス数
+    output_dir/{領域}/index.jsonl         1ペア1行 (shard, offset, rows, columns, case, file_name, z_index, ...)
+    output_dir/{領域}/shard-{k:05}.bin    (CT1, CT2) の順に (rows, columns) の配列を連続して格納
+
+学習時は SliceShards で開くと，シャードをメモリマップで読み込むため（DICOMの解析なし）連続したI/Oとなる．
+
+使用例:
+with ShardWriter('~/dataset_shards') as shards:
+    partition_slices(regions, src_dir, manifest=shards)
+
+upper = SliceShards('~/dataset_shards/upper')
+ct1, ct2 = upper[0]
+'''
+
+# CT値のウィンドウ（下限, 上限）．範囲外はクリップし，[-1, 1] に正規化する
+DEFAULT_HU_WINDOW = (-1024.0, 3071.0)
+
+# 保存するデータ型（float16で元のDICOMと同じ1ピクセル2バイト）
+DEFAULT_DTYPE = 'float16'
+
+# 1シャードあたりの最大バイト数
+DEFAULT_SHARD_BYTES = 256 * 2**20
+
+# ペアにするシリーズ（入力, 目標）
+DEFAULT_SERIES = ('CT1', 'CT2')
+
+SHARD_VERSION = 1
+
+
+def normalize_slice(dcm, window=DEFAULT_HU_WINDOW, dtype=DEFAULT_DTYPE):
+    """
+    DICOMのピクセルデータをCT値に変換し，ウィンドウでクリップして [-1, 1] に正規化する
+
+    Parameters:
+    dcm (pydicom.Dataset): DICOMデータ
+    window (tuple): CT値の (下限, 上限)
+    dtype (str): 出力のデータ型
+
+    Returns:
+    numpy.ndarray: (rows, columns) の配列
+    """
+    low, high = window
+    hu = dcm.pixel_array.astype(np.float32)
+    hu *= np.float32(getattr(dcm, 'RescaleSlope', 1))
+    hu += np.float32(getattr(dcm, 'RescaleIntercept', 0))
+    np.clip(hu, low, high, out=hu)
+    hu -= np.float32(low)
+    hu *= np.float32(2.0 / (high - low))
+    hu -= np.float32(1.0)
+    return hu.astype(dtype)
+
+
+def _slice_metadata(dcm):
+    position = getattr(dcm, 'ImagePositionPatient', None)
+    spacing = getattr(dcm, 'PixelSpacing', None)
+    return {
+        'slice_location': float(position[2]) if position is not None else None,
+        'pixel_spacing': [float(s) for s in spacing] if spacing is not None else None,
+        'slice_thickness': float(dcm.SliceThickness) if 'SliceThickness' in dcm else None,
+    }
+
+
+class ShardWriter(ManifestWriter):
+    """
+    分割結果を記録し，close() 時に領域ごとの正規化済みシャードを出力する
+    （ManifestWriterと同じく partition_slices などの manifest に指定する）
+
+    Parameters:
+    output_dir (str): 出力先のフォルダ
+    window (tuple): CT値の (下限, 上限)
+    dtype (str): 保存するデータ型
+    shard_bytes (int): 1シャードあたりの最大バイト数
+    series (tuple): ペアにするシリーズ名 (入力, 目標)
+    manifest_path (str): マニフェストのパス．Noneの場合は output_dir/manifest.jsonl
+    """
+
+    def __init__(self, output_dir, window=DEFAULT_HU_WINDOW, dtype=DEFAULT_DTYPE, shard_bytes=DEFAULT_SHARD_BYTES,
+                 series=DEFAULT_SERIES, manifest_path=None):
+        self.output_dir = os.path.expanduser(output_dir)
+        super().__init__(manifest_path or os.path.join(self.output_dir, 'manifest.jsonl'))
+        self.window = tuple(float(v) for v in window)
+        self.dtype = np.dtype(dtype)
+        self.shard_bytes = shard_bytes
+        self.pair_series = tuple(series)
+
+    def regions(self):
+        """
+        記録された領域ラベルのリスト
+        """
+        return sorted({region for series_rows in self.series.values()
+                       for row in series_rows.values() for region in row['regions']})
+
+    def pairs_in_region(self, region):
+        """
+        領域に含まれるCT1/CT2のペアを (case, 入力の行, 目標の行) のリストで返す（ケース・ファイル名順）
+        """
+        source_series, target_series = self.pair_series
+        pairs = []
+        for case in self.cases():
+            source_rows = self.series.get((case, source_series), {})
+            target_rows = self.series.get((case, target_series), {})
+            for file_name in sorted(self.files_in_region(case, source_series, region)
+                                    & self.files_in_region(case, target_series, region)):
+                pairs.append((case, source_rows[file_name], target_rows[file_name]))
+        return pairs
+
+    def close(self):
+        super().close()
+        for region in self.regions():
+            self.export_region(region)
+
+    def export_region(self, region):
+        """
+        1領域分のシャードを書き出す（書き込み途中のフォルダを読まれないよう，完了後に置き換える）
+
+        Returns:
+        int: 書き出したペアの数
+        """
+        region_dir = os.path.join(self.output_dir, region)
+        tmp_dir = temp_path(region_dir)
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        pairs = self.pairs_in_region(region)
+        progress = ProgressReporter(f"shards:{region}")
+        shard, offset, shard_file = 0, 0, None
+        skipped = 0
+        with open(os.path.join(tmp_dir, 'index.jsonl'), 'w') as index_file:
+            try:
+                for case, source_row, target_row in pairs:
+                    source_dcm = pydicom.dcmread(source_row['source_path'])
+                    target_dcm = pydicom.dcmread(target_row['source_path'])
+                    source = normalize_slice(source_dcm, self.window, self.dtype)
+                    target = normalize_slice(target_dcm, self.window, self.dtype)
+                    if source.shape != target.shape:
+                        print(f"{case} {source_row['file_name']}: CT1とCT2の画像サイズが異なります "
+                              f"{source.shape} {target.shape}")
+                        skipped += 1
+                        continue
+
+                    nbytes = source.nbytes + target.nbytes
+                    if shard_file is None or (offset > 0 and offset + nbytes > self.shard_bytes):
+                        if shard_file is not None:
+                            shard_file.close()
+                            shard += 1
+                        shard_file = open(os.path.join(tmp_dir, f'shard-{shard:05}.bin'), 'wb')
+                        offset = 0
+                    shard_file.write(source.tobytes())
+                    shard_file.write(target.tobytes())
+
+                    entry = {
+                        'shard': shard,
+                        'offset': offset,
+                        'rows': source.shape[0],
+                        'columns': source.shape[1],
+                        'case': case,
+                        'file_name': source_row['file_name'],
+                        'z_index': source_row['z_index'],
+                        'overlap': len(source_row['regions']) > 1,
+                        'source_paths': [source_row['source_path'], target_row['source_path']],
+                    }
+                    entry.update(_slice_metadata(target_dcm))
+                    index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    offset += nbytes
+                    progress.update(2, nbytes)
+            finally:
+                if shard_file is not None:
+                    shard_file.close()
+
+        count = len(pairs) - skipped
+        with open(os.path.join(tmp_dir, 'shards.json'), 'w') as f:
+            json.dump({'version': SHARD_VERSION, 'region': region, 'dtype': self.dtype.str,
+                       'series': list(self.pair_series), 'window': list(self.window), 'range': [-1.0, 1.0],
+                       'pairs': count, 'shards': shard + 1 if shard_file is not None else 0}, f, indent=2)
+
+        replace_path(tmp_dir, region_dir)
+        progress.close()
+        print(f"Shards saved: {region_dir} ({count} pairs, {skipped} skipped)")
+        return count
+
+
+class SliceShards:
+    """
+    ShardWriterで書き出した1領域分のシャードを読み込む（シャードはメモリマップで開く）
+
+    Parameters:
+    region_dir (str): 領域のフォルダ (例: '~/dataset_shards/upper')
+    """
+
+    def __init__(self, region_dir):
+        self.region_dir = os.path.expanduser(region_dir)
+        with open(os.path.join(self.region_dir, 'shards.json'), 'r') as f:
+            self.header = json.load(f)
+        if self.header.get('version') != SHARD_VERSION:
+            raise ValueError(f"Unsupported shard version in {self.region_dir}: {self.header.get('version')}")
+        self.dtype = np.dtype(self.header['dtype'])
+        with open(os.path.join(self.region_dir, 'index.jsonl'), 'r') as f:
+            self.index = [json.loads(line) for line in f if line.strip()]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+        # ワーカープロセスごとに遅延して開く（fork後も各プロセスでページキャッシュを共有）
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(os.path.join(self.region_dir, f'shard-{shard:05}.bin'),
+                                            dtype=self.dtype, mode='r')
+        return self._shards[shard]
+
+    def __getitem__(self, i):
+        """
+        i番目のペアを (CT1, CT2) の (rows, columns) の配列で返す（メモリマップのビュー）
+        """
+        entry = self.index[i]
+        start = entry['offset'] // self.dtype.itemsize
+        size = entry['rows'] * entry['columns']
+        pair = self._shard(entry['shard'])[start:start + 2 * size].reshape(2, entry['rows'], entry['columns'])
+        return pair[0], pair[1]
+
+    def metadata(self, i):
+        """
+        i番目のペアのメタデータ（ケース名・ファイル名・スライス位置など）
+        """
+        return self.index[i]
+
+
+if __name__ == "__main__":
+    from slicepartitioning import partition_slices
+
+    src_dir = '~/dataset'
+    regions = [
+        ('~/totalSegmentator/organSeg/dataset_thyroidgland', '~/dataset_upper', 'thyroid_gland', True),
+        ('~/totalSegmentator/organSeg/dataset_wholelung', '~/dataset_middle', 'whole_lung', False),
+        ('~/totalSegmentator/organSeg/dataset_kidney', '~/dataset_lower', 'kidney', False),
+    ]
+
+    # フォルダを作成せず，領域ごとのシャードを出力（dataset_shards/upper, middle, lower）
+    with ShardWriter('~/dataset_shards') as shards:
+        partition_slices(regions, src_dir, manifest=shards)
+
+    # CT値のウィンドウやデータ型を変える場合
+    # with ShardWriter('~/dataset_shards', window=(-200, 300), dtype='float32') as shards:
+    #     partition_slices(regions, src_dir, manifest=shards)
+
+    # 学習時の読み込み
+    # upper = SliceShards('~/dataset_shards/upper')
+    # ct1, ct2 = upper[0]
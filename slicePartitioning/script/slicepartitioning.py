@@ -1,8 +1,167 @@
 import os
-import shutil
-import nibabel as nib
+import numpy as np
+from extent_index import ExtentIndex, mask_available
+from volume_cache import load_mask_extent
+from materialize import Materializer, DEFAULT_MATERIALIZE_WORKERS
+from manifest import region_label
+from series_index import load_series_index
+from partition_planner import plan_from_occupancies, interval_to_occupancy
+import script_paths  # noqa: F401
+from case_runner import new_case_result, log_case_message, run_cases, summarize_results
+from instrumentation import measure_stage, ProgressReporter
 
-def copy_slices_up_to_segmentation(nifti_dir, src_dir, dst_dir, organ_name, copy_all=False):
+def _place_slice(materializer, result, region, case, series, file_name, src_path, dst_path, z_index,
+                 record_manifest):
+    # マニフェストを出力する場合はファイルを配置せず記録のみ行う
+    # （ファイルごとには表示せず，進捗は呼び出し元のProgressReporterでまとめて表示）
+    if record_manifest:
+        result['manifest_rows'].append((case, series, file_name, src_path, int(z_index), region))
+    else:
+        materializer.submit(src_path, dst_path)
+    result['files'] += 1
+
+def copy_case_slices(case_folder, nifti_dir, src_dir, dst_dir, organ_name, copy_all=False, extent_index=None,
+                     materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                     record_manifest=False, verbose=True, use_series_index=True, series_index_cache=None,
+                     volume_cache=None, result=None):
+    """
+    1ケース分のスライスをコピーする（copy_slices_up_to_segmentationからケースごとに呼び出される）
+
+    Parameters:
+    case_folder (str): nifti_dir内のケースフォルダ名 (例: case01_CT2)
+    record_manifest (bool): Trueの場合はファイルを配置せず，マニフェストの行を結果に記録
+    verbose (bool): Trueの場合はメッセージを逐次表示
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+    その他はcopy_slices_up_to_segmentationと同じ
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)
+    """
+    case_name = case_folder.replace('_CT2', '')
+    if result is None:
+        result = new_case_result(case_name)
+    nifti_case_path = os.path.join(nifti_dir, case_folder)
+
+    with measure_stage(result, f"copy:{region_label(dst_dir)}") as metrics:
+        # NIfTIファイルのパスを生成
+        file_path = os.path.join(nifti_case_path, f'{organ_name}_{case_folder}.nii.gz')
+        # z範囲のみを記録したマスク (extents_only) はインデックスのエントリを使う
+        if not mask_available(file_path, extent_index):
+            result['status'] = 'skipped'
+            log_case_message(result, f"NIfTI file {file_path} does not exist", verbose)
+            return result
+
+        # スライスごとのセグメンテーションの有無を取得（float64に展開せずスラブ単位で読み込む）
+        affine = None
+        if extent_index is not None:
+            with metrics.decoding():
+                slices_with_segmentation = extent_index.get_slice_occupancy(file_path)
+                if use_series_index:
+                    affine = extent_index.get_geometry(file_path)[1]
+            result['extent_entries'][extent_index.index_path] = extent_index.updated
+        else:
+            with metrics.decoding(*([file_path] if volume_cache is None else [])):
+                slices_with_segmentation, _, mask_affine = load_mask_extent(file_path, volume_cache)
+            if use_series_index:
+                affine = mask_affine
+
+        materializer = Materializer(materialize_method, materialize_workers)
+        try:
+            return place_case_slices(case_name, slices_with_segmentation, src_dir, dst_dir, copy_all,
+                                     record_manifest=record_manifest, verbose=verbose, result=result,
+                                     affine=affine, series_index_cache=series_index_cache,
+                                     materializer=materializer)
+        finally:
+            materializer.close()
+            metrics.add_materializer(materializer)
+
+def place_case_slices(case_name, slices_with_segmentation, src_dir, dst_dir, copy_all=False,
+                      materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                      record_manifest=False, verbose=True, result=None, affine=None, series_index_cache=None,
+                      materializer=None):
+    """
+    スライスごとのセグメンテーションの有無から，1ケース分のスライスをコピーする
+
+    Parameters:
+    case_name (str): ケース名 (src_dir内のケースフォルダ名)
+    slices_with_segmentation (numpy.ndarray): zスライスごとのセグメンテーションの有無 (bool配列)
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+    affine (numpy.ndarray): マスクのaffine．指定した場合はシリーズのインデックス(series_index)でスライス位置から
+                            ファイルを求める．Noneの場合はzインデックスiのファイルを {total_slices - i:08}.DCM とする
+    series_index_cache (str): シリーズのインデックスを保存するフォルダ
+    materializer (Materializer): 指定した場合はそのMaterializerで配置する（closeは呼び出し元で行う）
+    その他はcopy_case_slicesと同じ
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)
+    """
+    if result is None:
+        result = new_case_result(case_name)
+    region = region_label(dst_dir)
+    segmented_indices = np.flatnonzero(slices_with_segmentation)
+
+    # 対応するケースフォルダのコピー元とコピー先パスを指定
+    src_case_path = os.path.join(src_dir, case_name)
+    dst_case_path = os.path.join(dst_dir, case_name)
+
+    if not os.path.exists(src_case_path):
+        result['status'] = 'skipped'
+        log_case_message(result, f"Source case folder {src_case_path} does not exist", verbose)
+        return result
+
+    # ケースフォルダをコピー先に作成
+    if not record_manifest:
+        os.makedirs(dst_case_path, exist_ok=True)
+
+    # コピーするスライスのzインデックス
+    total_slices = len(slices_with_segmentation)
+    if copy_all and segmented_indices.size:
+        # 最も下のセグメンテーションスライスから上端のスライス(00000001.DCM)まで全スライスをコピー
+        z_indices = np.arange(segmented_indices[0], total_slices)
+    else:
+        # セグメンテーションスライスのみをコピー
+        z_indices = segmented_indices
+
+    own_materializer = materializer is None
+    if own_materializer:
+        materializer = Materializer(materialize_method, materialize_workers)
+    try:
+        # CTフォルダごとにコピーを実行
+        for ct in os.listdir(src_case_path):
+            ct_path = os.path.join(src_case_path, ct)
+            if os.path.isdir(ct_path):
+                ct_dst_path = os.path.join(dst_case_path, ct)
+                if not record_manifest:
+                    os.makedirs(ct_dst_path, exist_ok=True)
+
+                # スライス位置に基づいてファイルを求める（ファイルごとの存在確認は不要）
+                if affine is not None:
+                    series_index = load_series_index(ct_path, series_index_cache)
+                    dcm_filenames = series_index.files_for_z_indices(z_indices, affine, total_slices)
+                else:
+                    dcm_filenames = [f"{total_slices - i:08}.DCM" for i in z_indices]
+
+                for i, dcm_filename in zip(z_indices, dcm_filenames):
+                    if dcm_filename is None:
+                        log_case_message(result, f"No DICOM file for z index {i} in {ct_path}", verbose)
+                        continue
+                    src_dcm_path = os.path.join(ct_path, dcm_filename)
+                    dst_dcm_path = os.path.join(ct_dst_path, dcm_filename)
+                    if affine is None and not os.path.exists(src_dcm_path):
+                        log_case_message(result, f"File {src_dcm_path} does not exist", verbose)
+                        continue
+                    _place_slice(materializer, result, region, case_name, ct, dcm_filename,
+                                 src_dcm_path, dst_dcm_path, i, record_manifest)
+    finally:
+        if own_materializer:
+            materializer.close()
+
+    return result
+
+def copy_slices_up_to_segmentation(nifti_dir, src_dir, dst_dir, organ_name, copy_all=False, use_extent_index=True,
+                                   materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                                   manifest=None, num_workers=1, verbose=None, use_series_index=True,
+                                   series_index_cache=None, metrics=None, volume_cache=None):
     """
     Parameters:
     nifti_dir (str): NIfTI形式の臓器セグメンテーションファイルが格納されているフォルダのパス
@@ -10,192 +169,451 @@ def copy_slices_up_to_segmentation(nifti_dir, src_dir, dst_dir, organ_name, copy
     dst_dir (str): コピー先のフォルダのパス
     organ_name (str): 臓器名 ('thyroid_gland', 'whole_lung', 'kidney' など)
     copy_all (bool): Trueの場合、セグメンテーションスライスに到達するまでの全スライスをコピー
+    use_extent_index (bool): Trueの場合、nifti_dirのz範囲インデックス(extent_index.json)を利用・更新
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    materialize_workers (int): 配置を並列に行うスレッド数
+    manifest (ManifestWriter): 指定した場合はフォルダを作成せず，マニフェストに領域ラベル(dst_dirの末尾 例: upper)を記録
+    num_workers (int): ケースを並列に処理するプロセス数（1の場合は逐次処理）
+    verbose (bool): メッセージを逐次表示するか（Noneの場合は逐次処理のときのみ表示）
+    use_series_index (bool): Trueの場合，DICOMのヘッダのスライス位置とマスクのaffineからファイルを求める
+                             Falseの場合はファイル名の連番 (00000001.DCM~) で対応付ける
+    series_index_cache (str): シリーズのインデックスを保存するフォルダ（Noneの場合はプロセス内のみでキャッシュ）
+    metrics (MetricsWriter): 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    volume_cache (str): 指定した場合はマスクを非圧縮のキャッシュ (volume_cache) に展開し，以降はメモリマップで読み込む
+
+    Returns:
+    dict: 集計結果 (case_runner.summarize_results)
     """
-    
+    if verbose is None:
+        verbose = num_workers is None or num_workers <= 1
+
     # コピー先のディレクトリが存在しない場合は作成
-    if not os.path.exists(dst_dir):
+    if manifest is None and not os.path.exists(dst_dir):
         os.makedirs(dst_dir)
 
+    # z範囲インデックスを読み込む（変更のないマスクは再読み込みしない）
+    extent_index = ExtentIndex(nifti_dir, volume_cache=volume_cache) if use_extent_index else None
+    parallel = num_workers is not None and num_workers > 1
+
     # ケースフォルダごとに処理を実行
-    for case_folder in os.listdir(nifti_dir):
+    # z範囲のみを記録したケース (extents_only) はケースフォルダがなくても処理する
+    case_folders = {case_folder for case_folder in os.listdir(nifti_dir)
+                    if os.path.isdir(os.path.join(nifti_dir, case_folder))}
+    if extent_index is not None:
+        case_folders |= extent_index.extents_only_folders()
+
+    tasks = []
+    for case_folder in sorted(case_folders):
         nifti_case_path = os.path.join(nifti_dir, case_folder)
-        
-        # NIfTIファイルのパスを生成
-        file_path = os.path.join(nifti_case_path, f'{organ_name}_{case_folder}.nii.gz')
-        if not os.path.exists(file_path):
-            print(f"NIfTI file {file_path} does not exist")
-            continue
-        
-        img = nib.load(file_path)
-        data = img.get_fdata()
 
-        # スライス番号を取得
-        slices_with_segmentation = [1 if data[:, :, i].sum() > 0 else 'none' for i in range(data.shape[2])]
+        # ワーカープロセスにはそのケースのエントリだけを渡す
+        case_index = extent_index
+        if extent_index is not None and parallel:
+            case_index = extent_index.subset([os.path.join(nifti_case_path, f'{organ_name}_{case_folder}.nii.gz')])
+
+        tasks.append((case_folder.replace('_CT2', ''),
+                      (case_folder, nifti_dir, src_dir, dst_dir, organ_name),
+                      dict(copy_all=copy_all, extent_index=case_index,
+                           materialize_method=materialize_method, materialize_workers=materialize_workers,
+                           record_manifest=manifest is not None, verbose=verbose,
+                           use_series_index=use_series_index, series_index_cache=series_index_cache,
+                           volume_cache=volume_cache)))
+
+    progress = ProgressReporter(f"copy:{region_label(dst_dir)}", len(tasks))
+    results = []
+    for result in run_cases(copy_case_slices, tasks, num_workers):
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+        if extent_index is not None and parallel:
+            extent_index.merge(result['extent_entries'].get(extent_index.index_path, {}))
+        if manifest is not None:
+            for row in result['manifest_rows']:
+                manifest.add(*row)
+        results.append(result)
+    progress.close()
+
+    if extent_index is not None:
+        extent_index.save()
+
+    print("Dataset copy complete.")
+    return summarize_results(results, os.path.basename(os.path.normpath(dst_dir)))
+
+def _mask_path(nifti_dir, case_name, organ_name):
+    return os.path.join(nifti_dir, f'{case_name}_CT2', f'{organ_name}_{case_name}_CT2.nii.gz')
+
+def partition_case_slices(case_name, regions, src_dir, margin=0, extend_bottom=False, extent_indexes=None,
+                          materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                          record_manifest=False, verbose=True, use_series_index=True, series_index_cache=None,
+                          volume_cache=None, result=None):
+    """
+    1ケース分のスライスを全領域に分割する（partition_slicesからケースごとに呼び出される）
+
+    Parameters:
+    case_name (str): src_dir内のケースフォルダ名 (例: case01)
+    extent_indexes (list): 領域ごとのz範囲インデックス（Noneの場合はマスクを直接読み込む）
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+    その他はpartition_slicesと同じ
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)
+    """
+    if result is None:
+        result = new_case_result(case_name)
+
+    with measure_stage(result, 'partition') as metrics:
+        # 領域ごとのスライスごとのセグメンテーションの有無とaffine
+        occupancies, affines = [], []
+        for k, (nifti_dir, _, organ_name, _) in enumerate(regions):
+            file_path = _mask_path(nifti_dir, case_name, organ_name)
+            extent_index = extent_indexes[k] if extent_indexes is not None else None
+            if not mask_available(file_path, extent_index):
+                log_case_message(result, f"NIfTI file {file_path} does not exist", verbose)
+                occupancies.append(None)
+                affines.append(None)
+                continue
+
+            if extent_index is not None:
+                with metrics.decoding():
+                    occupancies.append(extent_index.get_slice_occupancy(file_path))
+                    affines.append(extent_index.get_geometry(file_path)[1])
+                result['extent_entries'][extent_index.index_path] = extent_index.updated
+            else:
+                with metrics.decoding(*([file_path] if volume_cache is None else [])):
+                    occupancy, _, affine = load_mask_extent(file_path, volume_cache)
+                occupancies.append(occupancy)
+                affines.append(affine)
+
+        if all(occupancy is None for occupancy in occupancies):
+            result['status'] = 'skipped'
+            return result
+
+        # ファイルを配置する前に全領域のz区間を求める
+        intervals, n_slices = plan_from_occupancies(occupancies, margin, [region[3] for region in regions],
+                                                    extend_bottom)
+
+        # 全領域の配置を1回で行う
+        materializer = Materializer(materialize_method, materialize_workers)
+        try:
+            for (_, dst_dir, _, _), interval, affine in zip(regions, intervals, affines):
+                if interval is None:
+                    continue
+                place_case_slices(case_name, interval_to_occupancy(interval, n_slices), src_dir, dst_dir,
+                                  record_manifest=record_manifest, verbose=verbose, result=result,
+                                  affine=affine if use_series_index else None,
+                                  series_index_cache=series_index_cache, materializer=materializer)
+        finally:
+            materializer.close()
+            metrics.add_materializer(materializer)
 
-        # 対応するケースフォルダのコピー元とコピー先パスを指定
-        src_case_path = os.path.join(src_dir, case_folder.replace('_CT2', ''))
-        dst_case_path = os.path.join(dst_dir, case_folder.replace('_CT2', ''))
+        return result
 
-        if not os.path.exists(src_case_path):
-            print(f"Source case folder {src_case_path} does not exist")
+def partition_slices(regions, src_dir, margin=0, extend_bottom=False, use_extent_index=True,
+                     materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                     manifest=None, num_workers=1, verbose=None, use_series_index=True, series_index_cache=None,
+                     metrics=None, volume_cache=None):
+    """
+    臓器のz範囲から全領域のz区間を求めてデータセットを分割する
+    （copy_slices_up_to_segmentation と find_and_copy_missing_files をまとめて行う）
+
+    Parameters:
+    regions (list): 上の領域から順に (nifti_dir, dst_dir, organ_name, copy_all)
+                    nifti_dir: 臓器セグメンテーションのフォルダ, dst_dir: コピー先のフォルダ,
+                    organ_name: 臓器名, copy_all: 上端のスライスまで含めるか
+    src_dir (str): コピー元のフォルダのパス
+    margin (int): 隣り合う領域と重複させるスライス数（0の場合は間のスライスを補うのみ）
+    extend_bottom (bool): 最後の領域を下端のスライスまで含めるか
+    use_extent_index (bool): Trueの場合、nifti_dirのz範囲インデックス(extent_index.json)を利用・更新
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    materialize_workers (int): 配置を並列に行うスレッド数
+    manifest (ManifestWriter): 指定した場合はフォルダを作成せず，マニフェストに領域ラベル(dst_dirの末尾 例: upper)を記録
+    num_workers (int): ケースを並列に処理するプロセス数（1の場合は逐次処理）
+    verbose (bool): メッセージを逐次表示するか（Noneの場合は逐次処理のときのみ表示）
+    use_series_index (bool): Trueの場合，DICOMのヘッダのスライス位置とマスクのaffineからファイルを求める
+    series_index_cache (str): シリーズのインデックスを保存するフォルダ（Noneの場合はプロセス内のみでキャッシュ）
+    metrics (MetricsWriter): 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    volume_cache (str): 指定した場合はマスクを非圧縮のキャッシュ (volume_cache) に展開し，以降はメモリマップで読み込む
+
+    Returns:
+    dict: 集計結果 (case_runner.summarize_results)
+    """
+    parallel = num_workers is not None and num_workers > 1
+    if verbose is None:
+        verbose = not parallel
+
+    # コピー先のディレクトリが存在しない場合は作成
+    if manifest is None:
+        for _, dst_dir, _, _ in regions:
+            os.makedirs(dst_dir, exist_ok=True)
+
+    # 臓器データセットごとのz範囲インデックス（変更のないマスクは再読み込みしない）
+    extent_indexes = {}
+    if use_extent_index:
+        for nifti_dir, _, _, _ in regions:
+            if nifti_dir not in extent_indexes:
+                extent_indexes[nifti_dir] = ExtentIndex(nifti_dir, volume_cache=volume_cache)
+
+    tasks = []
+    for case_name in sorted(os.listdir(src_dir)):
+        if not os.path.isdir(os.path.join(src_dir, case_name)):
             continue
 
-        # ケースフォルダをコピー先に作成
-        if not os.path.exists(dst_case_path):
-            os.makedirs(dst_case_path)
+        case_indexes = None
+        if use_extent_index:
+            case_indexes = dict(extent_indexes)
+            if parallel:
+                # ワーカープロセスにはそのケースのエントリだけを渡す
+                case_indexes = {nifti_dir: index.subset([_mask_path(nifti_dir, case_name, organ_name)
+                                                         for region_dir, _, organ_name, _ in regions
+                                                         if region_dir == nifti_dir])
+                                for nifti_dir, index in extent_indexes.items()}
+            case_indexes = [case_indexes[nifti_dir] for nifti_dir, _, _, _ in regions]
 
-        # CTフォルダごとにコピーを実行
-        for ct in os.listdir(src_case_path):
-            ct_path = os.path.join(src_case_path, ct)
-            if os.path.isdir(ct_path):
-                ct_dst_path = os.path.join(dst_case_path, ct)
-                if not os.path.exists(ct_dst_path):
-                    os.makedirs(ct_dst_path)
-
-                # スライス番号に基づいてファイルをコピー
-                total_slices = len(slices_with_segmentation)
-                for i, val in enumerate(slices_with_segmentation):
-                    if val == 1:
-                        reversed_index = total_slices - i
-                        if copy_all:
-                            # 00000001.DCM~セグメンテーションスライスまで全スライスをコピー
-                            for j in range(1, reversed_index + 1):
-                                dcm_filename = f"{j:08}.DCM"
-                                src_dcm_path = os.path.join(ct_path, dcm_filename)
-                                dst_dcm_path = os.path.join(ct_dst_path, dcm_filename)
-                                if os.path.exists(src_dcm_path):
-                                    shutil.copy(src_dcm_path, dst_dcm_path)
-                                    print(f"Copied {src_dcm_path} to {dst_dcm_path}")
-                                else:
-                                    print(f"File {src_dcm_path} does not exist")
-                            break
-                        else:
-                            # セグメンテーションスライスのみをコピー
-                            dcm_filename = f"{reversed_index:08}.DCM"
-                            src_dcm_path = os.path.join(ct_path, dcm_filename)
-                            dst_dcm_path = os.path.join(ct_dst_path, dcm_filename)
-                            if os.path.exists(src_dcm_path):
-                                shutil.copy(src_dcm_path, dst_dcm_path)
-                                print(f"Copied {src_dcm_path} to {dst_dcm_path}")
-                            else:
-                                print(f"File {src_dcm_path} does not exist")
+        tasks.append((case_name, (case_name, regions, src_dir),
+                      dict(margin=margin, extend_bottom=extend_bottom, extent_indexes=case_indexes,
+                           materialize_method=materialize_method, materialize_workers=materialize_workers,
+                           record_manifest=manifest is not None, verbose=verbose,
+                           use_series_index=use_series_index, series_index_cache=series_index_cache,
+                           volume_cache=volume_cache)))
+
+    progress = ProgressReporter('partition', len(tasks))
+    results = []
+    for result in run_cases(partition_case_slices, tasks, num_workers):
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+        if parallel:
+            for index in extent_indexes.values():
+                index.merge(result['extent_entries'].get(index.index_path, {}))
+        if manifest is not None:
+            for row in result['manifest_rows']:
+                manifest.add(*row)
+        results.append(result)
+    progress.close()
+
+    for index in extent_indexes.values():
+        index.save()
 
     print("Dataset copy complete.")
+    return summarize_results(results, 'partition')
 
-def find_and_copy_missing_files(folder1, folder2, alldata_folder):
+def find_and_copy_missing_files(folder1, folder2, alldata_folder,
+                                materialize_method='copy', materialize_workers=DEFAULT_MATERIALIZE_WORKERS,
+                                manifest=None, metrics=None, verbose=False, series_index_cache=None):
     """
     フォルダに重複がある場合何もせず．
     フォルダに重複がない場合は, alldataフォルダから重複していない領域をコピーする関数
 
     ※注意
     folder1, folder2, alldata_folder全てに同じフォルダ(caseフォルダ)が含まれている必要があります．
+
+    materialize_method (str): ファイルの配置方法 ('copy', 'hardlink', 'reflink', 'symlink')
+    materialize_workers (int): 配置を並列に行うスレッド数
+    manifest (ManifestWriter): 指定した場合はフォルダの代わりにマニフェストの領域(folder1, folder2の末尾 例: upper)を参照・追記
+    metrics (MetricsWriter): 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    verbose (bool): Trueの場合はファイルごとのメッセージも逐次表示（Falseの場合はケースごとにまとめて表示）
+    series_index_cache (str): 指定した場合はalldataのシリーズのインデックスをこのフォルダにキャッシュ
+
+    Returns:
+    dict: 集計結果 (case_runner.summarize_results)
     """
+    stage = f"gap_fill:{region_label(folder1)}-{region_label(folder2)}"
+
     # folder1とfolder2の中に含まれるcaseフォルダを取得
-    case_folders = os.listdir(folder1)
-    
+    case_folders = sorted(manifest.cases() if manifest is not None else os.listdir(folder1))
+
+    progress = ProgressReporter(stage, len(case_folders))
+    results = []
     for case_folder in case_folders:
-        folder1_case = os.path.join(folder1, case_folder)
-        folder2_case = os.path.join(folder2, case_folder)
-        alldata_case = os.path.join(alldata_folder, case_folder)
-        
-        if not (os.path.exists(folder1_case) and os.path.exists(folder2_case) and os.path.exists(alldata_case)):
-            print(f"{case_folder} がどちらかのフォルダに存在しません")
-            continue
+        result = new_case_result(case_folder)
+        with measure_stage(result, stage) as stage_metrics:
+            materializer = Materializer(materialize_method, materialize_workers)
+            try:
+                fill_case_gaps(case_folder, folder1, folder2, alldata_folder, materializer, manifest,
+                               result=result, verbose=verbose, series_index_cache=series_index_cache)
+            finally:
+                materializer.close()
+                stage_metrics.add_materializer(materializer)
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+        results.append(result)
+    progress.close()
+
+    print("Dataset copy complete")
+    return summarize_results(results, stage)
+
+def find_gap_files(folder1_files, folder2_files, ordered_files=None):
+    """
+    2つの領域のDCMファイル名の集合から，間にある（どちらにも含まれない）ファイル名を返す
+    重複するファイルがある場合は空のリストを返す
+
+    ordered_files (list): シリーズ全体のスライス位置順のファイル名 (SeriesIndex.ordered_files)．
+                          Noneの場合はファイル名の連番 ({j:08}.DCM) で求める
+    """
+    if folder1_files & folder2_files:
+        return []
 
-        # CT1とCT2フォルダを取得
-        ct_folders = ['CT1', 'CT2']
-        
-        # # testの場合はCT1, CT2, CT3となります
-        # ct_folders = ['CT1', 'CT2', 'CT3']
-
-        for ct_folder in ct_folders:
-            folder1_ct = os.path.join(folder1_case, ct_folder)
-            folder2_ct = os.path.join(folder2_case, ct_folder)
-            alldata_ct = os.path.join(alldata_case, ct_folder)
-            
-            if not (os.path.exists(folder1_ct) and os.path.exists(folder2_ct) and os.path.exists(alldata_ct)):
-                print(f"{ct_folder} が {case_folder} のいずれかに存在しません")
+    # 重複していないファイルを探す
+    all_files = sorted(folder1_files | folder2_files)
+    if not all_files:
+        return []
+
+    if ordered_files is not None:
+        positions = [k for k, file_name in enumerate(ordered_files) if file_name in folder1_files | folder2_files]
+        if not positions:
+            return []
+        return [file_name for file_name in ordered_files[positions[0]:positions[-1] + 1]
+                if file_name not in folder1_files and file_name not in folder2_files]
+
+    # all_files の間にある連番を探す
+    missing_files = []
+    for i in range(int(all_files[0].split('.')[0]), int(all_files[-1].split('.')[0])):
+        file_name = f"{i:08d}.DCM"
+        if file_name not in all_files:
+            missing_files.append(file_name)
+    return missing_files
+
+def fill_case_gaps(case_folder, folder1, folder2, alldata_folder, materializer, manifest=None, result=None,
+                   verbose=False, series_index_cache=None):
+    """
+    1ケース分について，folder1とfolder2の間の重複していない領域をalldataフォルダからコピーする
+    （find_and_copy_missing_filesからケースごとに呼び出される）
+
+    Parameters:
+    case_folder (str): ケースフォルダ名
+    materializer (Materializer): ファイルの配置に使うMaterializer
+    result (dict): 処理結果を追記する場合に指定 (case_runner.new_case_result)
+    verbose (bool): Trueの場合はファイルごとのメッセージも逐次表示
+    その他はfind_and_copy_missing_filesと同じ
+
+    Returns:
+    dict: ケースの処理結果 (case_runner.new_case_result)．ケースごとの集計を1行表示する
+    """
+    if result is None:
+        result = new_case_result(case_folder)
+    region1 = region_label(folder1)
+    region2 = region_label(folder2)
+    folder1_case = os.path.join(folder1, case_folder)
+    folder2_case = os.path.join(folder2, case_folder)
+    alldata_case = os.path.join(alldata_folder, case_folder)
+
+    if manifest is not None:
+        if not os.path.exists(alldata_case):
+            result['status'] = 'skipped'
+            log_case_message(result, f"{case_folder} が {alldata_folder} に存在しません", verbose)
+            return result
+    elif not (os.path.exists(folder1_case) and os.path.exists(folder2_case) and os.path.exists(alldata_case)):
+        result['status'] = 'skipped'
+        log_case_message(result, f"{case_folder} がどちらかのフォルダに存在しません", verbose)
+        return result
+
+    # CT1とCT2フォルダを取得
+    ct_folders = ['CT1', 'CT2']
+
+    # # testの場合はCT1, CT2, CT3となります
+    # ct_folders = ['CT1', 'CT2', 'CT3']
+
+    # シリーズごとの補ったスライス数（ケースごとにまとめて表示する）
+    summary = []
+    for ct_folder in ct_folders:
+        folder1_ct = os.path.join(folder1_case, ct_folder)
+        folder2_ct = os.path.join(folder2_case, ct_folder)
+        alldata_ct = os.path.join(alldata_case, ct_folder)
+
+        if manifest is not None:
+            # マニフェストに記録された領域ごとのファイルリストを取得
+            folder1_files = manifest.files_in_region(case_folder, ct_folder, region1)
+            folder2_files = manifest.files_in_region(case_folder, ct_folder, region2)
+            if not (folder1_files and folder2_files and os.path.exists(alldata_ct)):
+                log_case_message(result, f"{ct_folder} が {case_folder} のいずれかに存在しません", verbose)
+                summary.append(f"{ct_folder}: not found")
                 continue
-            
+        elif not (os.path.exists(folder1_ct) and os.path.exists(folder2_ct) and os.path.exists(alldata_ct)):
+            log_case_message(result, f"{ct_folder} が {case_folder} のいずれかに存在しません", verbose)
+            summary.append(f"{ct_folder}: not found")
+            continue
+        else:
             # folder1_ct, folder2_ctに含まれるファイルリストを取得
             folder1_files = set(os.listdir(folder1_ct))
             folder2_files = set(os.listdir(folder2_ct))
-            
-            # DCMファイルだけを対象にする
-            folder1_files = {file for file in folder1_files if file.endswith('.DCM')}
-            folder2_files = {file for file in folder2_files if file.endswith('.DCM')}
-            
-            # 重複しているファイルを確認
-            common_files = folder1_files & folder2_files
-            if common_files:
-                # 重複ファイルがあれば何もしない
-                print(f"{ct_folder} in {case_folder}: 重複ファイルが見つかりました: {common_files}")
-                continue
+
+        # DCMファイルだけを対象にする
+        folder1_files = {file for file in folder1_files if file.endswith('.DCM')}
+        folder2_files = {file for file in folder2_files if file.endswith('.DCM')}
+
+        # 重複しているファイルを確認
+        common_files = folder1_files & folder2_files
+        if common_files:
+            # 重複ファイルがあれば何もしない
+            log_case_message(result, f"{ct_folder} in {case_folder}: 重複ファイルが見つかりました: {sorted(common_files)}",
+                             verbose)
+            summary.append(f"{ct_folder}: {len(common_files)} overlapping")
+            continue
+
+        # 間のスライスはalldataのシリーズのスライス位置の順で求める（ファイル名の命名規則に依存しない）
+        series_index = load_series_index(alldata_ct, series_index_cache)
+        missing_files = find_gap_files(folder1_files, folder2_files, series_index.ordered_files())
+
+        # missing_files を alldata_folder からコピーする
+        filled = not_found = 0
+        for file_name in missing_files:
+            src_path = os.path.join(alldata_ct, file_name)
+            if manifest is not None:
+                # 両方の領域に追加（重複領域として記録される）
+                z_index = manifest.z_index_of(case_folder, ct_folder, file_name, series_index)
+                manifest.add(case_folder, ct_folder, file_name, src_path, z_index, region1)
+                manifest.add(case_folder, ct_folder, file_name, src_path, z_index, region2)
+            elif os.path.exists(src_path):
+                materializer.submit(src_path, folder1_ct)  # folder1のCTフォルダにコピー
+                materializer.submit(src_path, folder2_ct)  # folder2のCTフォルダにもコピー
+                if verbose:
+                    print(f"{file_name} を {folder1_ct} と {folder2_ct} にコピーしました")
             else:
-                # 重複していないファイルを探す
-                all_files = sorted(folder1_files | folder2_files)
-                
-                # all_files の間にある連番を探す
-                missing_files = []
-                for i in range(int(all_files[0].split('.')[0]), int(all_files[-1].split('.')[0])):
-                    file_name = f"{i:08d}.DCM"
-                    if file_name not in all_files:
-                        missing_files.append(file_name)
-
-                # missing_files を alldata_folder からコピーする
-                for file_name in missing_files:
-                    src_path = os.path.join(alldata_ct, file_name)
-                    if os.path.exists(src_path):
-                        shutil.copy(src_path, folder1_ct)  # folder1のCTフォルダにコピー
-                        shutil.copy(src_path, folder2_ct)  # folder2のCTフォルダにもコピー
-                        print(f"{file_name} を {folder1_ct} と {folder2_ct} にコピーしました")
-                    else:
-                        print(f"{file_name} が {alldata_ct} に存在しません")
+                log_case_message(result, f"{file_name} が {alldata_ct} に存在しません", verbose)
+                not_found += 1
+                continue
+            filled += 1
+            result['files'] += 2
+        summary.append(f"{ct_folder}: {filled} gap slices" + (f", {not_found} missing" if not_found else ""))
 
-    print("Dataset copy complete")
+    print(f"{case_folder} ({region1}/{region2}): {'; '.join(summary)}")
+    return result
+
+if __name__ == "__main__":
+    #入力フォルダ: dataset01 or dataset02 or test
+    src_dir = '~/dataset'
+
+    # 呼び出し例（num_workersを指定するとケースをプロセスプールで並列に処理）
+    # 上から順に (臓器セグメンテーションのフォルダ, コピー先のフォルダ, 臓器名, copy_all)
+    regions = [
+        ('~/totalSegmentator/organSeg/dataset_thyroidgland', '~/dataset_upper', 'thyroid_gland', True),  # 上部datset
+        ('~/totalSegmentator/organSeg/dataset_wholelung', '~/dataset_middle', 'whole_lung', False),  # 中部dataset
+        ('~/totalSegmentator/organSeg/dataset_kidney', '~/dataset_lower', 'kidney', False),  # 下部dataset
+    ]
+
+    # 各領域のz区間を求めてから1回で分割（隣り合う領域の間に重複がない場合は間のスライスを両方に含める）
+    # margin=5 とすると隣り合う領域と5スライスずつ重複させる
+    partition_slices(regions, src_dir, margin=0)
+
+    # ケースごとの処理時間・読み書きしたバイト数・ピーク時のRSSを記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     partition_slices(regions, src_dir, metrics=metrics)
+
+    # フォルダを作成せず，マニフェストのみを出力する場合
+    # from manifest import ManifestWriter
+    # with ManifestWriter('~/dataset_manifest.parquet') as manifest:
+    #     partition_slices(regions, src_dir, manifest=manifest)
+
+    # 学習用に正規化済みのCT1/CT2ペアのシャードを領域ごとに出力する場合 (slice_shards)
+    # from slice_shards import ShardWriter
+    # with ShardWriter('~/dataset_shards') as shards:
+    #     partition_slices(regions, src_dir, manifest=shards)
 
-#入力フォルダ: dataset01 or dataset02 or test
-src_dir = '~/dataset'
-
-# 呼び出し例
-
-# 上部datsetの作成
-copy_slices_up_to_segmentation(
-    nifti_dir='~/totalSegmentator/organSeg/dataset_thyroidgland',
-    src_dir = src_dir,
-    dst_dir='~/dataset_upper',
-    organ_name='thyroid_gland',
-    copy_all=True
-)
-
-# 中部datasetの作成
-copy_slices_up_to_segmentation(
-    nifti_dir='~/totalSegmentator/organSeg/dataset_wholelung',
-    src_dir = src_dir,
-    dst_dir='~/dataset_middle',
-    organ_name='whole_lung',
-    copy_all=False
-)
-
-# 下部datasetの作成
-copy_slices_up_to_segmentation(
-    nifti_dir='~/totalSegmentator/organSeg/dataset_kidney',
-    src_dir = src_dir,
-    dst_dir='~/dataset_lower',
-    organ_name='kidney',
-    copy_all=False  
-)
-
-# 上部データセットと中部データセットに対して重複領域の有無を確認
-find_and_copy_missing_files(
-    folder1 = '~/dataset_upper', 
-    folder2 = '~/dataset_middle', 
-    alldata_folder = '~/dataset_all' # 3領域分割前のデータセット
-)
-
-# 中部データセットと下部データセットに対して重複領域の有無を確認
-find_and_copy_missing_files(
-    folder1 = '~/dataset_lower', 
-    folder2 = '~/dataset_middle', 
-    alldata_folder = '~/dataset_all' 
-)
\ No newline at end of file
+    # 領域ごとにコピーしてから重複領域を確認する場合（従来の方法）
+    # copy_slices_up_to_segmentation('~/totalSegmentator/organSeg/dataset_thyroidgland', src_dir, '~/dataset_upper', 'thyroid_gland', copy_all=True)
+    # copy_slices_up_to_segmentation('~/totalSegmentator/organSeg/dataset_wholelung', src_dir, '~/dataset_middle', 'whole_lung')
+    # copy_slices_up_to_segmentation('~/totalSegmentator/organSeg/dataset_kidney', src_dir, '~/dataset_lower', 'kidney')
+    # find_and_copy_missing_files('~/dataset_upper', '~/dataset_middle', '~/dataset_all')
+    # find_and_copy_missing_files('~/dataset_lower', '~/dataset_middle', '~/dataset_all')
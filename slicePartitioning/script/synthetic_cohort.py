@@ -0,0 +1,148 @@
+import os
+import shutil
+import numpy as np
+import nibabel as nib
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+'''
+ベンチマーク用の合成データセットを作成するモジュール
+
+以下の構成でDICOMシリーズ（pydicom）と臓器マスク（nibabel）を作成する．
+    root/dataset/caseNN/CT1, CT2/{j:08}.DCM                          (00000001.DCMが最上部)
+    root/organSeg/dataset_{臓器名}/caseNN_CT2/{臓器名}_caseNN_CT2.nii.gz
+
+マスクのzインデックスkはファイル番号 j = n_slices - k のスライスに対応し，
+affineとImagePositionPatientのzも一致させる（series_indexでも対応付けられる）．
+'''
+
+# 臓器ごとのz範囲（スライス数に対する割合，下端が0）とorganSegのフォルダ名
+ORGAN_EXTENTS = {
+    'thyroid_gland': ('thyroidgland', 0.80, 0.86),
+    'whole_lung': ('wholelung', 0.50, 0.78),
+    'kidney': ('kidney', 0.15, 0.30),
+    'aorta': ('aorta', 0.45, 0.83),
+    'liver': ('liver', 0.25, 0.55),
+}
+
+SLICE_THICKNESS = 1.0
+PIXEL_SPACING = 0.8
+
+
+def _write_slice(path, pixels, z, instance, series_uid, study_uid):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dcm = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    dcm.SOPClassUID = CTImageStorage
+    dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dcm.StudyInstanceUID = study_uid
+    dcm.SeriesInstanceUID = series_uid
+    dcm.Modality = 'CT'
+    dcm.InstanceNumber = instance
+    dcm.ImagePositionPatient = [0.0, 0.0, float(z)]
+    dcm.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dcm.PixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+    dcm.SliceThickness = SLICE_THICKNESS
+    dcm.Rows, dcm.Columns = pixels.shape
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 0
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = 'MONOCHROME2'
+    dcm.RescaleSlope = 1
+    dcm.RescaleIntercept = -1024
+    dcm.PixelData = pixels.tobytes()
+    dcm.is_little_endian = True
+    dcm.is_implicit_VR = False
+    dcm.save_as(path)
+
+
+def mask_affine():
+    # zインデックスkの患者座標zは k * SLICE_THICKNESS（DICOMのImagePositionPatientと一致）
+    return np.diag([-PIXEL_SPACING, -PIXEL_SPACING, SLICE_THICKNESS, 1.0])
+
+
+def make_cohort(root, n_cases=4, n_slices=200, matrix_size=128, series=('CT1', 'CT2'), organs=ORGAN_EXTENTS,
+                seed=0):
+    """
+    合成データセットを作成する
+
+    Parameters:
+    root (str): 作成先のフォルダ
+    n_cases (int): ケース数
+    n_slices (int): 1シリーズあたりのスライス数
+    matrix_size (int): 画像の縦横のピクセル数
+    series (tuple): 作成するシリーズ名
+    organs (dict): {臓器名: (organSegのフォルダ名, z範囲の下端の割合, 上端の割合)}
+    seed (int): 乱数のシード
+
+    Returns:
+    dict: {'dataset': DICOMのフォルダ, 'organSeg': マスクのフォルダ, 'cases': ケース名のリスト, 'slices': DICOMファイル数}
+    """
+    rng = np.random.default_rng(seed)
+    dataset_folder = os.path.join(root, 'dataset')
+    organ_folder = os.path.join(root, 'organSeg')
+    cases = [f'case{k:02}' for k in range(1, n_cases + 1)]
+    n_files = 0
+
+    for case in cases:
+        study_uid = generate_uid()
+        for series_name in series:
+            series_folder = os.path.join(dataset_folder, case, series_name)
+            os.makedirs(series_folder, exist_ok=True)
+            series_uid = generate_uid()
+            for j in range(1, n_slices + 1):
+                pixels = rng.integers(0, 2048, (matrix_size, matrix_size), dtype=np.uint16)
+                _write_slice(os.path.join(series_folder, f'{j:08}.DCM'), pixels, (n_slices - j) * SLICE_THICKNESS,
+                             j, series_uid, study_uid)
+                n_files += 1
+
+        # ケースごとに臓器の位置を少しずらす
+        shift = int(rng.integers(-2, 3))
+        for organ_name, (folder_name, low, high) in organs.items():
+            z_min = min(max(int(low * n_slices) + shift, 0), n_slices - 1)
+            z_max = min(max(int(high * n_slices) + shift, z_min), n_slices - 1)
+            mask = np.zeros((matrix_size, matrix_size, n_slices), dtype=np.uint8)
+            quarter = matrix_size // 4
+            mask[quarter:3 * quarter, quarter:3 * quarter, z_min:z_max + 1] = 1
+
+            case_folder = os.path.join(organ_folder, f'dataset_{folder_name}', f'{case}_CT2')
+            os.makedirs(case_folder, exist_ok=True)
+            img = nib.Nifti1Image(mask, mask_affine())
+            img.set_data_dtype(np.uint8)
+            nib.save(img, os.path.join(case_folder, f'{organ_name}_{case}_CT2.nii.gz'))
+
+    return {'dataset': dataset_folder, 'organSeg': organ_folder, 'cases': cases, 'slices': n_files}
+
+
+def make_generated_folders(root, region_folders):
+    """
+    分割したデータセットから，blend用の生成画像のフォルダ (gene_{領域}/case/dicom) を作成する
+    （推論の代わりにCT2のスライスをそのまま使う）
+
+    Parameters:
+    root (str): 作成先のフォルダ
+    region_folders (dict): {領域ラベル: 分割したデータセットのフォルダ}
+
+    Returns:
+    list: 生成画像のフォルダのリスト
+    """
+    folders = []
+    for region, region_folder in region_folders.items():
+        folder = os.path.join(root, f'gene_{region}')
+        for case in sorted(os.listdir(region_folder)):
+            src = os.path.join(region_folder, case, 'CT2')
+            if not os.path.isdir(src):
+                continue
+            dst = os.path.join(folder, case, 'dicom')
+            os.makedirs(dst, exist_ok=True)
+            for file_name in os.listdir(src):
+                dst_path = os.path.join(dst, file_name)
+                if not os.path.exists(dst_path):
+                    shutil.copy(os.path.join(src, file_name), dst_path)
+        folders.append(folder)
+    return folders
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from partition_planner import plan_intervals, plan_from_occupancies
+
+'''
+partition_planner のテスト
+
+python -m pytest test_partition_planner.py
+'''
+
+
+def _covered(intervals, n_slices):
+    covered = np.zeros(n_slices, dtype=bool)
+    for interval in intervals:
+        if interval is not None:
+            covered[interval[0]:interval[1] + 1] = True
+    return np.flatnonzero(covered)
+
+
+def _assert_contiguous(intervals, n_slices):
+    # 領域の区間を合わせたzの範囲に抜けがない
+    z = _covered(intervals, n_slices)
+    assert z.size and z[-1] - z[0] + 1 == z.size, intervals
+
+
+def test_gap_between_neighbours_is_filled():
+    assert plan_intervals([(30, 34), (18, 25), (5, 12)], 40) == [(26, 34), (13, 29), (5, 17)]
+
+
+@pytest.mark.parametrize('extents', [
+    [(30, 34), None, (5, 12)],
+    [(35, 38), None, None, (2, 6)],
+    [None, (30, 34), None, (5, 12)],
+    [(30, 34), None, (5, 12), None],
+])
+@pytest.mark.parametrize('margin', [0, 2])
+def test_gap_is_filled_across_missing_regions(extents, margin):
+    intervals = plan_intervals(extents, 40, margin)
+
+    _assert_contiguous(intervals, 40)
+    assert [interval is None for interval in intervals] == [extent is None for extent in extents]
+
+
+def test_margin_is_applied_between_nearest_found_regions():
+    upper, middle, lower = plan_intervals([(30, 34), None, (5, 12)], 40, margin=2)
+
+    assert middle is None
+    # 間のスライス (13-29) を両方に加え，さらに相手の側へ2スライス広げる
+    assert upper == (11, 34)
+    assert lower == (5, 31)
+
+
+def test_copy_all_and_extend_bottom_with_missing_middle():
+    intervals = plan_intervals([(30, 34), None, (5, 12)], 40, copy_all=[True, False, False], extend_bottom=True)
+
+    assert intervals == [(13, 39), None, (0, 29)]
+    assert _covered(intervals, 40).size == 40
+
+
+def test_plan_from_occupancies_with_missing_mask():
+    n_slices = 40
+    upper, lower = np.zeros(n_slices, dtype=bool), np.zeros(n_slices, dtype=bool)
+    upper[30:35] = True
+    lower[5:13] = True
+
+    intervals, planned_slices = plan_from_occupancies([upper, None, lower], margin=1)
+
+    assert planned_slices == n_slices
+    assert intervals == [(12, 34), None, (5, 30)]
+    _assert_contiguous(intervals, n_slices)
+
+
+def test_all_regions_missing():
+    assert plan_intervals([None, None, None], 40, margin=2) == [None, None, None]
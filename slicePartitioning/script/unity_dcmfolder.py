@@ -1,18 +1,28 @@
 import os
 import pydicom
 import numpy as np
-import shutil  
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from manifest import region_label
+import script_paths  # noqa: F401
+from instrumentation import ProgressReporter, file_size
+from volume_cache import load_series_pixels
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, JPEGLSLossless, JPEG2000Lossless
 
-# 入力フォルダのパス
-folders = [
-    '~/test_gene_upper',
-    '~/test_gene_middle',
-    '~/test_gene_lower'
-]
-folder_path = folders[0]
-cases = []  
+'''
+各領域のモデルの生成画像を1つのデータセットに統合する（重複するスライスは加重平均）
 
-cases = [f for f in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, f))]
+スライスごとの読み込み・加重平均・書き出しをスレッドプールで並列に行う．
+同時に処理中のスライス数を制限するため，メモリ使用量はケースのスライス数によらず一定．
+ファイルごとには表示せず，進捗は一定間隔ごとにまとめて表示する (instrumentation.ProgressReporter)．
+volume_cacheを指定した場合は，生成画像のピクセルデータをフォルダごとに1回だけ展開してキャッシュし，
+以降（重みを変えての再実行など）はメモリマップから読み込む（ヘッダのみDICOMファイルから読む）．
+routingを指定した場合は，ルーティングテーブル (routing.RoutingTable) で複数の領域に割り当てたスライスのみを加重平均し，
+それ以外は担当する領域の生成画像のみをコピーする（フォルダ内のファイルを列挙しない）．
+加重平均はRescaleSlope/Interceptで変換したCT値で行い，保存値に戻す際はBitsStoredと符号の範囲にクリップする．
+compressionを指定した場合は，全てのスライスをimagecodecsでJPEG-LS/JPEG 2000に可逆圧縮して保存する．
+'''
 
 # 加重平均用の重みリスト（必要に応じて変更）
 weights = {
@@ -21,64 +31,297 @@ weights = {
     'lower': 0.5   # 下部の重み
 }
 
-# DICOMファイルの処理
-for case in cases:
+# 並列に処理するスレッド数と，スレッドあたりの同時に処理中とするスライス数
+DEFAULT_BLEND_WORKERS = min(8, os.cpu_count() or 1)
+IN_FLIGHT_PER_WORKER = 2
+
+# 可逆圧縮の形式と転送構文 (compression)
+LOSSLESS_TRANSFER_SYNTAXES = {
+    'jpegls': JPEGLSLossless,
+    'jpeg2000': JPEG2000Lossless,
+}
+
+def region_weights(folders, weights=weights):
+    """
+    フォルダ名から領域ラベルを求め，フォルダごとの重みを返す (例: '~/test_gene_upper' -> weights['upper'])
+    """
+    folder_weights = {}
+    for folder in folders:
+        region = region_label(folder)
+        if region not in weights:
+            raise ValueError(f"No weight for region '{region}' ({folder})")
+        folder_weights[folder] = weights[region]
+    return folder_weights
+
+def rescale_parameters(dcm):
+    """
+    保存値からCT値（モダリティ値）への変換係数 (RescaleSlope, RescaleIntercept)
+    """
+    return float(getattr(dcm, 'RescaleSlope', 1)), float(getattr(dcm, 'RescaleIntercept', 0))
+
+def stored_values(dcm, values):
+    """
+    CT値をdcmのRescaleSlope/RescaleInterceptで保存値に戻し，BitsStoredと符号 (PixelRepresentation) の範囲に
+    丸めてクリップする（負の値がuint16で折り返さないようにする．valuesはその場で上書きする）
+    """
+    signed = int(getattr(dcm, 'PixelRepresentation', 0)) == 1
+    bits_stored = int(getattr(dcm, 'BitsStored', 16))
+    low, high = (-(1 << (bits_stored - 1)), (1 << (bits_stored - 1)) - 1) if signed else (0, (1 << bits_stored) - 1)
+    dtype = np.dtype(f"{'i' if signed else 'u'}{max(int(getattr(dcm, 'BitsAllocated', 16)) // 8, 1)}")
+
+    slope, intercept = rescale_parameters(dcm)
+    values -= np.float32(intercept)
+    values /= np.float32(slope)
+    np.rint(values, out=values)
+    np.clip(values, low, high, out=values)
+    return values.astype(dtype)
+
+def write_pixel_data(dcm, stored, output_path, compression=None):
+    """
+    保存値をPixelDataに書き込んで保存する
+
+    Parameters:
+    dcm (pydicom.Dataset): ヘッダ（ピクセルデータは読み込んでいなくてよい）
+    stored (numpy.ndarray): 保存値の配列 (rows, columns)
+    output_path (str): 出力先のパス
+    compression (str): None (非圧縮) または可逆圧縮の形式 ('jpegls', 'jpeg2000')
+    """
+    if compression is None:
+        dcm.PixelData = stored.tobytes()
+        # ヘッダのみ読み込んだ場合はPixelDataのVRが決まらないため指定する
+        dcm['PixelData'].VR = 'OW'
+        dcm['PixelData'].is_undefined_length = False
+        transfer_syntax = dcm.file_meta.get('TransferSyntaxUID')
+        if transfer_syntax is not None and transfer_syntax.is_compressed:
+            # 圧縮されたファイルを非圧縮で書き出す場合は転送構文も戻す
+            dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            dcm.is_little_endian = True
+            dcm.is_implicit_VR = False
+    else:
+        if compression not in LOSSLESS_TRANSFER_SYNTAXES:
+            raise ValueError(f"Unknown compression '{compression}' (choose from {sorted(LOSSLESS_TRANSFER_SYNTAXES)})")
+        dcm.PixelData = encapsulate([_encode_frame(stored, compression)])
+        dcm['PixelData'].VR = 'OB'
+        dcm['PixelData'].is_undefined_length = True
+        dcm.file_meta.TransferSyntaxUID = LOSSLESS_TRANSFER_SYNTAXES[compression]
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+    dcm.save_as(output_path)
+    return output_path
+
+def _encode_frame(stored, compression):
+    # imagecodecsは符号化中にGILを解放するため，スレッドプールで並列に符号化できる
+    import imagecodecs
+
+    if compression == 'jpegls':
+        # JPEG-LSは符号付きの値を2の補数のビット列のまま符号化する (PixelRepresentationで解釈)
+        data = stored.view(np.uint16) if stored.dtype == np.int16 else stored
+        return imagecodecs.jpegls_encode(np.ascontiguousarray(data), level=0)
+    return imagecodecs.jpeg2k_encode(np.ascontiguousarray(stored), level=0, reversible=True, codecformat='J2K')
+
+def blend_slice(sources, output_path, read_pixels=None, compression=None):
+    """
+    重複するスライスをCT値で加重平均して保存する
+
+    Parameters:
+    sources (list): [(DCMファイルのパス, 重み), ...]
+    output_path (str): 出力先のパス（最初のDCMファイルのヘッダを使用）
+    read_pixels (callable): パスからピクセルデータを返す関数（キャッシュ用．Noneを返した場合はファイルから展開）
+    compression (str): 可逆圧縮して保存する場合の形式 ('jpegls', 'jpeg2000')
+    """
+    averaged_dcm = None
+    accumulated = scratch = None
+    total_weight = 0.0
+    # 各ファイルの intercept * 重み の合計（スカラーなので最後に1回だけ足す）
+    total_intercept = 0.0
+    for path, weight in sources:
+        pixels = read_pixels(path) if read_pixels is not None else None
+        if pixels is None:
+            dcm = pydicom.dcmread(path)
+            pixels = dcm.pixel_array
+        else:
+            # ピクセルデータはキャッシュから読むため，ヘッダ (RescaleSlope/Intercept) のみ読み込む
+            dcm = pydicom.dcmread(path, stop_before_pixels=True)
+        if averaged_dcm is None:
+            averaged_dcm = dcm
+            # 加重和は確保済みのfloat32のバッファに直接足し込む
+            accumulated = np.zeros(pixels.shape, dtype=np.float32)
+            scratch = np.empty_like(accumulated)
+        # ファイルごとにRescaleSlope/Interceptが異なってもよいよう，CT値で足し込む（slopeは重みにまとめる）
+        slope, intercept = rescale_parameters(dcm)
+        np.multiply(pixels, np.float32(slope * weight), out=scratch)
+        accumulated += scratch
+        total_intercept += intercept * weight
+        total_weight += weight
+
+    accumulated += np.float32(total_intercept)
+    accumulated /= np.float32(total_weight)
+
+    # 平均化したデータを最初のDCMファイルの保存値に戻して書き出す
+    return write_pixel_data(averaged_dcm, stored_values(averaged_dcm, accumulated), output_path, compression)
+
+def encode_slice(path, output_path, compression):
+    """
+    重複しないスライスを可逆圧縮して保存する（値は変更しない）
+    """
+    dcm = pydicom.dcmread(path)
+    return write_pixel_data(dcm, dcm.pixel_array, output_path, compression)
+
+def _blend_or_copy(sources, output_path, read_pixels=None, compression=None):
+    # 計測用に読み込んだバイト数と書き出したバイト数も返す
+    bytes_read = sum(file_size(path) for path, _ in sources)
+    if len(sources) > 1:
+        status = 'blended'
+        blend_slice(sources, output_path, read_pixels, compression)
+    elif compression is not None:
+        status = 'copied'
+        encode_slice(sources[0][0], output_path, compression)
+    else:
+        # 重複しないファイルはそのままコピー
+        status = 'copied'
+        shutil.copy(sources[0][0], output_path)
+    return status, output_path, len(sources), bytes_read, file_size(output_path)
+
+def _routed_files(case, folders, folder_weights, routing):
+    # ルーティングテーブルで割り当てた領域の生成画像のみを {file_name: [(パス, 重み), ...]} とする
+    region_folders = {region_label(folder): folder for folder in folders}
+    dicom_files = {}
+    for file_name, regions in routing.case_routes(case).items():
+        sources = []
+        for region in regions:
+            if region not in region_folders:
+                continue
+            path = os.path.join(region_folders[region], case, 'dicom', file_name)
+            if os.path.exists(path):
+                sources.append((path, folder_weights[region_folders[region]]))
+            else:
+                print(f"{case}: {file_name} is routed to {region} but {path} does not exist")
+        if sources:
+            dicom_files[file_name] = sources
+    return dicom_files
+
+def blend_case(case, folders, output_base, weights=weights, max_workers=DEFAULT_BLEND_WORKERS, max_in_flight=None,
+               metrics=None, volume_cache=None, routing=None, compression=None):
+    """
+    1ケース分の各領域の生成画像を加重平均して1つのフォルダにまとめる
+
+    Parameters:
+    case (str): ケースフォルダ名
+    folders (list): 各領域の生成画像のフォルダ (例: '~/test_gene_upper')
+    output_base (str): 出力先のフォルダ（output_base/case を作成）
+    weights (dict): 領域ごとの重み {'upper': 0.5, ...}
+    max_workers (int): 並列に処理するスレッド数
+    max_in_flight (int): 同時に処理中とするスライス数．Noneの場合は max_workers * IN_FLIGHT_PER_WORKER
+    metrics (StageMetrics): 指定した場合は読み書きしたファイル数とバイト数を加える (instrumentation.measure_stage)
+    volume_cache (str): 指定した場合は生成画像のピクセルデータをキャッシュ (volume_cache) から読み込む
+    routing (RoutingTable): 指定した場合はスライスごとに割り当てた領域の生成画像のみを読み込む (routing.RoutingTable)
+    compression (str): 指定した場合は全てのスライスを可逆圧縮して保存する ('jpegls', 'jpeg2000')
+
+    Returns:
+    list: 出力したファイルのパス
+    """
     # 各ケースごとに出力フォルダを作成
-    output_folder = f'~/test_gene/{case}'
+    output_folder = os.path.join(output_base, case)
     os.makedirs(output_folder, exist_ok=True)
+    folder_weights = region_weights(folders, weights)
 
-    # 各フォルダのdicomファイルのパスを取得
+    # 各フォルダのdicomファイルのパスと重みを取得
     dicom_files = {}
-    all_files = set()  # 全てのファイルを保存するセット
-    for folder in folders:
-        dicom_folder = os.path.join(folder, case, 'dicom')
-        if os.path.exists(dicom_folder):
-            for file in os.listdir(dicom_folder):
-                if file.endswith('.DCM'):
-                    all_files.add(file)  # 全てのファイルをセットに追加
-                    if file not in dicom_files:
-                        dicom_files[file] = []
-                    dicom_files[file].append(os.path.join(dicom_folder, file))
-
-    # 全てのファイルを処理
-    for file_name in all_files:
-        if file_name in dicom_files and len(dicom_files[file_name]) > 1:  # 重複するDCMファイルが存在する場合
-            print(f"重複するファイル名: {file_name} -> {dicom_files[file_name]}")
-
-            # すべてのDCMファイルを読み込む
-            dcm_images = [pydicom.dcmread(path) for path in dicom_files[file_name]]
-
-            # フォルダに基づいて適切な重みを取得
-            folder_names = []
-            for path in dicom_files[file_name]:
-                # フォルダ構造から 'upper', 'middle', 'lower' を特定する
-                split_path = path.split(os.sep)  # パスを分割
-                for part in split_path:
-                    if part in weights:
-                        folder_names.append(part)
-                        break  # 見つけたら次のファイルへ
-
-            # 加重平均用の重みを取得
-            weights_for_files = np.array([weights[folder] for folder in folder_names])
-
-            # ピクセルデータを加重平均化
-            pixel_arrays = [dcm.pixel_array.astype(np.float32) for dcm in dcm_images]
-            weighted_pixel_arrays = np.array([pixel_array * weight for pixel_array, weight in zip(pixel_arrays, weights_for_files)])
-            averaged_pixels = np.sum(weighted_pixel_arrays, axis=0) / np.sum(weights_for_files)
-
-            # 平均化したデータを最初のDCMファイルに書き戻し
-            averaged_dcm = dcm_images[0]
-            averaged_pixels = averaged_pixels.astype(np.uint16)  # データ型を元に戻す
-            averaged_dcm.PixelData = averaged_pixels.tobytes()
+    series_caches = {}
+    if routing is not None:
+        dicom_files = _routed_files(case, folders, folder_weights, routing)
+    else:
+        for folder in folders:
+            dicom_folder = os.path.join(folder, case, 'dicom')
+            if os.path.exists(dicom_folder):
+                for entry in os.scandir(dicom_folder):
+                    if entry.name.endswith('.DCM'):
+                        dicom_files.setdefault(entry.name, []).append((entry.path, folder_weights[folder]))
+
+    if volume_cache is not None:
+        # キャッシュには読み込むファイルのみを展開する（ルーティングの場合は割り当てたファイルのみ）
+        series_files = {}
+        for sources in dicom_files.values():
+            for path, _ in sources:
+                series_files.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+        for dicom_folder, file_names in series_files.items():
+            series_caches[dicom_folder] = load_series_pixels(dicom_folder, volume_cache,
+                                                             file_names if routing is not None else None)
+
+    def read_pixels(path):
+        series = series_caches.get(os.path.dirname(path))
+        return series.pixel_array(os.path.basename(path)) if series is not None else None
+
+    outputs = []
+    counts = {'blended': 0, 'copied': 0}
+    progress = ProgressReporter(f'blend {case}')
+
+    def collect(futures):
+        for future in futures:
+            status, output_path, files_read, bytes_read, bytes_written = future.result()
+            outputs.append(output_path)
+            counts[status] += 1
+            progress.update(1, bytes_written)
+            if metrics is not None:
+                metrics.read(bytes_read, files_read)
+                metrics.write(bytes_written)
+
+    max_workers = max(1, max_workers or 1)
+    max_in_flight = max_in_flight or max_workers * IN_FLIGHT_PER_WORKER
 
+    # 全てのファイルを処理（処理中のスライス数がmax_in_flightを超えないよう完了を待ちながら投入）
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for file_name in sorted(dicom_files):
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
             # 新しいファイル名と出力パスを定義
             output_path = os.path.join(output_folder, f'{case}_{file_name}')
-            averaged_dcm.save_as(output_path)
-            print(f'Weighted Averaged DICOM file saved: {output_path}')
+            pending.add(executor.submit(_blend_or_copy, dicom_files[file_name], output_path,
+                                        read_pixels if series_caches else None, compression))
+        collect(wait(pending)[0])
 
-        else:
-            # 重複しないファイルはそのままコピー
-            source_file_path = dicom_files[file_name][0]
-            output_path = os.path.join(output_folder, f'{case}_{file_name}')
-            shutil.copy(source_file_path, output_path)
-            print(f'Copied DICOM file: {output_path}')
+    progress.close()
+    print(f"{case}: {counts['blended']} weighted averaged, {counts['copied']} copied to {output_folder}")
+    return sorted(outputs)
+
+if __name__ == "__main__":
+    # 入力フォルダのパス
+    folders = [
+        '~/test_gene_upper',
+        '~/test_gene_middle',
+        '~/test_gene_lower'
+    ]
+    folder_path = folders[0]
+    cases = []
+
+    cases = [f for f in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, f))]
+
+    # DICOMファイルの処理
+    for case in cases:
+        blend_case(case, folders, '~/test_gene', weights)
+
+    # ケースごとの処理時間・読み書きしたバイト数・ピーク時のRSSを記録する場合
+    # from case_runner import new_case_result
+    # from instrumentation import MetricsWriter, measure_stage
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as writer:
+    #     for case in cases:
+    #         result = new_case_result(case)
+    #         with measure_stage(result, 'blend') as metrics:
+    #             blend_case(case, folders, '~/test_gene', weights, metrics=metrics)
+    #         writer.add_result(result)
+
+    # 重みを変えて再実行する場合など，生成画像のピクセルデータをキャッシュから読み込む場合
+    # for case in cases:
+    #     blend_case(case, folders, '~/test_gene', weights, volume_cache='~/volume_cache')
+
+    # ルーティングテーブルで割り当てた領域の生成画像のみを読み込む場合 (routing.py)
+    # from routing import RoutingTable
+    # routing = RoutingTable.load('~/test_routing.json')
+    # for case in sorted(routing.cases):
+    #     blend_case(case, folders, '~/test_gene', weights, routing=routing)
+
+    # 可逆圧縮 (JPEG-LS) して保存する場合
+    # for case in cases:
+    #     blend_case(case, folders, '~/test_gene', weights, compression='jpegls')
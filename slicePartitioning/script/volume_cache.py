@@ -0,0 +1,292 @@
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+import pydicom
+from mask_extent import iter_mask_slabs, get_slice_occupancy, DEFAULT_SLAB_SIZE
+import script_paths  # noqa: F401
+from file_io import DICOM_SUFFIX, temp_path, replace_path, write_json
+
+'''
+変換したボリュームと臓器マスクを非圧縮のnumpy配列 (.npy) として保存し，メモリマップで読み込むキャッシュ
+
+.nii.gzはzスラブ1枚を読むだけでも先頭からgzipを展開する必要があり，ステージごとに同じマスクを展開し直している．
+キャッシュには各ボリュームを1回だけ展開し，z方向が連続するよう (z, x, y, ...) の順で保存する．
+affineなどのジオメトリは同名の .json（サイドカー）に保存するため，配列を読まずに参照できる．
+    cache_dir/{元ファイルの絶対パスのsha1}.npy
+    cache_dir/{元ファイルの絶対パスのsha1}.json
+
+配列は np.load(mmap_mode='r') で開くため，zスラブへのアクセスは該当ページのみの読み込みとなり（コピーなし），
+複数のワーカープロセスからの読み込みもOSのページキャッシュで共有される．
+元ファイルのサイズと更新時刻が変わった場合は作り直す．
+
+DICOMシリーズ（生成画像など）のピクセルデータも (スライス数, rows, columns) の配列として同様に保存できる．
+（ファイルごとのサイズと更新時刻を記録し，上書きされたファイルがあれば作り直す）
+'''
+
+CACHE_VERSION = 1
+
+
+def _cache_paths(cache_dir, source):
+    key = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()
+    base = os.path.join(os.path.expanduser(cache_dir), key)
+    return f'{base}.npy', f'{base}.json'
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('version') == CACHE_VERSION else None
+
+
+def _open_array(data_path, shape, dtype):
+    # 書き込み途中のファイルを読まれないよう，一時ファイルに書いてから置き換える (_commit_array)
+    tmp_path = temp_path(data_path, '.npy')
+    return tmp_path, np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+
+
+def _commit_array(tmp_path, array, data_path):
+    array.flush()
+    replace_path(tmp_path, data_path)
+
+
+class CachedVolume:
+    """
+    キャッシュしたボリューム1つ分（配列はメモリマップで遅延して開く）
+
+    Parameters:
+    data_path (str): .npyのパス（(z, x, y, ...) の順）
+    meta (dict): サイドカーの内容 {'shape', 'dtype', 'affine', 'source', ...}
+    """
+
+    def __init__(self, data_path, meta):
+        self.data_path = data_path
+        self.meta = meta
+        self._z_major = None
+
+    @property
+    def shape(self):
+        return tuple(self.meta['shape'])
+
+    @property
+    def affine(self):
+        return np.array(self.meta['affine'], dtype=np.float64)
+
+    @property
+    def z_major(self):
+        """
+        (z, x, y, ...) の順のメモリマップ（z[k] が連続したスライス）
+        """
+        if self._z_major is None:
+            self._z_major = np.load(self.data_path, mmap_mode='r')
+        return self._z_major
+
+    @property
+    def data(self):
+        """
+        NIfTIと同じ (x, y, z, ...) の順のビュー（コピーなし）
+        """
+        return np.moveaxis(self.z_major, 0, 2)
+
+    def slab(self, z0, z1):
+        """
+        zインデックス z0 ~ z1-1 のスラブ (x, y, z1-z0, ...)．該当するページのみ読み込む
+        """
+        return np.moveaxis(self.z_major[z0:z1], 0, 2)
+
+    def slice_occupancy(self, slab_size=DEFAULT_SLAB_SIZE):
+        """
+        スライスごとのセグメンテーションの有無（mask_extent.get_slice_occupancyと同じ）
+        """
+        z_major = self.z_major
+        occupancy = np.zeros(z_major.shape[0], dtype=bool)
+        for z0 in range(0, z_major.shape[0], slab_size):
+            slab = z_major[z0:z0 + slab_size]
+            occupancy[z0:z0 + slab.shape[0]] = slab.reshape(slab.shape[0], -1).any(axis=1)
+        return occupancy
+
+
+def _volume_meta(nifti_file, shape, dtype, affine):
+    return {'version': CACHE_VERSION, 'source': os.path.abspath(nifti_file), 'signature': _file_signature(nifti_file),
+            'shape': [int(n) for n in shape], 'dtype': np.dtype(dtype).str,
+            'affine': np.asarray(affine, dtype=np.float64).tolist()}
+
+
+def load_volume(nifti_file, cache_dir, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    NIfTIファイルのキャッシュを返す（ない場合や元ファイルが変更された場合はスラブ単位で展開して作成）
+
+    Parameters:
+    nifti_file (str): NIfTIファイルのパス
+    cache_dir (str): キャッシュを保存するフォルダ
+    slab_size (int): 作成時に一度に展開するzスライス数
+
+    Returns:
+    CachedVolume: キャッシュしたボリューム
+    """
+    data_path, meta_path = _cache_paths(cache_dir, nifti_file)
+    meta = _read_meta(meta_path)
+    if meta is not None and os.path.exists(data_path) and meta['signature'] == _file_signature(nifti_file):
+        return CachedVolume(data_path, meta)
+
+    img = nib.load(nifti_file, keep_file_open=True)
+    if len(img.shape) < 3:
+        raise ValueError(f"{nifti_file} is not a volume: {img.shape}")
+
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    tmp_path = array = None
+    for z0, slab in iter_mask_slabs(img, slab_size):
+        if array is None:
+            shape = (img.shape[2], img.shape[0], img.shape[1]) + tuple(img.shape[3:])
+            tmp_path, array = _open_array(data_path, shape, slab.dtype)
+        array[z0:z0 + slab.shape[2]] = np.moveaxis(slab, 2, 0)
+    dtype = array.dtype
+    _commit_array(tmp_path, array, data_path)
+
+    meta = _volume_meta(nifti_file, img.shape, dtype, img.affine)
+    write_json(meta_path, meta)
+    return CachedVolume(data_path, meta)
+
+
+def store_volume(nifti_file, data, affine, cache_dir):
+    """
+    メモリ上のボリューム（保存済みのnifti_fileと同じ内容）をキャッシュに書き込む（展開し直さずに作成）
+
+    Parameters:
+    nifti_file (str): 保存済みのNIfTIファイルのパス（キャッシュのキー）
+    data (numpy.ndarray): (x, y, z, ...) の配列
+    affine (numpy.ndarray): affine
+    cache_dir (str): キャッシュを保存するフォルダ
+
+    Returns:
+    CachedVolume: キャッシュしたボリューム
+    """
+    data_path, meta_path = _cache_paths(cache_dir, nifti_file)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+
+    data = np.asanyarray(data)
+    z_major = np.moveaxis(data, 2, 0)
+    tmp_path, array = _open_array(data_path, z_major.shape, data.dtype)
+    array[...] = z_major
+    _commit_array(tmp_path, array, data_path)
+
+    meta = _volume_meta(nifti_file, data.shape, data.dtype, affine)
+    write_json(meta_path, meta)
+    return CachedVolume(data_path, meta)
+
+
+def load_mask_extent(nifti_file, cache_dir=None, slab_size=DEFAULT_SLAB_SIZE):
+    """
+    マスクのスライスごとのセグメンテーションの有無とshape，affineを求める
+
+    Parameters:
+    nifti_file (str): マスクのパス
+    cache_dir (str): 指定した場合はキャッシュから読み込む（Noneの場合は.nii.gzをスラブ単位で展開）
+    slab_size (int): 一度に読み込むzスライス数
+
+    Returns:
+    (numpy.ndarray, tuple, numpy.ndarray): 占有のbool配列 (mask_extent.get_slice_occupancy と同じ)，shape，affine
+    """
+    if cache_dir is not None:
+        volume = load_volume(nifti_file, cache_dir, slab_size)
+        return volume.slice_occupancy(slab_size), volume.shape, volume.affine
+    img = nib.load(nifti_file, keep_file_open=True)
+    return get_slice_occupancy(img, slab_size), img.shape, img.affine
+
+
+def _series_files(series_dir, file_names=None):
+    if file_names is None:
+        return sorted((entry.name, {'size': entry.stat().st_size, 'mtime_ns': entry.stat().st_mtime_ns})
+                      for entry in os.scandir(series_dir) if entry.name.endswith(DICOM_SUFFIX) and entry.is_file())
+
+    files = []
+    for name in sorted(set(file_names)):
+        try:
+            stat = os.stat(os.path.join(series_dir, name))
+        except FileNotFoundError:
+            continue
+        files.append((name, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}))
+    return files
+
+
+class CachedSeries:
+    """
+    キャッシュしたDICOMシリーズのピクセルデータ
+
+    Parameters:
+    data_path (str): .npyのパス（(ファイル数, rows, columns) の順）
+    meta (dict): サイドカーの内容 {'files': [[ファイル名, {size, mtime_ns}], ...], ...}
+    """
+
+    def __init__(self, data_path, meta):
+        self.data_path = data_path
+        self.meta = meta
+        self.positions = {name: k for k, (name, _) in enumerate(meta['files'])}
+        self._pixels = None
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = np.load(self.data_path, mmap_mode='r')
+        return self._pixels
+
+    def pixel_array(self, file_name):
+        """
+        ファイルのピクセルデータ（pydicomのpixel_arrayと同じ値．メモリマップのビュー）
+        """
+        return self.pixels[self.positions[file_name]]
+
+
+def load_series_pixels(series_dir, cache_dir, file_names=None):
+    """
+    DICOMシリーズのピクセルデータのキャッシュを返す（ない場合や変更があった場合は対象のファイルを展開して作成）
+
+    Parameters:
+    series_dir (str): シリーズのフォルダ (例: test_gene_upper/case01/dicom)
+    cache_dir (str): キャッシュを保存するフォルダ
+    file_names (iterable): 指定した場合はそのファイルのみを対象とする（ルーティングで割り当てたファイルなど）．
+                           既存のキャッシュが対象のファイルを全て含む場合はそのまま使う
+
+    Returns:
+    CachedSeries or None: 画像サイズや型がファイルごとに異なる場合など，キャッシュできない場合はNone
+    """
+    data_path, meta_path = _cache_paths(cache_dir, series_dir)
+    files = [[name, signature] for name, signature in _series_files(series_dir, file_names)]
+    meta = _read_meta(meta_path)
+    if meta is not None and os.path.exists(data_path):
+        cached = {name: signature for name, signature in meta['files']}
+        if (meta['files'] == files if file_names is None
+                else all(cached.get(name) == signature for name, signature in files)):
+            return CachedSeries(data_path, meta)
+    if not files:
+        return None
+
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    tmp_path = array = None
+    try:
+        for k, (name, _) in enumerate(files):
+            pixels = pydicom.dcmread(os.path.join(series_dir, name)).pixel_array
+            if array is None:
+                tmp_path, array = _open_array(data_path, (len(files),) + pixels.shape, pixels.dtype)
+            elif pixels.shape != array.shape[1:] or pixels.dtype != array.dtype:
+                raise ValueError(f"{name} has a different shape or dtype")
+            array[k] = pixels
+    except (ValueError, AttributeError) as e:
+        print(f"Series {series_dir} is not cached: {e}")
+        if tmp_path is not None:
+            os.remove(tmp_path)
+        return None
+    _commit_array(tmp_path, array, data_path)
+
+    meta = {'version': CACHE_VERSION, 'source': os.path.abspath(series_dir), 'files': files}
+    write_json(meta_path, meta)
+    return CachedSeries(data_path, meta)
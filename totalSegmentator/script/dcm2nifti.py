@@ -1,40 +1,194 @@
 import os
+import json
+import hashlib
+import tempfile
 import dicom2nifti
 import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import script_paths  # noqa: F401
+from file_io import update_digest, write_json
+from case_runner import new_case_result
+from instrumentation import measure_stage, ProgressReporter, folder_size, file_size
 
-def convert_dicom_to_nifti(dicom_folder, nifti_output_folder):
-
-    for case in os.listdir(dicom_folder):
-        case_path = os.path.join(dicom_folder, case)
-        if os.path.isdir(case_path):
-            # CT1 or CT2フォルダを探す
-            # ct1_path = os.path.join(case_path, 'CT1')
-             ct2_path = os.path.join(case_path, 'CT2')
-            if os.path.isdir(ct1_path):
-                temp_output_folder = os.path.join(nifti_output_folder, "temp")
-                os.makedirs(temp_output_folder, exist_ok=True)
-                
-                # DICOMをNIfTIに変換
+'''
+DICOMシリーズをNIfTIに変換する
+
+- ケースごとに個別の一時フォルダ（出力フォルダ内の .tmp_<case>_*）で変換するため，ケースを並列に処理できる
+- 出力がシリーズのどのファイルよりも新しい場合，または変換済みシリーズのハッシュが一致する場合は変換しない
+  （ハッシュは出力フォルダの conversion_index.json に記録）
+- ケースごとの処理時間・読み書きしたバイト数を計測し (instrumentation.measure_stage)，進捗は一定間隔ごとにまとめて表示する
+'''
+
+INDEX_FILENAME = 'conversion_index.json'
+
+# ケースを並列に変換するプロセス数
+DEFAULT_NUM_WORKERS = max(1, min(8, (os.cpu_count() or 1) // 2))
+
+
+def _series_files(ct_path):
+    return sorted((entry for entry in os.scandir(ct_path) if entry.is_file()), key=lambda entry: entry.name)
+
+
+def series_digest(ct_path):
+    """
+    シリーズ内の全ファイルの名前と内容から sha256 を求める
+    """
+    digest = hashlib.sha256()
+    for entry in _series_files(ct_path):
+        digest.update(entry.name.encode('utf-8') + b'\0')
+        update_digest(digest, entry.path)
+    return digest.hexdigest()
+
+
+def _load_index(index_path):
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Failed to read conversion index {index_path}: {e}")
+    return {}
+
+
+def _save_index(index_path, index):
+    write_json(index_path, index, indent=1, sort_keys=True)
+
+
+def convert_case(case, ct_path, nifti_output_folder, series='CT2', known_digest=None):
+    """
+    1ケース分のシリーズを変換する（変換不要の場合はスキップ）
+
+    Parameters:
+    case (str): ケース名
+    ct_path (str): 変換するシリーズ (例: dataset/case01/CT2)
+    known_digest (str): 前回変換したシリーズのハッシュ (conversion_index.json)
+
+    Returns:
+    (str, str, str): (状態 'converted' / 'skipped' / 'failed', メッセージ, シリーズのハッシュ)
+    """
+    target_file = os.path.join(nifti_output_folder, f"{case}_{series}.nii.gz")
+
+    files = _series_files(ct_path)
+    if not files:
+        return 'failed', f"No files in {ct_path}", None
+
+    # 出力がシリーズのどのファイルよりも新しければ変換しない
+    if os.path.exists(target_file):
+        newest_source = max(entry.stat().st_mtime_ns for entry in files)
+        if os.stat(target_file).st_mtime_ns >= newest_source:
+            return 'skipped', f"{target_file} is up to date", known_digest
+
+    # 更新時刻が変わっただけ（コピーなど）の場合は内容のハッシュで照合
+    digest = series_digest(ct_path)
+    if os.path.exists(target_file) and digest == known_digest:
+        os.utime(target_file)
+        return 'skipped', f"{target_file} matches {ct_path}", digest
+
+    # ケースごとの一時出力先ディレクトリで変換
+    temp_output_folder = tempfile.mkdtemp(prefix=f".tmp_{case}_", dir=nifti_output_folder)
+    try:
+        dicom2nifti.convert_directory(ct_path, temp_output_folder, compression=True, reorient=True)
+
+        # 変換されたファイルをrename
+        for file_name in os.listdir(temp_output_folder):
+            if file_name.endswith('.nii.gz'):
+                shutil.move(os.path.join(temp_output_folder, file_name), target_file)
+                return 'converted', f"Successfully converted {ct_path} to {target_file}", digest
+        return 'failed', f"Failed to convert {ct_path}: no NIfTI file was written", None
+    except Exception as e:
+        return 'failed', f"Failed to convert {ct_path}: {str(e)}", None
+    finally:
+        # 一時出力先ディレクトリをクリーンアップ
+        shutil.rmtree(temp_output_folder, ignore_errors=True)
+
+
+# convert_caseの状態とケースの処理結果 (case_runner.new_case_result) の状態の対応
+CASE_STATUS = {'converted': 'ok', 'skipped': 'skipped', 'failed': 'error'}
+
+
+def _convert_case_measured(case, ct_path, nifti_output_folder, series='CT2', known_digest=None):
+    # convert_caseの処理時間と読み書きしたバイト数を計測する（ワーカープロセスから結果と一緒に返す）
+    result = new_case_result(case)
+    with measure_stage(result, 'convert') as metrics:
+        status, message, digest = convert_case(case, ct_path, nifti_output_folder, series, known_digest)
+        result['status'] = CASE_STATUS[status]
+        if status == 'converted':
+            files, nbytes = folder_size(ct_path)
+            metrics.read(nbytes, files)
+            metrics.write(file_size(os.path.join(nifti_output_folder, f"{case}_{series}.nii.gz")))
+            result['files'] = 1
+    return status, message, digest, result
+
+
+def convert_dicom_to_nifti(dicom_folder, nifti_output_folder, series='CT2', num_workers=DEFAULT_NUM_WORKERS,
+                           metrics=None):
+    """
+    Parameters:
+    dicom_folder (str): DICOMファイルの親フォルダ（ケースフォルダ/CT1, CT2, CT3）
+    nifti_output_folder (str): NIfTIファイル ({case}_{series}.nii.gz) を保存するフォルダ
+    series (str): 変換するシリーズ ('CT1', 'CT2', 'CT3')
+    num_workers (int): ケースを並列に変換するプロセス数（1の場合は逐次処理）
+    metrics (MetricsWriter): 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+
+    Returns:
+    dict: {'converted': 件数, 'skipped': 件数, 'failed': 件数}
+    """
+    os.makedirs(nifti_output_folder, exist_ok=True)
+    index_path = os.path.join(nifti_output_folder, INDEX_FILENAME)
+    index = _load_index(index_path)
+
+    tasks = []
+    for case in sorted(os.listdir(dicom_folder)):
+        # CT1 or CT2 or CT3フォルダを探す
+        ct_path = os.path.join(dicom_folder, case, series)
+        if os.path.isdir(ct_path):
+            key = f"{case}_{series}"
+            tasks.append((key, (case, ct_path, nifti_output_folder, series, index.get(key))))
+
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    progress = ProgressReporter(f'convert:{series}', len(tasks))
+
+    def record(key, status, message, digest, result=None):
+        counts[status] += 1
+        if status != 'skipped':
+            print(message)
+        if result is not None:
+            progress.add_result(result)
+            if metrics is not None:
+                metrics.add_result(result)
+        if digest is not None:
+            index[key] = digest
+        elif status == 'failed':
+            index.pop(key, None)
+
+    if num_workers is None or num_workers <= 1:
+        for key, args in tasks:
+            record(key, *_convert_case_measured(*args))
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(_convert_case_measured, *args): key for key, args in tasks}
+            for future in as_completed(futures):
                 try:
-                    dicom2nifti.convert_directory(ct1_path, temp_output_folder, compression=True, reorient=True)
-                    
-                    # 変換されたファイルをrename
-                    for file_name in os.listdir(temp_output_folder):
-                        if file_name.endswith('.nii.gz'):
-                            source_file = os.path.join(temp_output_folder, file_name)
-                            target_file = os.path.join(nifti_output_folder, f"{case}_CT2.nii.gz")
-                            # target_file = os.path.join(nifti_output_folder, f"{case}_CT1.nii.gz")
-                            shutil.move(source_file, target_file)
-                            print(f"Successfully converted {ct2_path} to {target_file}")
+                    record(futures[future], *future.result())
                 except Exception as e:
-                    print(f"Failed to convert {ct2_path}: {str(e)}")
-                finally:
-                    # 一時出力先ディレクトリをクリーンアップ
-                    shutil.rmtree(temp_output_folder)
+                    record(futures[future], 'failed', f"Failed to convert {futures[future]}: {str(e)}", None)
+
+    _save_index(index_path, index)
+    progress.close()
+    print(f"Conversion complete: {counts['converted']} converted, {counts['skipped']} skipped, "
+          f"{counts['failed']} failed")
+    return counts
+
 
-# 使用例
-dicom_folder = '~/dataset'  # DICOMファイルの親フォルダへのパス
-nifti_output_folder = '~/dataset_nifti'  # NIfTIファイルを保存するフォルダへのパス
+if __name__ == "__main__":
+    # 使用例
+    dicom_folder = '~/dataset'  # DICOMファイルの親フォルダへのパス
+    nifti_output_folder = '~/dataset_nifti'  # NIfTIファイルを保存するフォルダへのパス
 
-convert_dicom_to_nifti(dicom_folder, nifti_output_folder)
+    # series='CT1' とすると {case}_CT1.nii.gz を作成
+    convert_dicom_to_nifti(dicom_folder, nifti_output_folder, series='CT2')
 
+    # ケースごとの処理時間・読み書きしたバイト数を記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     convert_dicom_to_nifti(dicom_folder, nifti_output_folder, series='CT2', metrics=metrics)
@@ -0,0 +1,69 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+import script_paths  # noqa: F401
+from file_io import atomic_write
+
+'''
+マスクの書き出しを行うモジュール
+
+- 結合マスクは一時的な.niiを経由せず，.nii.gzへ直接1回だけ書き出す
+- gzip圧縮はデータをブロックに分けてスレッドで並列に行う（pigzと同様に複数のgzipメンバーを連結．
+  連結したgzipは通常のgzipとして読み込める）
+'''
+
+# gzipの圧縮レベル（1: 高速 ～ 9: 高圧縮）
+DEFAULT_COMPRESSLEVEL = 6
+
+# 並列圧縮のスレッド数とブロックサイズ
+DEFAULT_GZIP_THREADS = min(8, os.cpu_count() or 1)
+GZIP_BLOCK_SIZE = 4 << 20
+
+
+def _compress_block(block, compresslevel):
+    # ブロックごとに独立したgzipメンバーを作成（zlibは圧縮中にGILを解放する）
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def parallel_gzip_compress(data, compresslevel=DEFAULT_COMPRESSLEVEL, threads=DEFAULT_GZIP_THREADS,
+                           block_size=GZIP_BLOCK_SIZE):
+    """
+    バイト列をブロック単位で並列にgzip圧縮し，連結したgzipメンバーのリストを返す
+    """
+    view = memoryview(data)
+    blocks = [view[i:i + block_size] for i in range(0, len(view), block_size)] or [view]
+
+    if threads is None or threads <= 1 or len(blocks) == 1:
+        return [_compress_block(block, compresslevel) for block in blocks]
+
+    with ThreadPoolExecutor(max_workers=min(threads, len(blocks))) as executor:
+        return list(executor.map(lambda block: _compress_block(block, compresslevel), blocks))
+
+
+def save_nifti_gz(img, output_file, compresslevel=DEFAULT_COMPRESSLEVEL, threads=DEFAULT_GZIP_THREADS):
+    """
+    NIfTI画像を.nii.gzとして直接書き出す（並列gzip）
+
+    Parameters:
+    img (nibabel.Nifti1Image): 保存する画像
+    output_file (str): 出力ファイルのパス（.nii.gz）
+    compresslevel (int): gzipの圧縮レベル
+    threads (int): 圧縮に使うスレッド数
+    """
+    members = parallel_gzip_compress(img.to_bytes(), compresslevel, threads)
+
+    with atomic_write(output_file, 'wb') as f:
+        for member in members:
+            f.write(member)
+
+
+def save_mask(mask, affine, output_file, compresslevel=DEFAULT_COMPRESSLEVEL, threads=DEFAULT_GZIP_THREADS):
+    """
+    uint8のマスクを.nii.gzとして保存する
+    """
+    img = nib.Nifti1Image(np.asarray(mask, dtype=np.uint8), affine)
+    img.set_data_dtype(np.uint8)
+    save_nifti_gz(img, output_file, compresslevel, threads)
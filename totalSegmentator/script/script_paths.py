@@ -0,0 +1,13 @@
+import os
+import sys
+
+'''
+共有モジュールのフォルダ (common/) を sys.path に追加する（import script_paths とするだけでよい）
+
+totalSegmentator/script からは common/ のみを読み込み，slicePartitioning/script のモジュールは読み込まない．
+'''
+
+COMMON_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+
+if COMMON_DIR not in sys.path:
+    sys.path.append(COMMON_DIR)
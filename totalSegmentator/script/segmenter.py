@@ -0,0 +1,125 @@
+import os
+import numpy as np
+
+'''
+1ケース1回の推論で複数の臓器グループのマスクを作成するモジュール
+
+臓器グループ（甲状腺，肺，腎臓など）ごとにtotalsegmentatorを呼び出すと，1ケースにつき
+グループ数だけ推論・リサンプリングが行われる．全グループのroi_subsetの和集合で1回だけ推論し，
+得られたマルチラベル画像をメモリ上でグループごとのマスクに分割する．
+
+TotalSegmentatorは呼び出しのたびに nnUNetPredictor を作成し，学習済みモデルのフォルダから
+チェックポイントを読み込んでネットワークを構築する．GroupSegmenterは keep_models_loaded で
+この初期化をプロセス内でキャッシュし，2ケース目以降は読み込み済みのネットワークと重みを使い回す
+（GroupSegmenterを作成したプロセスがケースを逐次処理する間，モデルはメモリ・GPU上に保持される）．
+segment_fnを差し替えることでGPUなしでも動作を確認できる．
+'''
+
+# 初期化済みの nnUNetPredictor の状態 {(モデルフォルダ, fold, チェックポイント, device): {属性名: 値}}
+_LOADED_MODELS = {}
+
+
+def keep_models_loaded(predictor_class=None):
+    """
+    nnUNetPredictor.initialize_from_trained_model_folder をプロセス内でキャッシュするよう置き換える
+
+    同じモデルフォルダ・fold・チェックポイント・deviceで2回目以降に呼ばれた場合は，チェックポイントを
+    読み込まずに1回目の初期化で設定された属性（ネットワーク，重み，plansなど）をそのまま設定する．
+
+    Parameters:
+    predictor_class (type): 置き換えるクラス．Noneの場合は nnunetv2 の nnUNetPredictor（テスト時はスタブを渡す）
+    """
+    if predictor_class is None:
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor as predictor_class
+    if getattr(predictor_class, '_keeps_models_loaded', False):
+        return
+    initialize = predictor_class.initialize_from_trained_model_folder
+
+    def initialize_once(self, model_training_output_dir, use_folds, checkpoint_name='checkpoint_final.pth'):
+        key = (os.path.abspath(model_training_output_dir), repr(use_folds), checkpoint_name,
+               str(getattr(self, 'device', None)))
+        state = _LOADED_MODELS.get(key)
+        if state is None:
+            before = dict(vars(self))
+            initialize(self, model_training_output_dir, use_folds, checkpoint_name)
+            state = {name: value for name, value in vars(self).items()
+                     if name not in before or before[name] is not value}
+            _LOADED_MODELS[key] = state
+        else:
+            vars(self).update(state)
+
+    predictor_class.initialize_from_trained_model_folder = initialize_once
+    predictor_class._keeps_models_loaded = True
+
+
+
+def totalsegmentator_backend(input_file, roi_subset, device='gpu', fast=False):
+    """
+    TotalSegmentatorでroi_subsetの臓器をまとめてセグメンテーションする
+
+    Returns:
+    (nibabel image, dict): マルチラベル画像と {臓器名: ラベル値}
+    """
+    from totalsegmentator.python_api import totalsegmentator
+    from totalsegmentator.map_to_binary import class_map
+
+    # ml=Trueで1つのマルチラベル画像として受け取る（臓器ごとのファイルは書き出さない）
+    seg_img = totalsegmentator(input_file, None, ml=True, roi_subset=list(roi_subset),
+                               device=device, fast=fast, quiet=True)
+    label_ids = {name: label for label, name in class_map['total'].items() if name in roi_subset}
+    return seg_img, label_ids
+
+
+class GroupSegmenter:
+    """
+    臓器グループの和集合で1回だけ推論するセグメンテーション（モデルはケース間で保持する）
+
+    Parameters:
+    segment_fn (callable): segment_fn(input_file, roi_subset) -> (マルチラベル画像, {臓器名: ラベル値})
+                           Noneの場合はTotalSegmentatorを使用（テスト時はスタブに差し替える）
+    **backend_kwargs: TotalSegmentatorに渡す引数 (device, fast)
+    """
+
+    def __init__(self, segment_fn=None, **backend_kwargs):
+        self.segment_fn = segment_fn
+        self.backend_kwargs = backend_kwargs
+
+        if self.segment_fn is None:
+            # ライブラリ（torch, nnU-Net）の読み込みは最初の1回だけ行い，モデルはケース間で保持する
+            import totalsegmentator.python_api  # noqa: F401
+            keep_models_loaded()
+            self.segment_fn = totalsegmentator_backend
+
+    def segment(self, input_file, roi_subset):
+        """
+        roi_subsetの臓器を1回の推論でセグメンテーションする
+
+        Returns:
+        (nibabel image, dict): マルチラベル画像と {臓器名: ラベル値}
+        """
+        return self.segment_fn(input_file, roi_subset, **self.backend_kwargs)
+
+    def segment_groups(self, input_file, mask_groups):
+        """
+        全グループの臓器の和集合で1回だけ推論し，グループごとの結合マスクに分割する
+
+        Parameters:
+        input_file (str): 入力のNIfTIファイル
+        mask_groups (list): [(グループ名, [臓器名, ...]), ...]
+
+        Returns:
+        (dict, numpy.ndarray): {グループ名: uint8の結合マスク (見つからない場合はNone)} とaffine
+        """
+        roi_subset = sorted({mask for _, masks in mask_groups for mask in masks})
+        seg_img, label_ids = self.segment(input_file, roi_subset)
+        labels = np.asanyarray(seg_img.dataobj)
+
+        combined_masks = {}
+        for group_name, masks in mask_groups:
+            ids = [label_ids[mask] for mask in masks if mask in label_ids]
+            if not ids:
+                combined_masks[group_name] = None
+                continue
+            combined_masks[group_name] = np.isin(labels, ids).astype(np.uint8)
+
+        return combined_masks, seg_img.affine
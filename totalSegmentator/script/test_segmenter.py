@@ -0,0 +1,119 @@
+import os
+import numpy as np
+import nibabel as nib
+import segmenter
+from segmenter import GroupSegmenter, keep_models_loaded
+from totalseg import process_case
+
+'''
+GroupSegmenter のテスト（TotalSegmentator・GPUなしでスタブのセグメンテーションを使う）
+
+python -m pytest test_segmenter.py
+'''
+
+# スタブが返すラベル値と，ラベルを置くzの範囲
+LABELS = {'thyroid_gland': (1, 12, 14), 'lung_upper_lobe_left': (2, 6, 10), 'kidney_left': (3, 1, 3)}
+
+
+def _write_case(path, n_slices=16):
+    labels = np.zeros((8, 8, n_slices), dtype=np.uint8)
+    for label, z_min, z_max in LABELS.values():
+        labels[2:6, 2:6, z_min:z_max + 1] = label
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), path)
+    return path
+
+
+class StubSegmentation:
+    """
+    入力のボリュームをそのままマルチラベル画像として返し，呼び出しを記録する
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input_file, roi_subset):
+        self.calls.append((input_file, tuple(roi_subset)))
+        img = nib.load(input_file)
+        return img, {name: label for name, (label, _, _) in LABELS.items() if name in roi_subset}
+
+
+def test_segment_groups_runs_once_per_case(tmp_path):
+    stub = StubSegmentation()
+    group_segmenter = GroupSegmenter(stub)
+    groups = [('thyroid', ['thyroid_gland']), ('lung', ['lung_upper_lobe_left']), ('kidney', ['kidney_left'])]
+
+    for case in ('case01', 'case02'):
+        masks, _ = group_segmenter.segment_groups(_write_case(str(tmp_path / f'{case}_CT2.nii.gz')), groups)
+        for group_name, (mask_name,) in groups:
+            _, z_min, z_max = LABELS[mask_name]
+            occupied = np.flatnonzero(masks[group_name].any(axis=(0, 1)))
+            assert masks[group_name].dtype == np.uint8
+            assert (occupied[0], occupied[-1]) == (z_min, z_max)
+
+    # 1ケースにつき全グループの和集合で1回だけ推論する
+    assert len(stub.calls) == 2
+    assert all(roi_subset == ('kidney_left', 'lung_upper_lobe_left', 'thyroid_gland') for _, roi_subset in stub.calls)
+
+
+def test_process_case_saves_combined_masks(tmp_path):
+    stub = StubSegmentation()
+    input_file = _write_case(str(tmp_path / 'case01_CT2.nii.gz'))
+    mask_groups = [
+        (str(tmp_path / 'dataset_thyroidgland'), ['thyroid_gland'], 'thyroidgland'),
+        (str(tmp_path / 'dataset_kidney'), ['kidney_left', 'kidney_right'], 'kidney'),
+        (str(tmp_path / 'dataset_liver'), ['liver'], 'liver'),
+    ]
+
+    saved = process_case(input_file, mask_groups, GroupSegmenter(stub))
+
+    assert len(stub.calls) == 1
+    assert sorted(os.path.basename(path) for path in saved) == ['kidney_case01_CT2.nii.gz',
+                                                                 'thyroidgland_case01_CT2.nii.gz']
+    kidney = np.asanyarray(nib.load(str(tmp_path / 'dataset_kidney' / 'case01_CT2' /
+                                        'kidney_case01_CT2.nii.gz')).dataobj)
+    assert np.flatnonzero(kidney.any(axis=(0, 1))).tolist() == [1, 2, 3]
+    # ラベルのない臓器グループは保存しない
+    assert not os.path.exists(tmp_path / 'dataset_liver' / 'case01_CT2')
+
+
+class StubPredictor:
+    """
+    nnUNetPredictor のスタブ（チェックポイントの読み込み回数を数える）
+    """
+    loads = 0
+
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.network = None
+
+    def initialize_from_trained_model_folder(self, model_training_output_dir, use_folds,
+                                             checkpoint_name='checkpoint_final.pth'):
+        StubPredictor.loads += 1
+        self.network = object()
+        self.list_of_parameters = [{'folder': model_training_output_dir, 'folds': use_folds}]
+
+
+def test_models_stay_loaded_across_cases(monkeypatch):
+    monkeypatch.setattr(segmenter, '_LOADED_MODELS', {})
+    keep_models_loaded(StubPredictor)
+
+    # TotalSegmentatorはケースごとに nnUNetPredictor を作成して初期化する
+    predictors = []
+    for _ in range(3):
+        predictor = StubPredictor()
+        predictor.initialize_from_trained_model_folder('/models/Dataset291', use_folds=[0])
+        predictors.append(predictor)
+
+    assert StubPredictor.loads == 1
+    assert all(predictor.network is predictors[0].network for predictor in predictors)
+    assert predictors[2].list_of_parameters is predictors[0].list_of_parameters
+
+    # 別のモデル・deviceは別に読み込む
+    StubPredictor().initialize_from_trained_model_folder('/models/Dataset292', use_folds=[0])
+    StubPredictor(device='cuda').initialize_from_trained_model_folder('/models/Dataset291', use_folds=[0])
+    assert StubPredictor.loads == 3
+
+    # 2回置き換えても読み込みは増えない
+    keep_models_loaded(StubPredictor)
+    StubPredictor().initialize_from_trained_model_folder('/models/Dataset291', use_folds=[0])
+    assert StubPredictor.loads == 3
@@ -1,72 +1,103 @@
-from totalsegmentator.python_api import totalsegmentator
-import nibabel as nib
-import numpy as np
 import os
+from segmenter import GroupSegmenter
+from mask_io import save_mask, DEFAULT_COMPRESSLEVEL, DEFAULT_GZIP_THREADS
+import script_paths  # noqa: F401
+from case_runner import new_case_result, summarize_results
+from instrumentation import measure_stage, ProgressReporter, file_size
 
-def process_file(input_file, output_folder, masks, combined_filename):
-    patient_id = os.path.basename(input_file)[:-7]  # '.nii.gz'を除外
-    output_path = os.path.join(output_folder, patient_id)
-
-    # 出力フォルダ作成
-    os.makedirs(output_path, exist_ok=True)
+def save_combined_mask(combined, affine, output_path, combined_filename, input_file,
+                       compresslevel=DEFAULT_COMPRESSLEVEL, gzip_threads=DEFAULT_GZIP_THREADS):
+    # 結合したマスクを.nii.gzへ直接保存（一時的な.niiは作らず，gzipは並列に圧縮）
+    combined_gz_path = os.path.join(output_path, f"{combined_filename}_{os.path.basename(input_file)[-19:]}")
+    save_mask(combined, affine, combined_gz_path, compresslevel, gzip_threads)
+    return combined_gz_path
 
-    # マスクの作成
-    totalsegmentator(input_file, output_path, roi_subset=masks)
+def process_case(input_file, mask_groups, segmenter,
+                 compresslevel=DEFAULT_COMPRESSLEVEL, gzip_threads=DEFAULT_GZIP_THREADS):
+    """
+    1ケースにつき1回だけ推論し，臓器グループごとの結合マスクを保存する
 
-    # 結合マスクの初期化
-    combined = None
+    Parameters:
+    input_file (str): 入力のNIfTIファイル
+    mask_groups (list): [(出力フォルダ, [臓器名, ...], 結合マスクのファイル名), ...]
+    segmenter (GroupSegmenter): ケース間でモデルを保持するセグメンテーション
+    compresslevel (int): gzipの圧縮レベル（1: 高速 ～ 9: 高圧縮）
+    gzip_threads (int): gzip圧縮に使うスレッド数
 
-    # 各マスクのデータを処理して結合
-    for mask in masks:
-        ref_img_path = os.path.join(output_path, f"{mask}.nii.gz")
-        if not os.path.exists(ref_img_path):
-            print(f"マスクファイルが見つかりません: {ref_img_path}")
-            continue
+    Returns:
+    list: 保存した結合マスクのパス
+    """
+    patient_id = os.path.basename(input_file)[:-7]  # '.nii.gz'を除外
+    saved_paths = []
 
-        ref_img = nib.load(ref_img_path)
-        img = ref_img.get_fdata()
+    # 全グループの臓器の和集合で1回だけ推論し，グループごとに分割
+    combined_masks, affine = segmenter.segment_groups(
+        input_file, [(combined_filename, masks) for _, masks, combined_filename in mask_groups])
 
+    for output_folder, masks, combined_filename in mask_groups:
+        combined = combined_masks[combined_filename]
         if combined is None:
-            combined = np.zeros(ref_img.shape, dtype=np.uint8)
-
-        combined[img > 0.5] = 1
+            print(f"マスクが見つかりません: {combined_filename} {masks}")
+            continue
 
-    # 結合したマスクを保存
-    if combined is not None:
-        combined_img = nib.Nifti1Image(combined, ref_img.affine)
-        combined_path = os.path.join(output_path, f"{combined_filename}.nii")
-        nib.save(combined_img, combined_path)
+        # 出力フォルダ作成
+        output_path = os.path.join(output_folder, patient_id)
+        os.makedirs(output_path, exist_ok=True)
+        saved_paths.append(save_combined_mask(combined, affine, output_path, combined_filename, input_file,
+                                              compresslevel, gzip_threads))
+    return saved_paths
 
-        # 圧縮保存と一時ファイル削除
-        combined_gz_path = os.path.join(output_path, f"{combined_filename}_{os.path.basename(input_file)[-19:]}")
-        nib.save(nib.load(combined_path), combined_gz_path)
-        os.remove(combined_path)
+# 変換したNIfTIファイルのフォルダ
+INPUT_FOLDER = '~/dataset_nifti'
 
-    # 個別のマスクファイルを削除
-    for mask in masks:
-        ref_img_path = os.path.join(output_path, f"{mask}.nii.gz")
-        if os.path.exists(ref_img_path):
-            os.remove(ref_img_path)
+## 各パラメータのmasks`['thyroid_gland'], ...`を変更することで検出する臓器を変更可能です．
+## 検出する臓器名は以下を参照してください：https://github.com/wasserth/TotalSegmentator/blob/ff50878153342c7b4cb8ae466f7d98aadde4797d/README.md
+MASK_GROUPS = [
+    ('~/totalSegmentator/organSeg/dataset_thyroidgland', ['thyroid_gland'], 'thyroidgland'),
+    ('~/totalSegmentator/organSeg/dataset_wholelung', ['lung_upper_lobe_right', 'lung_middle_lobe_right', 'lung_lower_lobe_right', 'lung_upper_lobe_left', 'lung_lower_lobe_left'], 'wholelung'),
+    ('~/totalSegmentator/organSeg/dataset_kidney', ['kidney_right', 'kidney_left'], 'kidney')
+]
 
-def main():
-    
-    inputfol = '~/dataset_nifti'
+def main(segment_fn=None, compresslevel=DEFAULT_COMPRESSLEVEL, gzip_threads=DEFAULT_GZIP_THREADS, metrics=None,
+         inputfol=INPUT_FOLDER, mask_groups=MASK_GROUPS):
+    """
+    segment_fn: セグメンテーションの関数（Noneの場合はTotalSegmentator．テスト時はスタブを渡す）
+    compresslevel: 結合マスクのgzipの圧縮レベル
+    gzip_threads: gzip圧縮に使うスレッド数
+    metrics: 指定した場合はケースごとの計測結果を出力 (instrumentation.MetricsWriter)
+    inputfol: 変換したNIfTIファイルのフォルダ
+    mask_groups: [(出力フォルダ, [臓器名, ...], 結合マスクのファイル名), ...]
 
-    ## 各パラメータのmasks`['thyroid_gland'], ...`を変更することで検出する臓器を変更可能です．
-    ## 検出する臓器名は以下を参照してください：https://github.com/wasserth/TotalSegmentator/blob/ff50878153342c7b4cb8ae466f7d98aadde4797d/README.md
-    input_output_mask_data = [
-        (inputfol, '~/totalSegmentator/organSeg/dataset_thyroidgland', ['thyroid_gland'], 'thyroidgland'),
-        (inputfol, '~/totalSegmentator/organSeg/dataset_wholelung', ['lung_upper_lobe_right', 'lung_middle_lobe_right', 'lung_lower_lobe_right', 'lung_upper_lobe_left', 'lung_lower_lobe_left'], 'wholelung'),
-        (inputfol, '~/totalSegmentator/organSeg/dataset_kidney', ['kidney_right', 'kidney_left'], 'kidney')
-    ]
+    CPUノードで分割に必要なz範囲のみを求める場合（マスクは保存しない）は slicePartitioning/script/extents.py を使う
+    """
+    # モデルはケース間で保持する
+    segmenter = GroupSegmenter(segment_fn)
 
-    # 各フォルダの処理
-    for input_folder, output_folder, masks, combined_filename in input_output_mask_data:
-        for filename in os.listdir(input_folder):
-            if filename.endswith('.nii.gz'):
-                process_file(os.path.join(input_folder, filename), output_folder, masks, combined_filename)
+    # 全グループを1回の推論でまとめて処理
+    filenames = [filename for filename in sorted(os.listdir(inputfol)) if filename.endswith('.nii.gz')]
+    progress = ProgressReporter('segment', len(filenames))
+    results = []
+    for filename in filenames:
+        input_file = os.path.join(inputfol, filename)
+        result = new_case_result(filename[:-7])
+        with measure_stage(result, 'segment') as stage_metrics:
+            stage_metrics.read(file_size(input_file))
+            for path in process_case(input_file, mask_groups, segmenter, compresslevel, gzip_threads):
+                stage_metrics.write(file_size(path))
+                result['files'] += 1
+        results.append(result)
+        progress.add_result(result)
+        if metrics is not None:
+            metrics.add_result(result)
+    progress.close()
+    return summarize_results(results, 'segment')
 
 if __name__ == "__main__":
     from multiprocessing import freeze_support
     freeze_support()
-    main()
\ No newline at end of file
+    main()
+
+    # ケースごとの処理時間・読み書きしたバイト数を記録する場合
+    # from instrumentation import MetricsWriter
+    # with MetricsWriter('~/metrics.jsonl', '~/slicepartitioning.prom') as metrics:
+    #     main(metrics=metrics)
\ No newline at end of file